@@ -0,0 +1,70 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import profiling
+
+# which images analyze_speed saves for manual revision
+artifact_modes = ['none', 'flagged', 'all']
+
+
+class ArtifactWriter:
+    def __init__(self, threads=None, max_pending=64, chunk_size=256):
+        if threads is None:
+            threads = min(4, os.cpu_count())
+
+        # png encoding releases the GIL, threads are enough to keep it off the main thread
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.chunk_size = chunk_size
+        self.futures = []
+
+    def submit(self, function, *args):
+        # block only when max_pending tasks are already queued, so that the images in flight don't pile up
+        self.slots.acquire()
+        future = self.pool.submit(function, *args)
+        future.add_done_callback(lambda future: self.slots.release())
+        self.futures.append(future)
+
+        # keep only the futures still running, failed ones are reported by close()
+        self.futures = [future for future in self.futures
+                        if not future.done() or future.exception() is not None]
+
+    def write_image(self, filename, img):
+        import cv2 as cv
+
+        def write():
+            with profiling.stage("png encode"):
+                cv.imwrite(filename, img)
+
+        self.submit(write)
+
+    def write_segments(self, seg_list, out_path, name, indexes=None):
+        import cv2 as cv
+
+        if indexes is None:
+            indexes = range(0, len(seg_list))
+
+        def write(chunk):
+            with profiling.stage("png encode"):
+                for j in chunk:
+                    cv.imwrite(out_path + name + "_" +
+                               str(j) + ".png", seg_list[j])
+
+        indexes = list(indexes)
+        for start in range(0, len(indexes), self.chunk_size):
+            self.submit(write, indexes[start:start+self.chunk_size])
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+
+
+"""
+    saves images in background threads, so that encoding them doesn't block the analysis
+    write_segments(): saves the segments with the given indexes (all of them by default) as name_j.png in out_path,
+    with the same names as vision.write_segments; seg_list can be a view over a spectrogram, which is kept in memory
+    until its segments are written
+    close() waits for all the images to be written, and raises the first error of the writer threads if any
+"""
@@ -0,0 +1,442 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import importlib
+import contextlib
+import numpy as np
+
+import utils
+import vision
+import profiling
+from inference import backends, model_paths, speedup_dict
+from spectrogram import engines
+
+
+# speed of the tape during each kind of irregularity, relative to the recording speed
+speed_factors = {
+    "double": 2.0,
+    "half": 0.5,
+    "quadruple": 4.0,
+    "quarter": 0.25
+}
+
+# pitches of the synthetic melody, in Hz, and how long each note lasts on
+# the tape (at the recording speed)
+note_frequencies = [110.0, 146.8, 196.0, 220.0, 293.7, 329.6,
+                    392.0, 440.0, 587.3, 659.3, 784.0, 880.0]
+note_seconds = 0.25
+
+
+def tape_events(duration, irregular_seconds=8, regular_seconds=22):
+    events = []
+    start = regular_seconds / 2
+    k = 0
+
+    # regular and irregular sections alternate, the irregularities go
+    # through the four speedups in turn
+    while start + irregular_seconds < duration:
+        events.append({"start": round(start, 2), "end": round(start + irregular_seconds, 2),
+                       "speedup": speedup_dict[k % len(speedup_dict)]})
+        start += irregular_seconds + regular_seconds
+        k += 1
+
+    return events
+
+
+"""
+    returns the list of irregularities of a synthetic tape of the given duration (in seconds), with
+    their start and end time in seconds and their speedup
+"""
+
+
+def synthetic_tape(path, duration, sr=44100, channels=2, events=None, gap=0.25, seed=2023,
+                   block_seconds=10):
+    from scipy.io import wavfile
+
+    if events is None:
+        events = tape_events(duration)
+
+    rng = np.random.default_rng(seed)
+    n_frames = int(duration*sr)
+
+    # playback speed of each event, the tape runs at the recording speed everywhere else
+    event_bounds = np.array([[event["start"], event["end"]] for event in events]).reshape(-1, 2)
+    event_speeds = np.array([speed_factors[event["speedup"]] for event in events])
+
+    # a different melody on each channel, so that the channels are not identical
+    melodies = rng.integers(0, len(note_frequencies), size=(channels, 4096))
+    frequencies = np.array(note_frequencies)
+
+    data = np.empty((n_frames, channels), dtype=np.int16)
+    tape_position = 0.0
+    phases = np.zeros(channels)
+
+    for block_start in range(0, n_frames, block_seconds*sr):
+        t = np.arange(block_start, min(block_start + block_seconds*sr, n_frames)) / sr
+
+        speed = np.ones(len(t))
+        silent = np.zeros(len(t), dtype=bool)
+        for (start, end), factor in zip(event_bounds, event_speeds):
+            speed[(t >= start) & (t < end)] = factor
+            # the tape stops for a moment at every change of speed
+            silent |= (np.abs(t - start) < gap/2) | (np.abs(t - end) < gap/2)
+
+        # position on the tape (in seconds at the recording speed) of every sample played
+        position = tape_position + np.cumsum(speed) / sr
+        tape_position = position[-1]
+
+        notes = (position / note_seconds).astype(np.int64)
+        for c in range(0, channels):
+            # the pitch of the melody is scaled by the speed of the tape, as is its tempo
+            frequency = frequencies[melodies[c, notes % melodies.shape[1]]] * speed
+            phase = phases[c] + np.cumsum(2*np.pi*frequency / sr)
+            phases[c] = phase[-1] % (2*np.pi)
+
+            # three harmonics and the hiss of the tape
+            signal = 0.5*np.sin(phase) + 0.25*np.sin(2*phase) + 0.12*np.sin(3*phase)
+            signal += 0.02*rng.standard_normal(len(t))
+            signal[silent] = 0
+
+            data[block_start:block_start + len(t), c] = np.round(
+                signal * 0.8 * 32767).astype(np.int16)
+
+    wavfile.write(path, sr, data)
+
+    with open(os.path.splitext(path)[0] + ".json", 'w') as truth_file:
+        json.dump({"duration": duration, "sr": sr, "channels": channels, "events": events},
+                  truth_file, indent=4)
+
+    return events
+
+
+"""
+    writes a 16-bit .wav file of the given duration (in seconds), playing a
+    melody with its harmonics and some hiss
+    events: list of irregularities, as returned by tape_events (the default), during
+    which the tape is played at the speed of their speedup: both the pitch and the tempo
+    of the melody change, as on a real tape
+    gap: the tape is silent for this many seconds around each change of speed
+    the ground truth (duration, sample rate, channels and events) is saved
+    next to the .wav file, as a .json file
+    the tape is generated block_seconds at a time, the same seed always gives the same tape
+"""
+
+
+def tape_path(work_path, duration, sr, channels):
+    return (work_path + "tapes/tape-" + str(int(duration)) + "s-" + str(sr) + "hz-" + str(channels)
+            + "ch.wav")
+
+
+def time_call(function, repeat):
+    seconds = []
+    for r in range(0, repeat):
+        profiling.reset()
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+
+    return min(seconds), result
+
+
+"""
+    calls function() repeat times and returns the best time, with the result of the last call
+    the stages measured by the profiling hooks are those of the last call
+"""
+
+
+def stage_seconds():
+    return {name: round(stats["seconds"], 4)
+            for name, stats in profiling.snapshot()["stages"].items()}
+
+
+def recall(events, records):
+    found = 0
+    for event in events:
+        # an irregularity is found if an event with its speedup overlaps it
+        for record in records:
+            if record.get("type") == "event" and record["speedup"] == event["speedup"] \
+                    and record["start"] < event["end"] and record["end"] > event["start"]:
+                found += 1
+                break
+
+    return round(found / len(events), 3) if len(events) > 0 else None
+
+
+"""
+    returns the fraction of the irregularities of the ground truth that overlap an event with the
+    same speedup in the records of a channel, as saved by analyze_speed
+"""
+
+
+def benchmark_tape(sample, duration, scale, width_res, steps, repeat, work_path, analysis=None,
+                   engine='sox'):
+    from wav2spec import wav2spec
+
+    cases = []
+    name = f"{os.path.basename(sample)[:-4]} {scale} w{width_res}"
+    out_path = work_path + "output/"
+    spectrograms_path = out_path + "spectrograms/"
+    segments_path = out_path + "segments/"
+
+    def add(case_name, seconds, **extra):
+        cases.append(dict({"name": case_name, "seconds": round(seconds, 4),
+                           "realtime": round(duration / seconds, 1)}, **extra))
+        print(f"{case_name}: {cases[-1]['seconds']}s ({cases[-1]['realtime']}x realtime)")
+
+    # spectrogram of the whole tape, as wav2spec.py computes it
+    utils.create_folder(spectrograms_path)
+    seconds, img = time_call(lambda: wav2spec(
+        sample, scale, spectrograms_path, width_res, save=True, engine=engine), repeat)
+    add(f"wav2spec {name}", seconds, stages=stage_seconds())
+
+    # split detection, as divide.py does it
+    seconds, thresholded = time_call(lambda: vision.highlight_split(
+        img=img, low_thresh=15, high_thresh=255, h_size=3, v_size=20), repeat)
+    add(f"highlight_split {name}", seconds)
+    seconds, splits = time_call(lambda: vision.find_splits(thresholded), repeat)
+    add(f"find_splits {name}", seconds, splits=len(splits))
+
+    for step in steps:
+        # windows of the spectrogram: the batch read by the models, and the
+        # segments saved as .png by segment.py
+        seconds, windows = time_call(lambda: np.array(vision.segment(
+            img, step, 256, multiple=True, offset=0)), repeat)
+        add(f"segment {name} j{step}", seconds, windows=len(windows))
+
+        utils.create_folder(segments_path)
+        seconds, result = time_call(lambda: vision.compute_segments(
+            [spectrograms_path], [segments_path], step=step, window_width=256, multiple=True,
+            offset=128), repeat)
+        add(f"compute_segments {name} j{step}", seconds, stages=stage_seconds())
+
+        if analysis is None:
+            continue
+
+        from main import analyze_speed
+
+        # the whole analysis of main.py, with the classifiers
+        def analyze():
+            with contextlib.redirect_stdout(io.StringIO()):
+                analyze_speed([sample], out_path + "analysis/", scale,
+                              width_res=width_res, step=step, **analysis)
+
+        seconds, result = time_call(analyze, repeat)
+        stages = stage_seconds()
+
+        # how many of the known irregularities are found on each channel
+        with open(os.path.splitext(sample)[0] + ".json") as truth_file:
+            truth = json.load(truth_file)
+        recalls = []
+        for i in range(0, truth["channels"]):
+            records_filename = out_path + "analysis/" + \
+                os.path.basename(sample)[:-4] + "/output-ch" + str(i) + ".jsonl"
+            with open(records_filename) as records_file:
+                recalls.append(recall(truth["events"], [json.loads(line) for line in records_file]))
+
+        add(f"analyze_speed {name} j{step}", seconds, stages=stages, recall=recalls)
+
+    return cases
+
+
+"""
+    times, on one synthetic tape, each stage of the offline pipeline (wav2spec.py, the
+    split detection of divide.py, the segmentation of segment.py) and the whole
+    analysis of main.py, for each step in steps
+    analysis: keyword arguments of analyze_speed (models, backend,
+    processes, engine), None to skip the analysis
+    engine: 'sox' or 'numpy', what computes the 'lin' and 'log' spectrograms
+    returns a list of cases, each with its name, its best time over repeat runs, how many times
+    faster than realtime it is, and the time of the stages measured by the profiling hooks
+"""
+
+
+def compare(cases, baseline, tolerance, min_difference=0.01):
+    previous = {case["name"]: case for case in baseline["cases"]}
+    regressions = []
+
+    print(f"Comparison with the baseline (tolerance {round(tolerance*100)}%):")
+    for case in cases:
+        if case["name"] not in previous:
+            print(f"    {case['name']}: {case['seconds']}s, not in the baseline")
+            continue
+
+        before = previous[case["name"]]["seconds"]
+        change = (case["seconds"] - before) / before if before > 0 else 0.0
+        status = ""
+        # differences of a few milliseconds are timer noise, even when large in proportion
+        if change > tolerance and case["seconds"] - before > min_difference:
+            status = " - regression"
+            regressions.append(case["name"])
+        print(f"    {case['name']}: {before}s -> {case['seconds']}s ({change*100:+.1f}%){status}")
+
+    return regressions
+
+
+"""
+    compares the times of the cases with those of the baseline (a
+    report saved by a previous run), by name
+    returns the names of the cases that are slower than in the baseline by more than tolerance (a
+    fraction) and by more than min_difference seconds
+"""
+
+
+if __name__ == "__main__":
+    script_path = utils.get_script_path()
+    models_path = os.path.dirname(script_path) + "/models/"
+
+    parser = argparse.ArgumentParser(
+        description="""Generate synthetic tapes with known speed irregularities, measure how long
+        each stage of the analysis takes on them, and compare the times with a baseline.""")
+
+    # optional arguments: work folder
+    parser.add_argument('-o', '--output', type=str, default="benchmark",
+                        help="""Folder in which to save the tapes, the outputs and the report. The
+                        tapes are kept and reused by the next runs. Default is 'benchmark'.""")
+
+    # optional arguments: length of the tapes
+    parser.add_argument('-l', '--lengths', nargs='+', type=float, default=[60, 600],
+                        help="Length of each synthetic tape, in seconds. Default is 60 600.")
+
+    # optional arguments: sample rate and channels of the tapes
+    parser.add_argument('--sr', nargs='?', type=int, default=44100,
+                        help="Sample rate of the synthetic tapes. Default is 44100.")
+    parser.add_argument('--channels', nargs='?', type=int, default=2,
+                        help="Number of channels of the synthetic tapes. Default is 2.")
+
+    # optional arguments: settings of the analysis
+    parser.add_argument('-s', '--scales', nargs='+', type=str, default=['lin'],
+                        help="""Scales of the spectrograms to measure, 'log',
+                        'lin' and/or 'mel'. Default is lin.""")
+    parser.add_argument('-w', '--widths', nargs='+', type=int, default=[256],
+                        help="Resolutions of the x-axis to measure, in pixels/s. Default is 256.")
+    parser.add_argument('-j', '--jumps', nargs='+', type=int, default=[64],
+                        help="Steps of the scanning to measure, in pixels. Default is 64.")
+
+    # optional arguments: repetitions
+    parser.add_argument('-r', '--repeat', nargs='?', type=int, default=3,
+                        help="""How many times to run each stage, the
+                        best time is kept. Default is 3.""")
+
+    # optional arguments: analysis
+    parser.add_argument('--backend', type=str, default='keras',
+                        help="""Runtime of the classifiers for the analysis: 'keras', 'tflite',
+                        'onnx' or 'tflite-int8'. Default is 'keras'.""")
+    parser.add_argument('-p', '--processes', nargs='?', type=int, default=None,
+                        help="Processes used by the analysis. Default is the number of CPUs.")
+    parser.add_argument('--engine', type=str, default='sox',
+                        help="""What computes the 'lin' and 'log' spectrograms: 'sox' or
+                        'numpy', as in main.py. Default is 'sox'.""")
+    parser.add_argument('--no-analysis', action='store_true',
+                        help="Only measure the stages that don't need the classifiers.")
+
+    # optional arguments: baseline
+    parser.add_argument('--baseline', type=str, default=None,
+                        help="""Report of a previous run (.json) to compare the times with. Exits
+                        with an error if a stage got slower than the tolerance.""")
+    parser.add_argument('--tolerance', nargs='?', type=float, default=0.25,
+                        help="""How much slower than the baseline a stage can be,
+                        as a fraction. Default is 0.25.""")
+
+    args = parser.parse_args()
+
+    work_path = args.output
+    if not work_path.endswith("/"):
+        work_path = work_path + "/"
+
+    if any(scale not in ['lin', 'log', 'mel'] for scale in args.scales):
+        print("The scales chosen are not valid. See benchmark.py -h for information.")
+        sys.exit(1)
+
+    if args.backend not in backends:
+        print(f"{args.backend} is not a valid backend. See benchmark.py -h for information.")
+        sys.exit(1)
+
+    if args.engine not in engines:
+        print(f"{args.engine} is not a valid engine. See benchmark.py -h for information.")
+        sys.exit(1)
+
+    if args.engine == 'sox' and args.scales != ['mel'] and shutil.which('sox') is None:
+        print("sox is not on the PATH, use --engine numpy or install sox-extended. "
+              "Exiting program.")
+        sys.exit(1)
+
+    if args.repeat < 1:
+        print("The stages must be run at least once. See benchmark.py -h for information.")
+        sys.exit(1)
+
+    baseline = None
+    if args.baseline is not None:
+        if not os.path.isfile(args.baseline):
+            print(f"The baseline {args.baseline} doesn't exist. Exiting program.")
+            sys.exit(1)
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    os.makedirs(work_path + "tapes/", exist_ok=True)
+    os.makedirs(work_path + "output/", exist_ok=True)
+
+    # the tapes are generated once, the next runs measure the same audio
+    samples = []
+    for duration in args.lengths:
+        sample = tape_path(work_path, duration, args.sr, args.channels)
+        if not os.path.isfile(sample) or not os.path.isfile(sample[:-4] + ".json"):
+            print(f"Generating {sample}..")
+            synthetic_tape(sample, duration, args.sr, args.channels)
+        samples.append((sample, duration))
+
+    # import the modules that the stages import lazily, so that the first run doesn't pay for them
+    lazy_modules = ['cv2', 'scipy.fft', 'scipy.signal', 'scipy.io.wavfile']
+    if 'mel' in args.scales:
+        lazy_modules.append('librosa')
+    for name in lazy_modules:
+        importlib.import_module(name)
+
+    # the stages are timed with the profiling hooks, without tracing the
+    # memory which would slow them down
+    profiling.enable(memory=False)
+
+    cases = []
+    for scale in args.scales:
+        analysis = None
+        if not args.no_analysis:
+            binary_model_path, four_classes_model_path = model_paths(models_path, scale)
+            analysis = {"binary_model_path": binary_model_path,
+                        "four_classes_model_path": four_classes_model_path,
+                        "backend": args.backend, "processes": args.processes,
+                        "engine": args.engine}
+
+            # check that the classifiers can be loaded, otherwise measure the other stages only
+            try:
+                from main import load_classifier
+                load_classifier(binary_model_path, four_classes_model_path, 256, args.backend)
+            except (ImportError, OSError, ValueError) as e:
+                print(f"Couldn't load the {scale} classifiers ({e}), the analysis is not measured.")
+                analysis = None
+
+        for sample, duration in samples:
+            for width_res in args.widths:
+                cases += benchmark_tape(sample, duration, scale, width_res, args.jumps, args.repeat,
+                                        work_path, analysis, args.engine)
+
+    report = {
+        "command": sys.argv,
+        "cpus": os.cpu_count(),
+        "lengths": args.lengths,
+        "sr": args.sr,
+        "channels": args.channels,
+        "engine": args.engine,
+        "cases": cases
+    }
+    with open(work_path + "report.json", 'w') as report_file:
+        json.dump(report, report_file, indent=4)
+    print(f"Saved report in {work_path}report.json")
+
+    if baseline is not None:
+        regressions = compare(cases, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print(f"{len(regressions)} stages are slower than the baseline. Exiting with an error.")
+            sys.exit(1)
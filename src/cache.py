@@ -0,0 +1,135 @@
+import os
+import hashlib
+import functools
+import numpy as np
+
+import profiling
+
+
+# default location and size limit of the cache
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "speed-analyzer")
+CACHE_SIZE = 2048  # MB
+
+# change this when the spectrograms computed for the same audio change, to invalidate the old entries
+CACHE_VERSION = 3
+
+
+@functools.lru_cache(maxsize=64)
+def file_digest(path, size, mtime):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as audio_file:
+        for block in iter(lambda: audio_file.read(2**20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+"""
+    returns the sha256 of the content of the file
+    size and mtime are only part of the key of the memoization, so that a modified file is hashed again
+"""
+
+
+def sample_digest(sample):
+    stat = os.stat(sample)
+
+    return file_digest(os.path.abspath(sample), stat.st_size, stat.st_mtime_ns)
+
+
+"""
+    returns the sha256 of the audio file sample, hashed once per process for each version of the file
+    the memoization is not shared with the worker processes: compute it in the main process and pass it to them
+"""
+
+
+class SpectrogramCache:
+    def __init__(self, path=CACHE_PATH, max_size=CACHE_SIZE):
+        self.path = path
+        self.max_bytes = max_size * 2**20
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, sample, scale, width, channel, digest=None, engine='sox'):
+        if digest is None:
+            digest = sample_digest(sample)
+
+        return f"{digest}-{scale}-{engine}-{width}-{channel}-v{CACHE_VERSION}"
+
+    def get(self, key):
+        entry = os.path.join(self.path, key + ".npy")
+        try:
+            img = np.load(entry)
+        except (OSError, ValueError):
+            return None
+
+        # mark the entry as recently used
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+
+        return img
+
+    def put(self, key, img):
+        entry = os.path.join(self.path, key + ".npy")
+
+        # write to a temporary file first, so that concurrent readers never see a partial entry
+        tmp_entry = entry + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_entry, 'wb') as tmp_file:
+            np.save(tmp_file, img)
+        os.replace(tmp_entry, entry)
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for filename in os.listdir(self.path):
+            if not filename.endswith(".npy"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, filename))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+
+        # remove the least recently used entries until the cache fits its size limit
+        total = sum(size for mtime, size, filename in entries)
+        for mtime, size, filename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(os.path.join(self.path, filename))
+            except OSError:
+                pass
+            total -= size
+
+
+"""
+    stores spectrograms as .npy files in path, keyed by the sha256 of the audio file, the scale, the engine that
+    computed it, the width of the spectrogram (which depends only on the audio and on the resolution of the x-axis)
+    and the channel
+    max_size: size limit of the cache in MB, the least recently used spectrograms are deleted beyond it
+    the same cache can be shared by several processes
+"""
+
+
+def cached_spectrogram(cache, sample, scale, width, channel, compute, digest=None, engine='sox'):
+    if cache is None:
+        return compute()
+
+    with profiling.stage("cache read"):
+        key = cache.key(sample, scale, width, channel, digest, engine)
+        img = cache.get(key)
+    if img is None:
+        img = compute()
+        with profiling.stage("cache write"):
+            cache.put(key, img)
+
+    return img
+
+
+"""
+    returns the spectrogram from the cache if there, otherwise computes it with compute() and stores it
+    cache: SpectrogramCache, or None to always compute the spectrogram
+    digest: sha256 of the sample (see sample_digest), computed here if not given
+    engine: what computes the spectrogram, 'sox' or 'numpy', kept apart in the cache
+"""
@@ -0,0 +1,374 @@
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+import utils
+import profiling
+
+
+# how many segments go in each shard: 2048 segments of 128x256 pixels are 64MB
+SHARD_SIZE = 2048
+
+# part of the name of the samples that tells the speedup of the 'w' segments, as in the training notebook
+speedup_patterns = {
+    "3,75ips_to15ips": "quadruple",
+    "15ips_to3,75ips": "quarter",
+    "3,75ips_to7,5ips": "double",
+    "7,5ips_to15ips": "double",
+    "15ips_to7,5ips": "half",
+    "7,5ips_to3,75ips": "half"
+}
+
+
+class ShardWriter:
+    def __init__(self, out_path, labels, shard_size=SHARD_SIZE, segment_shape=(128, 256), overwrite=False):
+        if not out_path.endswith("/"):
+            out_path = out_path + "/"
+
+        # the folder is emptied, never do that to a folder with other files unless asked to
+        if os.path.isdir(out_path) and len(os.listdir(out_path)) > 0 and not overwrite:
+            raise FileExistsError(f"{out_path} is not empty")
+        utils.create_folder(out_path)
+
+        self.out_path = out_path
+        self.labels = sorted(labels)
+        self.shard_size = shard_size
+        self.segment_shape = tuple(segment_shape)
+
+        self.sources = []
+        self.source_indexes = {}
+        self.shards = []
+
+        self.segments = np.empty((shard_size,) + self.segment_shape, dtype=np.uint8)
+        self.segment_labels = np.empty(shard_size, dtype=np.int16)
+        self.segment_sources = np.empty(shard_size, dtype=np.int32)
+        self.n_buffered = 0
+
+    def add(self, segments, label, source):
+        # check the shape before copying anything, the buffer only holds segments of one shape
+        if len(segments) > 0 and np.shape(segments)[1:] != self.segment_shape:
+            raise ValueError(f"the segments of {source} have shape {np.shape(segments)[1:]}, "
+                             f"the shards hold segments of shape {self.segment_shape}")
+
+        if source not in self.source_indexes:
+            self.source_indexes[source] = len(self.sources)
+            self.sources.append(source)
+
+        # copy the segments in the buffer of the current shard, writing it out whenever it's full
+        start = 0
+        while start < len(segments):
+            n = min(len(segments) - start, self.shard_size - self.n_buffered)
+            end = self.n_buffered + n
+
+            self.segments[self.n_buffered:end] = segments[start:start+n]
+            self.segment_labels[self.n_buffered:end] = self.labels.index(label)
+            self.segment_sources[self.n_buffered:end] = self.source_indexes[source]
+
+            self.n_buffered = end
+            start += n
+            if self.n_buffered == self.shard_size:
+                self.flush()
+
+    def flush(self):
+        if self.n_buffered == 0:
+            return
+
+        name = "shard-" + str(len(self.shards)).zfill(5)
+        with profiling.stage("shard write"):
+            np.save(self.out_path + name + ".npy", self.segments[:self.n_buffered])
+            np.save(self.out_path + name + "-labels.npy", self.segment_labels[:self.n_buffered])
+            np.save(self.out_path + name + "-sources.npy", self.segment_sources[:self.n_buffered])
+
+        self.shards.append({"name": name, "size": self.n_buffered})
+        self.n_buffered = 0
+
+    def close(self):
+        self.flush()
+
+        index = {
+            "labels": self.labels,
+            "sources": self.sources,
+            "segment_shape": list(self.segment_shape),
+            "shards": self.shards
+        }
+        with open(self.out_path + "index.json", 'w') as index_file:
+            json.dump(index, index_file, indent=4)
+
+        return sum(shard["size"] for shard in self.shards)
+
+
+"""
+    writes segments to out_path in shards of shard_size segments, each one made of three .npy files:
+    the uint8 segments (shard_size, height, width), the label and the source sample of every segment
+    out_path must be empty or not exist, unless overwrite is set: it is then emptied first
+    index.json lists the shards, the label names and the source names, and is written by close()
+    add(): segments is an array (or a list) of 2-D uint8 segments of shape segment_shape, all with the same label
+    and source, raises ValueError otherwise
+"""
+
+
+class SegmentDataset:
+    def __init__(self, path):
+        if not path.endswith("/"):
+            path = path + "/"
+
+        with open(path + "index.json") as index_file:
+            index = json.load(index_file)
+
+        self.labels = index["labels"]
+        self.sources = index["sources"]
+        self.segment_shape = tuple(index["segment_shape"])
+
+        # the segments stay on disk, only the pages that are read get loaded
+        self.shards = [np.load(path + shard["name"] + ".npy", mmap_mode='r')
+                       for shard in index["shards"]]
+        self.segment_labels = np.concatenate([np.load(path + shard["name"] + "-labels.npy")
+                                              for shard in index["shards"]] + [np.empty(0, dtype=np.int16)])
+        self.segment_sources = np.concatenate([np.load(path + shard["name"] + "-sources.npy")
+                                               for shard in index["shards"]] + [np.empty(0, dtype=np.int32)])
+
+        # global index of the first segment of each shard
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, indexes):
+        indexes = np.asarray(indexes, dtype=np.int64)
+        shard_indexes = np.searchsorted(self.offsets, indexes, side='right') - 1
+
+        segments = np.empty((len(indexes),) + self.segment_shape, dtype=np.uint8)
+        for k in np.unique(shard_indexes):
+            selected = np.flatnonzero(shard_indexes == k)
+            segments[selected] = self.shards[k][indexes[selected] - self.offsets[k]]
+
+        return segments
+
+
+"""
+    reads a dataset written by ShardWriter, memory-mapping its shards
+    dataset[indexes] returns the segments with the given global indexes as a (n, height, width) uint8 array
+    segment_labels and segment_sources hold the label and the source index of every segment
+"""
+
+
+class ManifestSegments:
+    def __init__(self, path):
+        if os.path.isdir(path):
+            entries = folder_entries(path)
+        else:
+            entries = utils.read_split_manifest(path)
+
+        self.labels = sorted(set(label for label, file_path in entries))
+        self.paths = [file_path for label, file_path in entries]
+        self.sources = self.paths
+        self.segment_labels = np.array([self.labels.index(label) for label, file_path in entries],
+                                       dtype=np.int16)
+        self.segment_sources = np.arange(len(entries), dtype=np.int32)
+        self.segment_shape = (128, 256)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, indexes):
+        import cv2 as cv
+
+        return np.stack([cv.imread(self.paths[i], cv.IMREAD_GRAYSCALE) for i in indexes])
+
+
+"""
+    reads the .png segments listed in a split manifest (see utils.write_split_manifests), with the same interface as
+    SegmentDataset, so that SegmentBatches can be used on a split without creating its folders
+    path can also be a folder with a subfolder of segments for each label, as read by flow_from_directory
+"""
+
+
+def folder_entries(path):
+    if not path.endswith("/"):
+        path = path + "/"
+
+    # labels and files in alphabetical order, as flow_from_directory lists them
+    labels = sorted(label for label in os.listdir(path) if os.path.isdir(path + label))
+
+    return [(label, path + label + "/" + filename) for label in labels
+            for filename in sorted(os.listdir(path + label)) if filename.endswith(".png")]
+
+
+"""
+    returns the list of (label, path) pairs of the .png segments in the subfolders of path, one for each label
+"""
+
+
+def split_indexes(dataset, ratios, seed):
+    splits = [[], [], []]
+
+    # divide the segments of each label separately, as utils.create_dataset does with the folders
+    for label in range(0, len(dataset.labels)):
+        indexes = list(np.flatnonzero(dataset.segment_labels == label))
+        for i, split in enumerate(utils.split_files(indexes, ratios, seed)):
+            splits[i] += split
+
+    return [np.sort(np.array(split, dtype=np.int64)) for split in splits]
+
+
+"""
+    returns the indexes of the segments of the dataset in the training, validation and test set
+    the same seed and ratios always give the same split, save it with np.save to reuse it
+"""
+
+
+def speedup_classes(dataset, wrong_label="w"):
+    labels = sorted(set(speedup_patterns.values()))
+    source_classes = np.full(len(dataset.sources), -1, dtype=np.int16)
+
+    for i, source in enumerate(dataset.sources):
+        for pattern, speedup in speedup_patterns.items():
+            if pattern in source:
+                source_classes[i] = labels.index(speedup)
+                break
+
+    # only the segments after the speed transition have a speedup
+    classes = source_classes[dataset.segment_sources]
+    indexes = np.flatnonzero((dataset.segment_labels == dataset.labels.index(wrong_label)) & (classes >= 0))
+
+    return indexes, classes[indexes], labels
+
+
+"""
+    returns the indexes of the segments of the dataset that can be used for the 4-class classifier, their class and
+    the names of the classes ('double', 'half', 'quadruple', 'quarter')
+"""
+
+
+class SegmentBatches:
+    def __init__(self, dataset, indexes=None, labels=None, n_classes=None, batch_size=20, shuffle=True, seed=None):
+        self.dataset = dataset
+        self.indexes = np.arange(len(dataset)) if indexes is None else np.asarray(indexes)
+        self.labels = dataset.segment_labels[self.indexes] if labels is None else np.asarray(labels)
+        self.n_classes = len(dataset.labels) if n_classes is None else n_classes
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+
+        self.order = np.arange(len(self.indexes))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.indexes) / self.batch_size))
+
+    def __getitem__(self, i):
+        # read the segments of the batch in the order they are stored, which is faster on memory-mapped shards
+        batch = np.sort(self.order[i*self.batch_size:(i+1)*self.batch_size])
+
+        x = np.expand_dims(self.dataset[self.indexes[batch]].astype(np.float32), axis=-1)
+        y = np.eye(self.n_classes, dtype=np.float32)[self.labels[batch]]
+
+        return x, y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+
+    def __iter__(self):
+        for i in range(0, len(self)):
+            yield self[i]
+
+
+"""
+    batches of (segments, one-hot labels) over the given segments of the dataset (all of them by default), with the same
+    format as flow_from_directory(color_mode='grayscale', class_mode='categorical'): float32 (batch, height, width, 1)
+    labels: class of every segment, by default the labels of the dataset
+    it has the same interface as keras.utils.Sequence, use training_batches() to pass it to model.fit
+"""
+
+
+def training_batches(batches):
+    while True:
+        for batch in batches:
+            yield batch
+        batches.on_epoch_end()
+
+
+"""
+    repeats the batches forever, shuffling them at every epoch
+    use with model.fit(training_batches(batches), steps_per_epoch=len(batches))
+"""
+
+
+def pack_segments(in_path, out_path, shard_size=SHARD_SIZE, overwrite=False):
+    import cv2 as cv
+
+    if not in_path.endswith("/"):
+        in_path = in_path + "/"
+
+    # one subfolder per label, as read by flow_from_directory
+    labels = sorted(label for label in os.listdir(in_path) if os.path.isdir(in_path + label))
+    writer = ShardWriter(out_path, labels, shard_size, overwrite=overwrite)
+
+    for label in labels:
+        for filename in sorted(os.listdir(in_path + label)):
+            if not filename.endswith(".png"):
+                continue
+
+            # segments are named [label]_[source]_[index].png, as saved by segment.py
+            source = filename[0:-4].rsplit("_", 1)[0]
+            if source.startswith(label + "_"):
+                source = source[len(label) + 1:]
+            segment = cv.imread(in_path + label + "/" + filename, cv.IMREAD_GRAYSCALE)
+            if segment is None or segment.shape != writer.segment_shape:
+                print(f"{in_path + label}/{filename} is not a {writer.segment_shape[0]}x"
+                      f"{writer.segment_shape[1]} segment. Skipping to next one..")
+                continue
+            writer.add([segment], label, source)
+
+    return writer.close()
+
+
+"""
+    packs a folder of .png segments, with a subfolder per label (e.g. the output of segment.py), into shards
+    the images that can't be read or that are not 128x256 are skipped
+    overwrite: empty out_path if it has files, otherwise it must be empty or not exist
+    returns the number of segments packed
+"""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Pack a folder of .png segments, with a subfolder for each label, into memory-mappable shards
+        that can be read without decoding images.""")
+
+    # required argument: folder of segments
+    parser.add_argument('-i', '--input', type=str,
+                        help="Folder containing a subfolder of .png segments for each label, e.g. c/ and w/")
+
+    # required argument: output folder
+    parser.add_argument('-o', '--output', type=str,
+                        help="""Folder in which to save the shards. It must be empty or not exist, unless
+                        --overwrite is given""")
+
+    # optional arguments: replace the content of the output folder
+    parser.add_argument('--overwrite', action='store_true',
+                        help="Empty the output folder first if it already has files in it")
+
+    # optional arguments: segments per shard
+    parser.add_argument('-n', '--shard-size', nargs='?', type=int, default=SHARD_SIZE,
+                        help=f"How many segments to save in each shard. Default is {SHARD_SIZE}.")
+
+    args = parser.parse_args()
+
+    if args.input is None or not os.path.isdir(args.input):
+        print(f"{args.input} is not a folder. Exiting program.")
+        sys.exit(1)
+
+    if args.output is None:
+        print("No output folder given, see dataset.py -h for help. Exiting program.")
+        sys.exit(1)
+
+    if os.path.isdir(args.output) and len(os.listdir(args.output)) > 0 and not args.overwrite:
+        print(f"{args.output} is not empty, use --overwrite to replace its content. Exiting program.")
+        sys.exit(1)
+
+    n_segments = pack_segments(args.input, args.output, args.shard_size, args.overwrite)
+    print(f"Packed {n_segments} segments in {args.output}")
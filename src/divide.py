@@ -1,16 +1,43 @@
 import os
 import sys
-import numpy as np
 import argparse
-import subprocess
-import librosa
-import cv2 as cv
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 import utils
+import profiling
 import vision
 
 
-def divide_spec(spec, scale, out_path):
+# height of the vertical structuring element used to highlight the split, for each scale
+# this is probably useless as a v_size of 20 likely works for every scale, will remove
+v_size = {
+    'log': 10,
+    'mel': 20,
+    'lin': 20,
+}
+
+
+def find_middle(img, scale):
+    with profiling.stage("split detection"):
+        thresholded = vision.highlight_split(
+            img=img, low_thresh=15, high_thresh=255, h_size=3, v_size=v_size[scale])
+
+        img_splits = vision.find_splits(thresholded)
+    if len(img_splits) == 0:
+        return None
+
+    return img_splits[0]
+
+
+"""
+    takes in input a spectrogram (grayscale or not)
+    returns the x coordinates of the start and the end of the speed transition, None if none was found
+"""
+
+
+def output_folders(out_path):
     if not out_path.endswith("/"):
         out_path = out_path + "/"
     c_path = out_path + "c/"
@@ -20,26 +47,31 @@ def divide_spec(spec, scale, out_path):
         utils.create_folder(c_path)
         utils.create_folder(w_path)
 
+    return c_path, w_path
+
+
+"""
+    creates the folders for the parts before (c/) and after (w/) the speed transition, if they don't exist
+"""
+
+
+def divide_spec(spec, scale, out_path):
+    import cv2 as cv
+
+    c_path, w_path = output_folders(out_path)
+
     # create spectrogram's filenames
     out_name = spec.split("/")[-1]
 
-    # this is probably useless as a v_size of 20 likely works for every scale, will remove
-    v_size = {
-        'log': 10,
-        'mel': 20,
-        'lin': 20,
-    }
-
-    # read image and highlight split
+    # read image and find the split
     print(spec)
-    img = cv.imread(spec)
-    thresholded = vision.highlight_split(
-        img=img, low_thresh=15, high_thresh=255, h_size=3, v_size=v_size[scale])
+    with profiling.stage("png decode"):
+        img = cv.imread(spec)
 
-    img_splits = vision.find_splits(thresholded)
-    if len(img_splits) != 0:
+    middle = find_middle(img, scale)
+    if middle is not None:
         vision.divide_half(img=img, filename=out_name,
-                           middle=img_splits[0], left_path=c_path, right_path=w_path)
+                           middle=middle, left_path=c_path, right_path=w_path)
 
     return
 
@@ -58,12 +90,21 @@ if __name__ == "__main__":
                         help="""Path in which to store the output. If it doesn't exist, it
                         will be created""")
 
+    # optional arguments: number of processes
+    parser.add_argument('-p', '--processes', nargs='?', type=int, default=None,
+                        help="How many spectrograms to divide in parallel. Default is the number of CPUs")
+
     # TODO: scale argument is probably useless, will remove
     # required argument: scale
     parser.add_argument('-s', '--scale', type=str,
                         help="""What scale is used on the y-axis of the spectrogram(s).
                         Possible options are 'log', 'mel' or 'lin'""")
 
+    # optional arguments: profiling
+    parser.add_argument('--profile', nargs='?', type=str, default=None, const="profile.json",
+                        help="""Measure the time, the number of calls and the peak memory of each stage, and save the
+                        report in the given .json file. Default is profile.json""")
+
     args = parser.parse_args()
 
     in_path = args.input
@@ -76,6 +117,9 @@ if __name__ == "__main__":
             f"{scale} is not a valid scale option, see divide.py -h for help. Exiting program")
         sys.exit(1)
 
+    if args.profile is not None:
+        profiling.enable()
+
     if in_path.endswith(".png"):
         divide_spec(spec=in_path, scale=scale, out_path=out_path)
 
@@ -86,9 +130,22 @@ if __name__ == "__main__":
             print(f"{in_path} doesn't contain any .png images. Exiting program.")
             sys.exit(1)
 
-        for spec in spec_list:
-            divide_spec(spec=spec, scale=scale, out_path=out_path)
+        # create the output folders before starting the workers, so that they don't race to create them
+        output_folders(out_path)
+
+        processes = args.processes if args.processes is not None else os.cpu_count()
+        if processes > 1:
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                chunksize = max(1, len(spec_list) // (4*processes))
+                list(profiling.profiled_map(functools.partial(pool.map, chunksize=chunksize), divide_spec,
+                                            spec_list, repeat(scale), repeat(out_path)))
+        else:
+            for spec in spec_list:
+                divide_spec(spec=spec, scale=scale, out_path=out_path)
 
     else:
         print(f"{in_path} is neither a .png file, nor a folder.")
         sys.exit(1)
+
+    if args.profile is not None:
+        profiling.save(args.profile)
@@ -0,0 +1,339 @@
+import os
+import sys
+import json
+import time
+import argparse
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+from dataset import ManifestSegments, SegmentDataset, speedup_classes, speedup_patterns
+from inference import backends, load_model, warm_up
+
+
+def load_test_set(in_path, indexes_path=None):
+    # packed dataset, all of its segments or those of a split saved by split.py
+    if os.path.isfile(os.path.join(in_path, "index.json")):
+        dataset = SegmentDataset(in_path)
+        indexes = np.arange(len(dataset)) if indexes_path is None else np.sort(
+            np.load(indexes_path))
+        return dataset, indexes
+
+    # split manifest, or folder with a subfolder of .png segments for each label
+    dataset = ManifestSegments(in_path)
+
+    return dataset, np.arange(len(dataset))
+
+
+"""
+    in_path: folder with a subfolder of .png segments for each label, split manifest (.txt) written
+    by split.py, or folder of shards written by dataset.py or extract.py --shards
+    indexes_path: for a packed dataset, .npy file with the indexes of the segments
+    to use (e.g. test.npy from split.py)
+    returns the dataset and the indexes of its segments to evaluate
+"""
+
+
+def output_sizes(model):
+    outputs = model.predict_on_batch(np.zeros((1, 128, 256, 1), dtype=np.float32))
+    if not isinstance(outputs, (list, tuple)):
+        outputs = [outputs]
+
+    return [np.asarray(output).shape[-1] for output in outputs]
+
+
+def test_classes(dataset, indexes, n_classes):
+    # segments labelled with their speedup: the classes of the
+    # 4-class models, even if some are missing
+    speedups = sorted(set(speedup_patterns.values()))
+    if set(dataset.labels) <= set(speedups):
+        if n_classes != len(speedups):
+            return None
+        classes = np.array([speedups.index(label) for label in dataset.labels])[
+            dataset.segment_labels[indexes]]
+        return indexes, classes, speedups
+
+    if n_classes == len(dataset.labels):
+        return indexes, dataset.segment_labels[indexes], dataset.labels
+
+    # 4-class model on a binary dataset: the class of the 'w' segments
+    # comes from the name of their sample
+    if n_classes == 4 and "w" in dataset.labels:
+        speedup_indexes, classes, class_names = speedup_classes(dataset)
+        selected = np.isin(speedup_indexes, indexes)
+
+        return speedup_indexes[selected], classes[selected], class_names
+
+    return None
+
+
+"""
+    returns the indexes of the segments to evaluate a model with n_classes outputs on, their class
+    and the names of the classes, or None if the model doesn't fit the dataset
+"""
+
+
+def select_output(model, dataset, indexes):
+    sizes = output_sizes(model)
+
+    # fused models have a binary and a 4-class output, prefer the one with as many
+    # classes as the labels of the dataset
+    for output in sorted(range(0, len(sizes)), key=lambda k: sizes[k] != len(dataset.labels)):
+        selected = test_classes(dataset, indexes, sizes[output])
+        if selected is not None:
+            return (output,) + selected
+
+    return None
+
+
+"""
+    returns the output of the model to evaluate on the dataset, with the indexes, classes and class
+    names returned by test_classes for it, or None if no output of the model fits the dataset
+"""
+
+
+def load_batches(dataset, indexes, batch_size, threads, prefetch=2):
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = collections.deque()
+
+        def submit(start):
+            # every thread decodes a part of the batch
+            parts = np.array_split(indexes[start:start+batch_size], min(threads, batch_size))
+            pending.append([pool.submit(dataset.__getitem__, part)
+                            for part in parts if len(part) > 0])
+
+        starts = iter(range(0, len(indexes), batch_size))
+        for start in starts:
+            submit(start)
+            if len(pending) > prefetch:
+                break
+
+        while len(pending) > 0:
+            parts = pending.popleft()
+            batch = np.concatenate([part.result() for part in parts], axis=0)
+
+            # keep decoding the next batches while the model runs on this one
+            for start in starts:
+                submit(start)
+                break
+
+            yield batch
+
+
+"""
+    yields the segments with the given indexes, batch_size at a time, as uint8
+    arrays of shape (batch, height, width)
+    the batches are decoded by a pool of threads (OpenCV releases the GIL),
+    prefetch batches ahead of the model
+"""
+
+
+def evaluate_model(model, dataset, indexes, output=0, batch_size=256, threads=None):
+    if threads is None:
+        threads = os.cpu_count()
+
+    warm_up(model, min(batch_size, len(indexes)))
+
+    predictions = []
+    latencies = []
+
+    start = time.perf_counter()
+    for batch in load_batches(dataset, indexes, batch_size, threads):
+        batch = np.expand_dims(batch.astype(np.float32), axis=-1)
+
+        batch_start = time.perf_counter()
+        outputs = model.predict_on_batch(batch)
+        latencies.append(time.perf_counter() - batch_start)
+
+        if isinstance(outputs, (list, tuple)):
+            outputs = outputs[output]
+        predictions.append(np.argmax(np.asarray(outputs), axis=-1))
+    elapsed = time.perf_counter() - start
+
+    predictions = np.concatenate(predictions + [np.empty(0, dtype=np.int64)])
+    latencies = np.array(latencies) * 1000
+
+    return predictions, {
+        "images_per_second": round(len(indexes) / elapsed, 1),
+        "inference_images_per_second": round(len(indexes) / (np.sum(latencies) / 1000), 1),
+        "batch_latency_ms": {
+            "p50": round(float(np.percentile(latencies, 50)), 3),
+            "p90": round(float(np.percentile(latencies, 90)), 3),
+            "p99": round(float(np.percentile(latencies, 99)), 3),
+            "max": round(float(np.max(latencies)), 3)
+        }
+    }
+
+
+"""
+    runs the model over the segments with the given indexes of the dataset, batch_size at a time
+    output: which output of the model to use, for models with several outputs (see fuse.py)
+    returns the predicted class of every segment and the throughput: images per second overall
+    (decoding included) and of the model alone, and the percentiles of the latency of a batch
+"""
+
+
+def accuracy_report(classes, predictions, class_names):
+    n_classes = len(class_names)
+    matrix = np.bincount(classes.astype(np.int64)*n_classes + predictions,
+                         minlength=n_classes*n_classes).reshape(n_classes, n_classes)
+
+    per_class = {}
+    for k, name in enumerate(class_names):
+        predicted, actual = matrix[:, k].sum(), matrix[k, :].sum()
+        per_class[name] = {
+            "precision": round(matrix[k, k] / predicted, 3) if predicted > 0 else None,
+            "recall": round(matrix[k, k] / actual, 3) if actual > 0 else None,
+            "support": int(actual)
+        }
+
+    return {
+        "segments": len(classes),
+        "accuracy": round(float(np.mean(classes == predictions)), 4) if len(classes) > 0 else None,
+        "classes": class_names,
+        "confusion_matrix": matrix.tolist(),
+        "per_class": per_class
+    }
+
+
+"""
+    returns the accuracy, the confusion matrix (rows are the actual classes, columns the predicted
+    ones) and the precision and recall of every class
+"""
+
+
+def print_report(result):
+    print(f"{result['model']} ({result['backend']}): accuracy {result['accuracy']*100:.2f}% "
+          f"on {result['segments']} segments")
+
+    # confusion matrix, rows are the actual classes
+    width = max(8, max(len(name) for name in result["classes"]) + 1)
+    print("    confusion matrix (rows: actual, columns: predicted):")
+    print("    " + " "*width + "".join(name.rjust(width) for name in result["classes"]))
+    for name, row in zip(result["classes"], result["confusion_matrix"]):
+        print("    " + name.ljust(width) + "".join(str(count).rjust(width) for count in row))
+
+    for name, stats in result["per_class"].items():
+        print(f"    {name}: precision {stats['precision']}, recall {stats['recall']}, "
+              f"{stats['support']} segments")
+
+    latency = result["batch_latency_ms"]
+    print(f"    {result['images_per_second']} images/s "
+          f"({result['inference_images_per_second']} images/s in the model), "
+          f"batch latency p50 {latency['p50']}ms, p90 {latency['p90']}ms, p99 {latency['p99']}ms")
+
+
+if __name__ == "__main__":
+    script_path = utils.get_script_path()
+    models_path = os.path.dirname(script_path) + "/models/"
+
+    parser = argparse.ArgumentParser(
+        description="""Evaluate one or more classifiers on a test set, in large batches: accuracy,
+        confusion matrix, throughput and latency.""")
+
+    # required argument: test set
+    parser.add_argument('-i', '--input', type=str,
+                        help="""Test set: a folder with a subfolder of .png segments for
+                        each label (as read by flow_from_directory), a split manifest
+                        (.txt) written by split.py, or a folder of shards written by
+                        dataset.py or extract.py --shards""")
+
+    # required argument: models
+    parser.add_argument('-m', '--models', nargs='+', type=str,
+                        help="""Models to evaluate: paths of SavedModel folders, or their names
+                        in models/ (e.g. model-binary-lin). A 4-class model evaluated on a
+                        dataset of 'c' and 'w' segments is tested on the 'w' segments, with the
+                        speedup given by the name of their sample.""")
+
+    # optional arguments: indexes of the test set
+    parser.add_argument('--indexes', type=str, default=None,
+                        help="""For a folder of shards, .npy file with the indexes of the segments
+                        to use, e.g. test.npy from split.py.""")
+
+    # optional arguments: inference backends
+    parser.add_argument('--backend', nargs='+', type=str, default=['keras'],
+                        help="""Runtimes with which to run every model: 'keras', 'tflite', 'onnx'
+                        and/or 'tflite-int8'. The models must be exported with export.py first
+                        for 'tflite' and 'onnx', and quantized with quantize.py for
+                        'tflite-int8'. Default is 'keras'.""")
+
+    # optional arguments: batch size
+    parser.add_argument('-b', '--batch', nargs='?', type=int, default=256,
+                        help="""How many segments to classify in a single
+                        call to the model. Default is 256.""")
+
+    # optional arguments: decoding threads
+    parser.add_argument('-t', '--threads', nargs='?', type=int, default=None,
+                        help="How many threads decode the segments. Default is the number of CPUs.")
+
+    # optional arguments: json report
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help="Path of a .json file in which to save the results.")
+
+    args = parser.parse_args()
+
+    if args.input is None or not os.path.exists(args.input):
+        print(f"{args.input} is not a folder or a manifest. See evaluate.py -h for information.")
+        sys.exit(1)
+
+    if args.models is None:
+        print("No model given. See evaluate.py -h for information.")
+        sys.exit(1)
+
+    if any(backend not in backends for backend in args.backend):
+        print(f"{' '.join(args.backend)} is not a valid list of backends. "
+              f"See evaluate.py -h for information.")
+        sys.exit(1)
+
+    if args.indexes is not None and not os.path.isfile(args.indexes):
+        print(f"{args.indexes} doesn't exist. Exiting program.")
+        sys.exit(1)
+
+    dataset, indexes = load_test_set(args.input, args.indexes)
+    if len(indexes) == 0:
+        print(f"{args.input} doesn't contain any segments. Exiting program.")
+        sys.exit(1)
+    print(f"Test set: {len(indexes)} segments, labels {', '.join(dataset.labels)}")
+
+    results = []
+    for model_path in args.models:
+        # names of the models in models/ can be given without the path
+        if not os.path.exists(model_path) and os.path.exists(models_path + model_path):
+            model_path = models_path + model_path
+        if not model_path.endswith("/") and os.path.isdir(model_path):
+            model_path = model_path + "/"
+
+        for backend in args.backend:
+            try:
+                model = load_model(model_path, backend)
+            except (ImportError, OSError, ValueError) as e:
+                print(f"Couldn't load {model_path} with {backend}: {e}. Skipping to next one..")
+                continue
+
+            selected = select_output(model, dataset, indexes)
+            if selected is None:
+                print(f"The outputs of {model_path} don't match the labels of the test set. "
+                      f"Skipping to next one..")
+                continue
+            output, test_indexes, classes, class_names = selected
+            if len(test_indexes) == 0:
+                print(f"The test set has no segments for the classes of {model_path}. "
+                      f"Skipping to next one..")
+                continue
+
+            predictions, throughput = evaluate_model(
+                model, dataset, test_indexes, output, args.batch, args.threads)
+
+            result = dict({"model": model_path, "backend": backend},
+                          **accuracy_report(classes, predictions, class_names), **throughput)
+            print_report(result)
+            results.append(result)
+
+    if args.output is not None:
+        with open(args.output, 'w') as out_file:
+            json.dump(results, out_file, indent=4)
+        print(f"Saved results in {args.output}")
+
+    if len(results) == 0:
+        sys.exit(1)
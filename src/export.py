@@ -0,0 +1,166 @@
+import os
+import sys
+import numpy as np
+import argparse
+
+import utils
+from inference import (backend_path, fused_model_path, load_model, model_paths, ordered_outputs, predict_batched,
+                       scales)
+
+
+def export_model(model_path, backend):
+    import tensorflow as tf
+
+    out_name = backend_path(model_path, backend)
+
+    if backend == 'tflite':
+        converter = tf.lite.TFLiteConverter.from_saved_model(model_path)
+        with open(out_name, 'wb') as out_file:
+            out_file.write(converter.convert())
+
+    elif backend == 'onnx':
+        import tf2onnx
+
+        model = tf.keras.models.load_model(model_path)
+        input_signature = (tf.TensorSpec(
+            (None, 128, 256, 1), tf.float32, name="window"),)
+        tf2onnx.convert.from_keras(
+            model, input_signature=input_signature, output_path=out_name)
+
+    print(f"Exported {model_path} to {out_name}")
+
+    return out_name
+
+
+"""
+    converts the keras SavedModel in model_path for the given backend ('tflite' or 'onnx')
+    the converted model is saved next to the SavedModel folder, see inference.backend_path
+"""
+
+
+def load_reference(path, n_windows):
+    import cv2 as cv
+
+    windows = []
+
+    for filename in sorted(utils.collect_png_files(path)):
+        window = cv.imread(filename, cv.IMREAD_GRAYSCALE)
+        if window is not None and window.shape == (128, 256):
+            windows.append(window)
+        if len(windows) == n_windows:
+            break
+
+    return np.stack(windows) if len(windows) > 0 else np.empty((0, 128, 256), dtype=np.uint8)
+
+
+"""
+    reads up to n_windows 128x256 segments (e.g. the output of segment.py) from the .png files in path
+"""
+
+
+def output_labels(model, windows, batch_size):
+    outputs = ordered_outputs(predict_batched(model, windows, batch_size))
+
+    return [np.argmax(output, axis=-1) for output in outputs]
+
+
+def check_parity(model_path, backend, windows, batch_size=256):
+    reference_labels = output_labels(
+        load_model(model_path, 'keras'), windows, batch_size)
+    labels = output_labels(load_model(
+        model_path, backend), windows, batch_size)
+
+    # a window agrees only if every output of the model gives the same label
+    agree = np.ones(len(windows), dtype=bool)
+    for reference, label in zip(reference_labels, labels):
+        agree &= reference == label
+
+    return np.mean(agree)
+
+
+"""
+    returns the fraction of windows for which the model exported for backend gives the same label as keras
+"""
+
+
+if __name__ == "__main__":
+    script_path = utils.get_script_path()
+    models_path = os.path.dirname(script_path) + "/models/"
+
+    parser = argparse.ArgumentParser(
+        description="""Convert the keras classifiers in models/ to a lightweight runtime format, and
+        check that the converted models give the same labels as keras.""")
+
+    # required argument: format(s) to export to
+    parser.add_argument('-f', '--format', type=str, nargs='+', default=['tflite'],
+                        help="Format(s) to export the models to: 'tflite' and/or 'onnx'. Default is 'tflite'.")
+
+    # optional argument: folder containing the models
+    parser.add_argument('-m', '--models', type=str, default=models_path,
+                        help="Folder containing the SavedModel folders. Default is the models/ folder of the project.")
+
+    # optional argument: reference set for the parity check
+    parser.add_argument('-c', '--check', type=str, default=None,
+                        help="""Folder containing .png segments (128x256) used to check that the exported models
+                        give the same labels as keras. If not set, the check is skipped.""")
+
+    # optional argument: how many segments of the reference set to use
+    parser.add_argument('-n', '--number', nargs='?', type=int, default=1000,
+                        help="How many segments of the reference set to use for the check. Default is 1000.")
+
+    # optional argument: minimum agreement for the check to pass
+    parser.add_argument('--min-agreement', nargs='?', type=float, default=1.0,
+                        help="Minimum fraction of labels that must match keras for the check to pass. Default is 1.0.")
+
+    # optional argument: export the fused models too
+    parser.add_argument('--fused', action='store_true',
+                        help="""Also export the models that fuse the two classifiers of each scale, created with
+                        fuse.py.""")
+
+    args = parser.parse_args()
+
+    formats = args.format
+    models_path = args.models
+    if not models_path.endswith("/"):
+        models_path = models_path + "/"
+
+    for backend in formats:
+        if backend not in ['tflite', 'onnx']:
+            print(f"{backend} is not a valid format, see export.py -h for help. Exiting program")
+            sys.exit(1)
+
+    model_list = [path for scale in scales for path in model_paths(
+        models_path, scale)]
+    if args.fused:
+        model_list += [fused_model_path(models_path, scale)
+                       for scale in scales]
+    for model_path in model_list:
+        if not os.path.isdir(model_path):
+            print(f"{model_path} doesn't exist. Exiting program.")
+            sys.exit(1)
+
+    for model_path in model_list:
+        for backend in formats:
+            export_model(model_path, backend)
+
+    if args.check is None:
+        sys.exit(0)
+
+    windows = load_reference(args.check, args.number)
+    if len(windows) == 0:
+        print(f"{args.check} doesn't contain any 128x256 .png segments. Exiting program.")
+        sys.exit(1)
+
+    # compare the labels of every exported model with the ones given by keras
+    passed = True
+    for model_path in model_list:
+        for backend in formats:
+            agreement = check_parity(model_path, backend, windows)
+            print(
+                f"{backend_path(model_path, backend)}: {agreement*100:.2f}% of {len(windows)} labels match keras")
+            if agreement < args.min_agreement:
+                passed = False
+
+    if not passed:
+        print("Parity check failed.")
+        sys.exit(1)
@@ -0,0 +1,272 @@
+import os
+import sys
+import shutil
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import utils
+import profiling
+import vision
+from dataset import SHARD_SIZE, ShardWriter
+from divide import find_middle, output_folders
+from spectrogram import engines
+from wav2spec import wav2spec
+
+
+def extract_segments(sample, scale, width_res=256, step=64, window_width=256, dump_path=None,
+                     engine='sox'):
+    # the spectrogram and the halfs only go to disk for debugging
+    dump = dump_path is not None
+    if not dump:
+        dump_path = ""
+
+    img = wav2spec(sample=sample, scale=scale, out_path=dump_path + "spectrograms/",
+                   width_res=width_res, save=dump, engine=engine)
+    if img is None:
+        return None
+
+    middle = find_middle(img, scale)
+    if middle is None:
+        print(f"no speed transition found in {sample}. Skipping to next one..")
+        return None
+
+    # same names as wav2spec.py, divide.py and segment.py run one after the other
+    name = sample.split("/")[-1].split(".")[0]
+    halves = vision.divide_half(img=img, filename=name + ".png", middle=middle,
+                                left_path=dump_path + "halves/c/", right_path=dump_path + "halves/w/", save=dump)
+
+    segments = {}
+    for half, label in zip(halves, ["c", "w"]):
+        segments[label] = vision.segment(
+            half, step, window_width, multiple=True, offset=128)
+
+    return name, segments
+
+
+"""
+    computes the spectrogram of the sample and divides it at the speed transition, keeping everything in memory
+    dump_path: if set, also save the spectrogram in dump_path/spectrograms/ and the halfs in dump_path/halves/
+    engine: 'sox' or 'numpy', what computes the 'lin' and 'log' spectrograms
+    returns the name of the sample and the segments of the two halfs ('c' and 'w'), None if the sample is skipped
+"""
+
+
+def extract_sample(sample, scale, out_path, width_res=256, step=64, window_width=256, dump_path=None,
+                   engine='sox'):
+    extracted = extract_segments(
+        sample, scale, width_res, step, window_width, dump_path, engine)
+    if extracted is None:
+        return 0
+
+    name, segments = extracted
+    for label, seg_list in segments.items():
+        vision.write_segments(seg_list, out_path + label +
+                              "/", label + "_" + name)
+
+    n_segments = sum(len(seg_list) for seg_list in segments.values())
+    print(f"{sample}: {n_segments} segments")
+
+    return n_segments
+
+
+"""
+    saves the segments of the two halfs of the sample in out_path/c/ and out_path/w/
+    returns the number of segments saved
+"""
+
+
+def extract_shard_segments(sample, scale, out_path, width_res=256, step=64, window_width=256, dump_path=None,
+                           engine='sox'):
+    extracted = extract_segments(
+        sample, scale, width_res, step, window_width, dump_path, engine)
+    if extracted is None:
+        return None
+
+    # the segments are views over the spectrogram, copy them to send them back to the main process
+    name, segments = extracted
+    return name, {label: np.array(seg_list) for label, seg_list in segments.items()}
+
+
+"""
+    same as extract_segments, run in the worker processes when the segments are saved in shards by the main process
+    out_path is not used, it is there to take the same arguments as extract_sample
+"""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Extract the dataset from the audio samples in a single pass: compute the spectrogram of each
+        sample, divide it at the speed transition and segment the two halfs, without saving the intermediate images.""")
+
+    # required argument: audio sample(s)
+    parser.add_argument('-i', '--input', type=str,
+                        help="""Path to the audio sample(s), with the channels already separated. It can be a
+                        single file, a folder, or a .txt manifest listing one sample per line""")
+
+    # required argument: output folder
+    parser.add_argument('-o', '--output', type=str,
+                        help="""Path in which to store the segments, in the subfolders c/ and w/. If it doesn't
+                        exist, it will be created""")
+
+    # required argument: scale
+    parser.add_argument('-s', '--scale', type=str,
+                        help="""What scale to use on the y-axis of the spectrogram.
+                        possible options are 'log', 'mel' or 'lin'""")
+
+    # optional arguments: resolution of x-axis (pixels per second)
+    parser.add_argument('-w', '--width', nargs='?', type=int, default=256,
+                        help="What resolution to use on the x-axis, in pixels/s. Default is 256.")
+
+    # optional arguments: spectrogram engine
+    parser.add_argument('--engine', type=str, default='sox',
+                        help="""What computes the 'lin' and 'log' spectrograms: 'sox' (sox-extended, which
+                        the existing models were trained on) or 'numpy' (in-process, check it with parity.py
+                        first). Default is 'sox'.""")
+
+    # optional arguments: width of each segment
+    parser.add_argument('--segment-width', nargs='?', type=int, default=256,
+                        help="How wide each segment should be. Default is 256 pixels.")
+
+    # optional arguments: step
+    parser.add_argument('-j', '--jump', nargs='?', type=int, default=64,
+                        help="Step to use for the scanning of the spectrum. Default is 64 pixels.")
+
+    # optional arguments: number of processes
+    parser.add_argument('-p', '--processes', nargs='?', type=int, default=None,
+                        help="How many samples to process in parallel. Default is the number of CPUs")
+
+    # optional arguments: save the intermediate images
+    parser.add_argument('--dump', action='store_true',
+                        help="""Also save the spectrograms and the two halfs of each one, as wav2spec.py and
+                        divide.py would, for debugging. They are saved outside of the output folder, so that
+                        they are not taken for labels""")
+
+    # optional arguments: folder of the intermediate images
+    parser.add_argument('--dump-dir', type=str, default=None,
+                        help="""Folder in which --dump saves the spectrograms (spectrograms/) and the halfs
+                        (halves/). Default is the output folder with '_dump' appended, next to it""")
+
+    # optional arguments: save the segments in shards
+    parser.add_argument('--shards', action='store_true',
+                        help="""Save the segments in memory-mappable .npy shards (see dataset.py) instead of .png
+                        files, labeled 'c' and 'w'. The output folder then holds only the shards: it must be
+                        empty or not exist, unless --overwrite is given.""")
+
+    # optional arguments: segments per shard
+    parser.add_argument('--shard-size', nargs='?', type=int, default=SHARD_SIZE,
+                        help=f"How many segments to save in each shard. Default is {SHARD_SIZE}.")
+
+    # optional arguments: replace the shards of a previous run
+    parser.add_argument('--overwrite', action='store_true',
+                        help="With --shards, empty the output folder first if it already has files in it")
+
+    # optional arguments: profiling
+    parser.add_argument('--profile', nargs='?', type=str, default=None, const="profile.json",
+                        help="""Measure the time, the number of calls and the peak memory of each stage, and save the
+                        report in the given .json file. Default is profile.json""")
+
+    args = parser.parse_args()
+
+    in_path = args.input
+    out_path = args.output
+    scale = args.scale
+
+    if in_path is None or out_path is None:
+        print("Input and output are required, see extract.py -h for help. Exiting program")
+        sys.exit(1)
+
+    # check validity of scale parameter
+    if scale not in ["log", "mel", "lin"]:
+        print(
+            f"{scale} is not a valid scale option, see extract.py -h for help. Exiting program")
+        sys.exit(1)
+
+    if args.engine not in engines:
+        print(f"{args.engine} is not a valid engine. See extract.py -h for information.")
+        sys.exit(1)
+
+    if args.engine == 'sox' and scale != "mel" and shutil.which('sox') is None:
+        print("sox is not on the PATH, use --engine numpy or install sox-extended. Exiting program.")
+        sys.exit(1)
+
+    if in_path.endswith(".wav"):
+        sample_list = [in_path]
+    elif os.path.isdir(in_path):
+        sample_list = sorted(utils.collect_audio_files(in_path))
+    elif in_path.endswith(".txt"):
+        sample_list = utils.read_manifest(in_path)
+    else:
+        print(f"{in_path} is neither a .wav file, a folder, nor a .txt manifest.")
+        sys.exit(1)
+
+    if len(sample_list) == 0:
+        print(f"{in_path} doesn't contain any .wav samples. Exiting program.")
+        sys.exit(1)
+
+    if not out_path.endswith("/"):
+        out_path = out_path + "/"
+
+    # the dumps go next to the output folder: split.py and dataset.py take every subfolder of it for a label
+    dump_path = None
+    if args.dump:
+        dump_path = args.dump_dir if args.dump_dir is not None else out_path[:-1] + "_dump"
+        if not dump_path.endswith("/"):
+            dump_path = dump_path + "/"
+        if os.path.commonpath([os.path.abspath(dump_path), os.path.abspath(out_path)]) == os.path.abspath(out_path):
+            print(f"{dump_path} is inside the output folder, give --dump-dir a folder outside of it. "
+                  "Exiting program.")
+            sys.exit(1)
+
+    # the workers send their segments back to the writer of the shards, or save them in the label folders:
+    # those are created here, as the folders of the dumps, so that the workers don't race to create them.
+    # The writer only empties the output folder when asked to
+    if args.shards:
+        if os.path.isdir(out_path) and len(os.listdir(out_path)) > 0 and not args.overwrite:
+            print(f"{out_path} is not empty, use --overwrite to replace its content. Exiting program.")
+            sys.exit(1)
+        writer = ShardWriter(out_path, ["c", "w"], args.shard_size,
+                             segment_shape=(128, args.segment_width), overwrite=args.overwrite)
+    else:
+        output_folders(out_path)
+    if dump_path is not None:
+        if not os.path.isdir(dump_path + "spectrograms/"):
+            utils.create_folder(dump_path + "spectrograms/")
+        output_folders(dump_path + "halves/")
+
+    processes = args.processes if args.processes is not None else os.cpu_count()
+    arguments = (sample_list, repeat(scale), repeat(out_path), repeat(args.width), repeat(args.jump),
+                 repeat(args.segment_width), repeat(dump_path), repeat(args.engine))
+
+    if args.profile is not None:
+        profiling.enable()
+
+    pool = ProcessPoolExecutor(
+        max_workers=processes) if processes > 1 else None
+
+    def parallel_map(function, *iterables):
+        if pool is None:
+            return map(function, *iterables)
+        return profiling.profiled_map(pool.map, function, *iterables)
+
+    if args.shards:
+        # the workers only compute the segments, the main process writes them in order
+        for extracted in parallel_map(extract_shard_segments, *arguments):
+            if extracted is None:
+                continue
+            name, segments = extracted
+            for label, seg_list in segments.items():
+                writer.add(seg_list, label, name)
+            print(f"{name}: {sum(len(seg_list) for seg_list in segments.values())} segments")
+        n_segments = writer.close()
+    else:
+        n_segments = sum(parallel_map(extract_sample, *arguments))
+
+    if pool is not None:
+        pool.shutdown()
+
+    print(f"Extracted {n_segments} segments from {len(sample_list)} samples")
+
+    if args.profile is not None:
+        profiling.save(args.profile)
@@ -0,0 +1,67 @@
+import os
+import sys
+import argparse
+
+import utils
+from inference import fused_model_path, model_paths, scales
+
+
+def fuse_models(binary_model_path, four_classes_model_path, out_path):
+    import keras
+    from keras.models import load_model
+
+    binary_model = load_model(binary_model_path)
+    four_classes_model = load_model(four_classes_model_path)
+
+    # the two classifiers were trained separately and can have the same name, rename them
+    binary_model._name = "binary"
+    four_classes_model._name = "four_classes"
+
+    # both classifiers read the same input, their outputs are computed in a single graph
+    window = keras.Input(shape=(128, 256, 1), name="window")
+    fused_model = keras.Model(inputs=window, outputs=[binary_model(window), four_classes_model(window)],
+                              name="fused")
+    fused_model.save(out_path)
+    print(f"Saved fused model in {out_path}")
+
+    return fused_model
+
+
+"""
+    combines the binary and the 4-class classifier in a model with one input and two outputs, in this order:
+    the probabilities of the binary classifier and those of the 4-class classifier
+"""
+
+
+if __name__ == "__main__":
+    script_path = utils.get_script_path()
+    models_path = os.path.dirname(script_path) + "/models/"
+
+    parser = argparse.ArgumentParser(
+        description="""Fuse the binary and the 4-class classifier of each scale in a single model
+        with two outputs, so that both are computed in one forward pass.""")
+
+    # optional argument: scale(s) to fuse
+    parser.add_argument('-s', '--scale', type=str, nargs='+', default=scales,
+                        help="Scale(s) of the classifiers to fuse: 'log', 'mel' and/or 'lin'. Default is all of them.")
+
+    # optional argument: folder containing the models
+    parser.add_argument('-m', '--models', type=str, default=models_path,
+                        help="Folder containing the SavedModel folders. Default is the models/ folder of the project.")
+
+    args = parser.parse_args()
+
+    models_path = args.models
+    if not models_path.endswith("/"):
+        models_path = models_path + "/"
+
+    for scale in args.scale:
+        if scale not in scales:
+            print(f"{scale} is not a valid scale option, see fuse.py -h for help. Exiting program")
+            sys.exit(1)
+
+    for scale in args.scale:
+        binary_model_path, four_classes_model_path = model_paths(
+            models_path, scale)
+        fuse_models(binary_model_path, four_classes_model_path,
+                    fused_model_path(models_path, scale))
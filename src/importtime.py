@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import json
+import argparse
+import subprocess
+
+import utils
+
+
+# modules that must only be imported by the code paths that use them
+heavy_modules = ['cv2', 'librosa', 'scipy', 'skimage',
+                 'tensorflow', 'keras', 'tflite_runtime', 'onnxruntime']
+
+# command line scripts whose startup is measured
+scripts = ['main.py', 'server.py', 'wav2spec.py', 'divide.py',
+           'segment.py', 'splitchannels.py', 'export.py', 'fuse.py', 'extract.py', 'dataset.py', 'split.py',
+           'benchmark.py', 'evaluate.py', 'quantize.py', 'live.py', 'parity.py']
+
+
+def measure_startup(script, args=['-h']):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', script] + args,
+                            capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+
+    # lines look like "import time:   self [us] | cumulative | imported package", nested imports are indented
+    top_level = {}
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+
+        # keep the top-level modules only, the nested ones are included in their cumulative time
+        name = fields[2][1:]
+        if not name.startswith(" "):
+            top_level[name] = int(fields[1]) / 1e6
+        imported.add(name.strip().split(".")[0])
+
+    heavy = sorted(name for name in imported if name in heavy_modules)
+
+    return {
+        "script": os.path.basename(script),
+        "args": args,
+        "seconds": round(elapsed, 3),
+        "import_seconds": round(sum(top_level.values()), 3),
+        "slowest_imports": sorted(top_level.items(), key=lambda item: -item[1])[:5],
+        "heavy_imports": heavy
+    }
+
+
+"""
+    runs the script with the given arguments under 'python -X importtime'
+    returns the wall time, the time spent importing modules, the slowest top-level imports and the heavy
+    modules imported by the script
+"""
+
+
+if __name__ == "__main__":
+    script_path = utils.get_script_path()
+
+    parser = argparse.ArgumentParser(
+        description="""Measure how long the scripts take to start up (running them with -h), and check that
+        they don't import heavy dependencies at module load.""")
+
+    # optional argument: time budget
+    parser.add_argument('-b', '--budget', nargs='?', type=float, default=1.0,
+                        help="Maximum startup time of each script, in seconds. Default is 1.0s.")
+
+    # optional argument: json report
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help="Path of a .json file in which to save the report.")
+
+    args = parser.parse_args()
+
+    report = []
+    passed = True
+
+    for script in scripts:
+        entry = measure_startup(os.path.join(script_path, script))
+        report.append(entry)
+
+        status = "ok"
+        if entry["seconds"] > args.budget:
+            status = f"over budget ({args.budget}s)"
+            passed = False
+        if len(entry["heavy_imports"]) > 0:
+            status = f"imports {', '.join(entry['heavy_imports'])} at startup"
+            passed = False
+
+        slowest = ", ".join(
+            f"{name} {seconds:.3f}s" for name, seconds in entry["slowest_imports"])
+        print(f"{entry['script']}: {entry['seconds']}s, {entry['import_seconds']}s importing "
+              f"(slowest: {slowest}) - {status}")
+
+    if args.output is not None:
+        with open(args.output, 'w') as out_file:
+            json.dump(report, out_file, indent=4)
+
+    if not passed:
+        sys.exit(1)
@@ -0,0 +1,327 @@
+import queue
+import threading
+import time
+import numpy as np
+from concurrent.futures import Future
+
+import profiling
+
+
+# scales for which a pair of classifiers is available in models/
+scales = ['lin', 'log', 'mel']
+
+# runtimes that can execute the classifiers, see export.py for converting the models and quantize.py for the
+# int8 models
+backends = ['keras', 'tflite', 'onnx', 'tflite-int8']
+
+# extension of the file exported for each backend, next to the SavedModel folder
+backend_extensions = {
+    'tflite': ".tflite",
+    'onnx': ".onnx",
+    'tflite-int8': "-int8.tflite"
+}
+
+# speedup corresponding to the label output by the second classifier
+speedup_dict = {
+    0: "double",
+    1: "half",
+    2: "quadruple",
+    3: "quarter"
+}
+
+
+def model_paths(models_path, scale):
+    binary_model_path = models_path + "model-binary-" + scale + "/"
+    four_classes_model_path = models_path + "model-4c-" + scale + "/"
+
+    return binary_model_path, four_classes_model_path
+
+
+"""
+    returns the paths of the binary and of the 4-class classifier for the given scale
+"""
+
+
+def fused_model_path(models_path, scale):
+    return models_path + "model-fused-" + scale + "/"
+
+
+"""
+    returns the path of the model that fuses the two classifiers of the given scale, see fuse.py
+"""
+
+
+def backend_path(model_path, backend):
+    if backend == 'keras':
+        return model_path
+
+    return model_path.rstrip("/") + backend_extensions[backend]
+
+
+"""
+    returns the path of the model exported for the given backend, e.g. models/model-binary-lin.tflite, or
+    models/model-binary-lin-int8.tflite for the quantized one
+"""
+
+
+class TFLiteModel:
+    def __init__(self, path):
+        # prefer the standalone runtime, fall back to the interpreter bundled with tensorflow
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+
+        self.interpreter = Interpreter(model_path=path)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_indexes = [output['index']
+                               for output in self.interpreter.get_output_details()]
+        self.input_shape = None
+
+    def predict_on_batch(self, batch):
+        # the interpreter has static shapes, reallocate only when the batch size changes
+        if self.input_shape != batch.shape:
+            self.interpreter.resize_tensor_input(
+                self.input_index, batch.shape)
+            self.interpreter.allocate_tensors()
+            self.input_shape = batch.shape
+
+        self.interpreter.set_tensor(self.input_index, batch)
+        self.interpreter.invoke()
+
+        outputs = [self.interpreter.get_tensor(index)
+                   for index in self.output_indexes]
+
+        return outputs[0] if len(outputs) == 1 else outputs
+
+
+class ONNXModel:
+    def __init__(self, path):
+        import onnxruntime
+
+        self.session = onnxruntime.InferenceSession(
+            path, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict_on_batch(self, batch):
+        outputs = self.session.run(None, {self.input_name: batch})
+
+        return outputs[0] if len(outputs) == 1 else outputs
+
+
+def load_model(model_path, backend='keras'):
+    if backend in ['tflite', 'tflite-int8']:
+        return TFLiteModel(backend_path(model_path, backend))
+    if backend == 'onnx':
+        return ONNXModel(backend_path(model_path, backend))
+
+    import keras.models
+    return keras.models.load_model(model_path)
+
+
+"""
+    loads the classifier saved in model_path (SavedModel folder) with the given backend
+    every backend exposes predict_on_batch, taking and returning float32 arrays like the keras models
+    (a list of arrays for models with several outputs)
+"""
+
+
+def predict_batched(model, windows, batch_size=256):
+    n_windows = len(windows)
+    predictions = []
+
+    for start in range(0, n_windows, batch_size):
+        # add the channel axis expected by the models: (batch, height, width, 1)
+        with profiling.stage("window slicing"):
+            batch = np.expand_dims(np.asarray(
+                windows[start:start+batch_size], dtype=np.float32), axis=-1)
+
+        batch_start = time.perf_counter()
+        predictions.append(model.predict_on_batch(batch))
+        profiling.sample("batch latency", time.perf_counter() - batch_start)
+
+    if len(predictions) == 0:
+        return np.empty((0, 0), dtype=np.float32)
+
+    # models with several outputs return a list, concatenate each output separately
+    if isinstance(predictions[0], (list, tuple)):
+        return [np.concatenate([np.asarray(prediction[k]) for prediction in predictions], axis=0)
+                for k in range(0, len(predictions[0]))]
+
+    return np.concatenate([np.asarray(prediction) for prediction in predictions], axis=0)
+
+
+"""
+    runs the model over a stack of windows with shape (n_windows, height, width), batch_size windows at a time
+    returns the concatenated model outputs, one row per window (a list of them for models with several outputs)
+"""
+
+
+def warm_up(model, batch_size=1):
+    # the first call of a model is slower (graph tracing, memory allocation)
+    if hasattr(model, "classify"):
+        model.classify(np.zeros((batch_size, 128, 256), dtype=np.uint8))
+    else:
+        model.predict_on_batch(np.zeros((batch_size, 128, 256, 1), dtype=np.float32))
+
+
+"""
+    runs model on a batch of batch_size blank windows, to keep its first call out of the measures
+    model: a model loaded by load_model(), or a WindowClassifier or FusedClassifier
+"""
+
+
+class WindowClassifier:
+    def __init__(self, binary_model, four_classes_model, batch_size=256):
+        self.binary_model = binary_model
+        self.four_classes_model = four_classes_model
+        self.batch_size = batch_size
+
+    def classify(self, windows, return_scores=False):
+        if len(windows) == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return (empty, empty, np.empty(0, dtype=np.float32)) if return_scores else (empty, empty)
+
+        # first pass: every window goes through the binary classifier
+        with profiling.stage("binary inference"):
+            binary_output = predict_batched(
+                self.binary_model, windows, self.batch_size)
+        flagged = np.flatnonzero(np.argmax(binary_output, axis=-1) == 1)
+
+        # second pass: only the flagged windows go through the 4-class classifier
+        speedup_labels = np.empty(0, dtype=np.int64)
+        if len(flagged) > 0:
+            with profiling.stage("4-class inference"):
+                speedup_labels = np.argmax(predict_batched(
+                    self.four_classes_model, windows[flagged], self.batch_size), axis=-1)
+
+        if return_scores:
+            return flagged, speedup_labels, binary_output[:, 1]
+
+        return flagged, speedup_labels
+
+    def flag(self, windows):
+        # binary classifier only
+        with profiling.stage("binary inference"):
+            return np.argmax(predict_batched(self.binary_model, windows, self.batch_size), axis=-1) == 1
+
+
+"""
+    windows: numpy array of shape (n_windows, height, width)
+    returns the indexes of the windows flagged as irregular and the speedup label of each of them
+    flag() returns only whether each window is flagged as irregular
+    return_scores: also return the probability of being irregular given by the binary classifier to every window
+"""
+
+
+def ordered_outputs(outputs):
+    if not isinstance(outputs, (list, tuple)):
+        outputs = [outputs]
+
+    # the order of the outputs of a fused model depends on the backend, sort them by number of classes
+    return sorted(outputs, key=lambda output: output.shape[-1])
+
+
+"""
+    returns the outputs of a model (one array or a list of them) as a list sorted by number of classes: the
+    binary output of a fused model comes before the 4-class one, whatever the backend
+"""
+
+
+class FusedClassifier:
+    def __init__(self, fused_model, batch_size=256):
+        self.fused_model = fused_model
+        self.batch_size = batch_size
+
+    def classify(self, windows, return_scores=False):
+        if len(windows) == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return (empty, empty, np.empty(0, dtype=np.float32)) if return_scores else (empty, empty)
+
+        # single pass: every window gets both the binary and the 4-class output
+        with profiling.stage("fused inference"):
+            binary_output, four_classes_output = ordered_outputs(
+                predict_batched(self.fused_model, windows, self.batch_size))
+
+        flagged = np.flatnonzero(np.argmax(binary_output, axis=-1) == 1)
+        speedup_labels = np.argmax(four_classes_output[flagged], axis=-1)
+
+        if return_scores:
+            return flagged, speedup_labels, binary_output[:, 1]
+
+        return flagged, speedup_labels
+
+    def flag(self, windows):
+        # the fused model computes both outputs in the same pass, only the binary one is read
+        with profiling.stage("fused inference"):
+            binary_output = ordered_outputs(predict_batched(self.fused_model, windows, self.batch_size))[0]
+
+        return np.argmax(binary_output, axis=-1) == 1
+
+
+"""
+    same as WindowClassifier, with the two classifiers fused in a single model with two outputs (see fuse.py)
+    flag() costs as much as classify(): the 4-class head runs on every window even if only the binary output is
+    read
+"""
+
+
+class MicroBatcher:
+    def __init__(self, model, batch_size=256, max_wait=0.005):
+        self.model = model
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def predict_on_batch(self, batch):
+        future = Future()
+        self.requests.put((batch, future))
+
+        return future.result()
+
+    def run(self):
+        while True:
+            # wait for a first request, then gather more until the batch is full or max_wait has passed
+            pending = [self.requests.get()]
+            n_windows = len(pending[0][0])
+            deadline = time.monotonic() + self.max_wait
+
+            while n_windows < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                n_windows += len(pending[-1][0])
+
+            try:
+                outputs = self.model.predict_on_batch(
+                    np.concatenate([batch for batch, future in pending]))
+            except Exception as e:
+                for batch, future in pending:
+                    future.set_exception(e)
+                continue
+
+            # give each caller back the rows of its own windows, for each output of the model
+            multiple = isinstance(outputs, (list, tuple))
+            outputs = [np.asarray(output) for output in outputs] if multiple else [
+                np.asarray(outputs)]
+
+            start = 0
+            for batch, future in pending:
+                rows = [output[start:start+len(batch)] for output in outputs]
+                future.set_result(rows if multiple else rows[0])
+                start += len(batch)
+
+
+"""
+    wraps a model shared by several threads: the batches passed to predict_on_batch by concurrent callers
+    are merged into a single call to the model, run by a background thread
+    max_wait: how many seconds to wait for other callers before running an incomplete batch
+"""
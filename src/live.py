@@ -0,0 +1,505 @@
+import os
+import sys
+import json
+import time
+import struct
+import argparse
+import itertools
+import numpy as np
+
+import utils
+import spectrogram
+import profiling
+from inference import backends, fused_model_path, model_paths, warm_up
+from results import ChannelResults, detection_line, result_formats
+from main import load_classifier, scan_stream
+
+# sample formats of raw pcm input, as named by sox and ffmpeg
+pcm_formats = {'s16le': np.dtype('<i2'), 's32le': np.dtype('<i4'),
+               'f32le': np.dtype('<f4'), 'u8': np.dtype('u1')}
+
+# sample formats of .wav input, by format tag (1 is integer pcm, 3 is float) and bits per sample
+wav_formats = {(1, 8): np.dtype('u1'), (1, 16): np.dtype('<i2'),
+               (1, 32): np.dtype('<i4'), (3, 32): np.dtype('<f4')}
+
+
+def read_available(stream, size, follow=False, poll=0.05, idle=10):
+    waited = 0
+    while True:
+        data = stream.read1(size)
+        if len(data) > 0 or not follow or waited >= idle:
+            return data
+
+        # a file that is still being written: wait for it to grow
+        time.sleep(poll)
+        waited += poll
+
+
+"""
+    returns the bytes that are available in stream, at most size, waiting only for the first ones
+    returns b"" at the end of the stream, or when following a growing
+    file that hasn't grown for idle seconds
+"""
+
+
+def read_exactly(stream, size, follow=False, poll=0.05, idle=10):
+    data = b""
+    while len(data) < size:
+        more = read_available(stream, size - len(data), follow, poll, idle)
+        if len(more) == 0:
+            break
+        data += more
+
+    return data
+
+
+def read_wav_header(stream, follow=False, poll=0.05, idle=10):
+    header = read_exactly(stream, 8, follow, poll, idle)
+    if len(header) < 8 or header[4:8] != b"WAVE":
+        raise ValueError("not a RIFF/WAVE stream")
+
+    sr, channels, dtype = None, None, None
+    while True:
+        chunk = read_exactly(stream, 8, follow, poll, idle)
+        if len(chunk) < 8:
+            raise ValueError("no data chunk")
+        chunk_id, size = chunk[:4], struct.unpack('<I', chunk[4:])[0]
+
+        if chunk_id == b"data":
+            break
+
+        body = read_exactly(stream, size + size % 2, follow, poll, idle)
+        if chunk_id == b"fmt ":
+            format_tag, channels, sr = struct.unpack('<HHI', body[:8])
+            bits = struct.unpack('<H', body[14:16])[0]
+            # WAVE_FORMAT_EXTENSIBLE: the actual format tag starts the subformat guid
+            if format_tag == 0xFFFE:
+                format_tag = struct.unpack('<H', body[24:26])[0]
+            if (format_tag, bits) not in wav_formats:
+                raise ValueError(
+                    f"{bits}-bit samples with format tag {format_tag} are not supported")
+            dtype = wav_formats[(format_tag, bits)]
+
+    if dtype is None:
+        raise ValueError("no fmt chunk before the data")
+
+    # recorders and pipes leave the size of the data unknown (0 or 0xFFFFFFFF) until they are done
+    if size in [0, 0xFFFFFFFF]:
+        size = None
+
+    return sr, channels, dtype, size
+
+
+"""
+    reads the header of a .wav stream, after the "RIFF" tag and up to the start of the samples
+    returns the sample rate, the number of channels, the dtype of the samples and the size of the
+    data in bytes (None if it is not known yet)
+"""
+
+
+def pcm_blocks(stream, channels, dtype, block_frames, data=b"", limit=None, follow=False, poll=0.05,
+               idle=10):
+    frame_bytes = channels * dtype.itemsize
+    received = 0
+
+    while limit is None or received < limit:
+        size = block_frames * frame_bytes - len(data)
+        if limit is not None:
+            size = min(size, limit - received)
+        more = read_available(stream, size, follow, poll, idle)
+        if len(more) == 0:
+            break
+        received += len(more)
+        data += more
+
+        # only whole frames, the rest waits for the next read
+        n_frames = len(data) // frame_bytes
+        if n_frames == 0:
+            continue
+        block = np.frombuffer(data[:n_frames*frame_bytes], dtype=dtype).reshape(n_frames, channels)
+        data = data[n_frames*frame_bytes:]
+
+        yield time.perf_counter(), block
+
+
+"""
+    yields the pcm samples of stream as soon as they arrive, at most block_frames at a time, with
+    the time at which they were read: (arrival time, array of shape (n_frames, channels))
+    data: bytes already read from the stream (e.g. while looking for a .wav
+    header), limit: size of the data in bytes
+"""
+
+
+class RingBuffer:
+    def __init__(self, capacity, channels, dtype):
+        self.data = np.zeros((capacity, channels), dtype=dtype)
+        self.capacity = capacity
+        self.written = 0
+
+    def write(self, block):
+        n = len(block)
+        block = block[-self.capacity:]
+        position = (self.written + n - len(block)) % self.capacity
+
+        first = min(len(block), self.capacity - position)
+        self.data[position:position + first] = block[:first]
+        self.data[:len(block) - first] = block[first:]
+        self.written += n
+
+    def read(self, start, stop):
+        start = max(start, 0)
+        if start < self.written - self.capacity or stop > self.written:
+            raise ValueError(f"samples [{start}, {stop}) are not in the buffer")
+
+        return self.data[np.arange(start, stop) % self.capacity], start
+
+
+"""
+    keeps the last capacity frames of a stream of pcm samples of shape (n_frames, channels)
+    read() returns the frames [start, stop) of the stream (start is clamped
+    to 0) and the index of the first one
+"""
+
+
+def ready_columns(n_received, n_fft, step, block_steps, first):
+    # the columns whose frames have all been received, see spectrogram.sox_geometry
+    n_frames = max(0, (n_received - n_fft - first) // step + 1)
+
+    return n_frames // block_steps
+
+
+"""
+    returns how many columns of the spectrogram can be computed from the first n_received samples
+"""
+
+
+def live_spectrogram(blocks, sr, channels, dtype, scale, width_res, block_frames):
+    log = scale == "log"
+    n_fft = spectrogram.dft_size(sr)
+    step, block_steps, first = spectrogram.sox_geometry(sr, n_fft, width_res)
+
+    # the samples of the columns still to compute and of the next block
+    ring = RingBuffer(block_frames + n_fft + 2*step*block_steps, channels, dtype)
+    next_column = 0
+
+    def columns(stop):
+        # frames of the columns [next_column, stop): the samples they
+        # cover are still in the ring buffer
+        y, first_sample = ring.read(first + next_column*block_steps*step, ring.written)
+
+        with profiling.stage("spectrogram"):
+            return [spectrogram.spectrogram_columns(
+                y[:, i], sr, width_res, next_column, stop, log=log, n_samples=ring.written,
+                first_sample=first_sample, pixels_per_sec=width_res) for i in range(0, channels)]
+
+    for arrival, block in blocks:
+        ring.write(block)
+        stop = ready_columns(ring.written, n_fft, step, block_steps, first)
+        if stop <= next_column:
+            yield arrival, next_column, [
+                np.empty((spectrogram.SPEC_HEIGHT, 0), dtype=np.uint8)]*channels
+            continue
+
+        chunks = columns(stop)
+        yield arrival, next_column, chunks
+        next_column = stop
+
+    # end of the stream: the last columns, padded with silence like those of a whole file
+    stop = -(-spectrogram.frame_count(ring.written, n_fft, step, first) // block_steps)
+    if stop > next_column:
+        yield time.perf_counter(), next_column, columns(stop)
+
+
+"""
+    computes the spectrogram of every channel of a stream of pcm blocks, as yielded by pcm_blocks,
+    one column as soon as the samples of its frames have arrived. The columns are the same as those
+    of the spectrogram of a whole file, which sox cuts at the width given by the duration: the live
+    spectrogram goes on up to the end of the stream
+    yields, for each block, its arrival time, the index of the first new column and the new columns
+    of each channel (grayscale uint8 images of shape (128, n), n can be 0)
+"""
+
+
+def channel_chunks(stream, channel):
+    for arrival, start, chunks in stream:
+        yield start, chunks[channel]
+
+
+def analyze_live(blocks, sr, channels, dtype, scale, classifier, width_res, step, block_frames,
+                 log_filenames, result_format='jsonl'):
+    window_width = 256
+
+    results = [ChannelResults(log_filenames[i], i, 1, width_res, step, window_width)
+               for i in range(0, channels)]
+    latencies = []
+    received = [0]
+
+    def counted(blocks):
+        for arrival, block in blocks:
+            received[0] += len(block)
+            yield arrival, block
+
+    # every channel scans its own copy of the spectrogram stream, all
+    # of them advance one block at a time
+    columns = live_spectrogram(counted(blocks), sr, channels, dtype, scale, width_res, block_frames)
+    copies = itertools.tee(columns, channels + 1)
+    scanners = [scan_stream(channel_chunks(copies[i], i), classifier, None, step, window_width)
+                for i in range(0, channels)]
+
+    start = time.perf_counter()
+    try:
+        for (arrival, column, chunks), *detections in zip(copies[-1], *scanners):
+            latency = time.perf_counter() - arrival
+            latencies.append(latency)
+            profiling.sample("block latency", latency)
+
+            # the detections are reported as soon as their window is complete
+            for i, channel_detections in enumerate(detections):
+                for j, speedup_label, score in channel_detections:
+                    # time of the window from the start of the stream: a
+                    # duration of 1s over width_res columns
+                    print(f"ch{i}: {detection_line(j, speedup_label, 1, width_res, step)} "
+                          f"(latency {latency*1000:.1f}ms)", flush=True)
+                results[i].add(channel_detections, echo=False)
+    except KeyboardInterrupt:
+        print("Interrupted, saving the results so far")
+    elapsed = time.perf_counter() - start
+
+    # the length of the recording is only known now
+    duration = round(received[0] / sr, 2)
+    for channel_results in results:
+        channel_results.duration, channel_results.width = duration, int(duration*width_res)
+        with open(channel_results.log_filename, 'a') as log_file:
+            log_file.write(f"Duration: {duration}s\n")
+        channel_results.write(result_format)
+
+    return duration, elapsed, latencies
+
+
+"""
+    blocks: pcm blocks of the stream, as yielded by pcm_blocks
+    classifies every window of the spectrogram of each channel as soon as its last column
+    is computed, and prints the flagged ones with the latency from the arrival of the
+    block that completed them. The logs and the merged events of each channel are written
+    when the stream ends (or on ctrl-c)
+    returns the duration of the stream, the time spent on it and
+    the latency of every block, in seconds
+"""
+
+
+def latency_summary(duration, elapsed, latencies, block_seconds):
+    latencies = np.array(latencies) * 1000
+    busy = np.sum(latencies) / 1000
+
+    return {
+        "audio_seconds": duration,
+        "wall_seconds": round(elapsed, 3),
+        # how much faster than real time the blocks are processed, below 1 the
+        # analysis falls behind a live input
+        "realtime_factor": round(duration / busy, 1) if busy > 0 else None,
+        "block_seconds": block_seconds,
+        "block_latency_ms": {
+            "p50": round(float(np.percentile(latencies, 50)), 3),
+            "p99": round(float(np.percentile(latencies, 99)), 3),
+            "max": round(float(np.max(latencies)), 3)
+        } if len(latencies) > 0 else None
+    }
+
+
+"""
+    returns the measures of a live analysis: the latency of a block is the time from its arrival to
+    the report of the windows it completed, on top of the length of the block and of a window
+"""
+
+
+if __name__ == "__main__":
+    script_path = utils.get_script_path()
+    models_path = os.path.dirname(script_path) + "/models/"
+
+    parser = argparse.ArgumentParser(
+        description="""Analyze a tape while it is being digitised: read the audio from stdin or from
+        a file that is still being written, and report the discrepancies between the recording and
+        the playback speed as soon as each window of the spectrogram is complete. The
+        spectrogram is always computed in-process (engine 'numpy' of main.py), check it with
+        parity.py first.""")
+
+    # optional arguments: input stream
+    parser.add_argument('-i', '--input', type=str, default="-",
+                        help="""Audio to analyze: '-' for stdin (default), or the path of a
+                        file that is still being written (see --follow). A WAV header is read
+                        if there is one, otherwise the input is raw PCM as described by
+                        --rate, --channels and --format.""")
+
+    # optional arguments: output folder
+    parser.add_argument('-o', '--output', type=str, default="output",
+                        help="""Folder in which to save the results, in a subfolder named
+                        after --name. Default is 'output'.""")
+
+    # optional arguments: name of the recording
+    parser.add_argument('-n', '--name', type=str, default=None,
+                        help="""Name of the subfolder of the results. Default is the name of the
+                        input file, or 'live' for stdin.""")
+
+    # required arguments: scale for y-axis
+    parser.add_argument('-s', '--scale', type=str,
+                        help="""Which scale to use for the y-axis of the spectrogram, and the models
+                        to use: 'log' or 'lin'. The 'mel' spectrogram is scaled with the bounds of
+                        the whole recording, so it can't be computed live.""")
+
+    # optional arguments: resolution of x-axis (pixels per second)
+    parser.add_argument('-w', '--width', nargs='?', type=int, default=256,
+                        help="What resolution to use on the x-axis, in pixels/s. Default is 256.")
+
+    # optional arguments: step
+    parser.add_argument('-j', '--jump', nargs='?', type=int, default=64,
+                        help="""What step to use for the scanning of the
+                        spectrum. Default is 64 pixels.""")
+
+    # optional arguments: batch size for the classifiers
+    parser.add_argument('-b', '--batch', nargs='?', type=int, default=256,
+                        help="""How many windows to classify in a single
+                        call to the models. Default is 256.""")
+
+    # optional arguments: raw pcm input
+    parser.add_argument('--rate', nargs='?', type=int, default=44100,
+                        help="Sample rate of raw PCM input. Default is 44100.")
+    parser.add_argument('--channels', nargs='?', type=int, default=2,
+                        help="Number of channels of raw PCM input. Default is 2.")
+    parser.add_argument('--format', type=str, default='s16le',
+                        help="""Sample format of raw PCM input: 's16le', 's32le',
+                        'f32le' or 'u8'. Default is 's16le'.""")
+
+    # optional arguments: length of the blocks
+    parser.add_argument('--block', nargs='?', type=int, default=100,
+                        help="""Longest block of audio to process at once, in milliseconds.
+                        Smaller blocks report the detections sooner, at the cost of more
+                        calls to the models. Default is 100.""")
+
+    # optional arguments: growing file
+    parser.add_argument('--follow', action='store_true',
+                        help="""Keep reading the input file as it grows, like 'tail -f', until it
+                        hasn't grown for --idle seconds.""")
+    parser.add_argument('--idle', nargs='?', type=float, default=10,
+                        help="""With --follow, how many seconds without new audio
+                        end the analysis. Default is 10.""")
+
+    # optional arguments: inference backend
+    parser.add_argument('--backend', type=str, default='keras',
+                        help="""Which runtime to use for the classifiers: 'keras', 'tflite',
+                        'onnx' or 'tflite-int8'. The models must be exported with export.py first
+                        for 'tflite' and 'onnx', and quantized with quantize.py for
+                        'tflite-int8'. Default is 'keras'.""")
+
+    # optional arguments: fused model
+    parser.add_argument('--fused', action='store_true',
+                        help="""Use the model that fuses the binary and the 4-class
+                        classifier of the scale, computing both in a single pass. It
+                        must be created with fuse.py first.""")
+
+    # optional arguments: format of the results
+    parser.add_argument('--results', type=str, default='jsonl',
+                        help="""Format of the file with the irregularities of each
+                        channel, merged into events with their start and end time:
+                        'jsonl' or 'csv'. Default is 'jsonl'.""")
+
+    # optional arguments: profiling
+    parser.add_argument('--profile', nargs='?', type=str, default=None, const="profile.json",
+                        help="""Measure the time of each stage of the analysis and
+                        the latency of each block, and save the report in the given
+                        .json file. Default is profile.json.""")
+
+    args = parser.parse_args()
+
+    if args.scale == "mel":
+        print("The mel spectrogram is scaled with the bounds of the whole recording, it can't be "
+              "computed live. Use 'lin' or 'log', or main.py once the transfer is done.")
+        sys.exit(1)
+
+    if not (args.scale in ['lin', 'log']):
+        print("The scale chosen is not valid. See live.py -h for information.")
+        sys.exit(1)
+
+    if args.format not in pcm_formats:
+        print(f"{args.format} is not a valid sample format. See live.py -h for information.")
+        sys.exit(1)
+
+    if args.results not in result_formats:
+        print(f"{args.results} is not a valid results format. See live.py -h for information.")
+        sys.exit(1)
+
+    if args.backend not in backends:
+        print(f"{args.backend} is not a valid backend. See live.py -h for information.")
+        sys.exit(1)
+
+    if args.input != "-" and not os.path.isfile(args.input):
+        print(f"{args.input} doesn't exist. Exiting program.")
+        sys.exit(1)
+
+    # the models are loaded before reading, so that the input doesn't pile up meanwhile
+    binary_model_path, four_classes_model_path = model_paths(models_path, args.scale)
+    fused_path = fused_model_path(models_path, args.scale) if args.fused else None
+    classifier = load_classifier(
+        binary_model_path, four_classes_model_path, args.batch, args.backend, fused_path)
+
+    # keep the first, slower call of the models out of the latency of the detections
+    warm_up(classifier)
+
+    if args.profile is not None:
+        profiling.enable(memory=False)
+
+    stream = sys.stdin.buffer if args.input == "-" else open(args.input, 'rb')
+    follow = args.follow and args.input != "-"
+
+    # .wav stream, or raw pcm
+    data = read_exactly(stream, 4, follow, idle=args.idle)
+    limit = None
+    if data == b"RIFF":
+        try:
+            sr, channels, dtype, limit = read_wav_header(stream, follow, idle=args.idle)
+        except ValueError as e:
+            print(f"Couldn't read the WAV header of {args.input}: {e}. Exiting program.")
+            sys.exit(1)
+        data = b""
+    else:
+        sr, channels, dtype = args.rate, args.channels, pcm_formats[args.format]
+    print(f"Reading {args.input}: {sr}Hz, {channels} channels, {dtype.name}")
+
+    # same for the first spectrogram (imports, dft setup)
+    spectrogram.sox_spectrogram(np.zeros(sr, dtype=dtype), sr, 1, log=(args.scale == "log"))
+
+    name = args.name
+    if name is None:
+        name = "live" if args.input == "-" else os.path.splitext(os.path.basename(args.input))[0]
+    out_path = os.path.join(args.output, name) + "/"
+    utils.create_folder(out_path)
+
+    log_filenames = []
+    for i in range(0, channels):
+        log_filename = out_path + "output-ch" + str(i) + ".txt"
+        with open(log_filename, 'w') as log_file:
+            log_file.write(f"Filename: {args.input}\n")
+        log_filenames.append(log_filename)
+
+    block_frames = max(1, sr * args.block // 1000)
+    blocks = pcm_blocks(stream, channels, dtype, block_frames, data, limit, follow, idle=args.idle)
+    duration, elapsed, latencies = analyze_live(
+        blocks, sr, channels, dtype, args.scale, classifier, args.width, args.jump, block_frames,
+        log_filenames, args.results)
+
+    summary = latency_summary(duration, elapsed, latencies, block_frames / sr)
+    with open(out_path + "latency.json", 'w') as out_file:
+        json.dump(summary, out_file, indent=4)
+
+    print(f"Analyzed {duration}s of audio in {summary['wall_seconds']}s, "
+          f"{summary['realtime_factor']}x faster than real time")
+    if summary["block_latency_ms"] is not None:
+        latency = summary["block_latency_ms"]
+        print(f"Latency from the arrival of a block to its detections: p50 {latency['p50']}ms, "
+              f"p99 {latency['p99']}ms, max {latency['max']}ms")
+    print(f"Saved results in {out_path}")
+    if summary["realtime_factor"] is not None and summary["realtime_factor"] < 1:
+        print("The analysis is slower than real time, "
+              "the detections of a live input fall further behind.")
+
+    if args.profile is not None:
+        profiling.save(args.profile)
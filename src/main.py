@@ -1,106 +1,403 @@
 import os
 import sys
+import shutil
 import numpy as np
 import argparse
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
 import utils
 import vision
-from wav2spec import wav2spec
+import profiling
+from spectrogram import engines
+from inference import (FusedClassifier, WindowClassifier, backends, fused_model_path, load_model,
+                       model_paths)
+from cache import CACHE_PATH, CACHE_SIZE, SpectrogramCache, cached_spectrogram, sample_digest
+from results import ChannelResults, result_formats
+from artifacts import ArtifactWriter, artifact_modes
+from wav2spec import compute_spectrogram, stream_spectrogram
 
-import cv2 as cv
-from scipy.io import wavfile
-import librosa
 # generator buffer
 
 
-def analyze_speed(sample, scale, binary_model_path, four_classes_model_path, width_res, step):
-    from keras.models import load_model
-
-    # load the keras classifiers
-    binary_model = load_model(binary_model_path)
-    four_classes_model = load_model(four_classes_model_path)
-
-    # speedup corresponding to the label output by the second classifier
-    speedup_dict = {
-        0: "double",
-        1: "half",
-        2: "quadruple",
-        3: "quarter"
-    }
-
-    # create output folder
-    out_path = os.path.dirname(os.path.realpath('__file__')) + "/output/"
-    utils.create_folder(out_path)
-
-    # read audio sample
-    fs, data = wavfile.read(sample)
-
-    # sample is mono
-    if len(data.shape) == 1:
-        data.shape = (data.shape[0], 1)
-
-    # for each channel:
-    for i in range(0, data.shape[1]):
-        log_filename = out_path + "output-ch" + str(i) + ".txt"
-        with open(log_filename, 'w') as log_file:
-            log_file.write(f"Filename: {sample}\n")
-            print(f"Created file {log_filename}")
-
-        # create folders where to save the separate audio and segmented spectrograms
-        channel_path = out_path + "ch" + str(i) + "/"
-        segments_path = out_path + "segments_ch" + str(i) + "/"
-        utils.create_folder(channel_path)
-        utils.create_folder(segments_path)
-
-        # save audio of channel
-        channel_filename = channel_path + "ch" + str(i) + ".wav"
-        wavfile.write(channel_filename, fs, data[:, i])
-
-        # load audio of channel and get the duration
-        y, sr = librosa.load(channel_filename, offset=0.0, duration=None)
-        duration = round(librosa.get_duration(filename=sample), 2)
-        with open(log_filename, 'a') as log_file:
-            log_file.write(f"Duration: {duration}s\n")
-
-        # save spectrogram and load it into numpy array
-        spec_name = wav2spec(channel_filename, scale, channel_path, width_res)
-        spectrum = cv.imread(spec_name, cv.IMREAD_GRAYSCALE)
-        height, width = spectrum.shape[:2]
-
-        if width < 256:
-            print("The audio file is too short to be analyzed")
-            break
-
-        # settings for the scanning of the spectrogram
-        offset = 0
-        window_width = 256
-
-        # scan the whole spectrogram and divide it in windows (segments)
-        for i in range(0, width//step):
-            if offset + i*step + window_width < width:
-                window = spectrum[0:height, offset+i *
-                                  step:offset+(i*step)+window_width]
-                window = np.expand_dims(window, axis=0)
-
-                # classify the window
-                binary_label = np.argmax(
-                    binary_model.predict(window, verbose=0))
-
-                if binary_label == 1:  # irregularity detected
-                    timestamp = round(duration * (i * step) / width, 2)
-
-                    # classify the speedup factor
-                    speedup_label = np.argmax(
-                        four_classes_model.predict(window, verbose=0))
-                    print(
-                        f"Segment {i}, time: {str(timestamp)}s, speedup: {speedup_dict[speedup_label]}")
-                    with open(log_filename, 'a') as log_file:
-                        log_file.write(
-                            f"Segment {i}, time: {str(timestamp)}s, speedup: {speedup_dict[speedup_label]}\n")
-
-        # save the windows for manual analysis
-        vision.compute_segments([channel_path], [segments_path], step=step,
-                                window_width=window_width, multiple=True, offset=offset)
+def scan_spectrogram(spectrum, classifier, step, window_width, offset=0):
+    # scan the whole spectrogram and divide it in windows (segments), as a view over the spectrogram
+    windows = vision.sliding_windows(
+        spectrum, step=step, window_width=window_width, offset=offset)
+
+    # classify all the windows in batches, then the speedup of the flagged ones
+    flagged, speedup_labels, scores = classifier.classify(
+        windows, return_scores=True)
+
+    return list(zip(flagged, speedup_labels, scores[flagged]))
+
+
+"""
+    returns the list of (window index, speedup label, probability of being irregular) of the windows
+    of the spectrogram flagged as irregular
+"""
+
+
+def scan_adaptive(spectrum, classifier, step, window_width, coarse_step, threshold=0.1, offset=0):
+    n_windows = vision.count_windows(
+        spectrum.shape[1], step, window_width, offset)
+    windows = vision.sliding_windows(
+        spectrum, step=step, window_width=window_width, offset=offset)
+    ratio = coarse_step // step
+
+    # label of each window of the fine scan: -1 not classified, 0 regular, 1 irregular
+    flags = np.full(n_windows, -1, dtype=np.int8)
+    speedups = np.full(n_windows, -1, dtype=np.int64)
+    probabilities = np.zeros(n_windows, dtype=np.float32)
+
+    def classify(indexes):
+        flagged, speedup_labels, scores = classifier.classify(
+            windows[indexes], return_scores=True)
+        flags[indexes] = 0
+        flags[indexes[flagged]] = 1
+        speedups[indexes[flagged]] = speedup_labels
+        probabilities[indexes] = scores
+        return flagged, speedup_labels, scores
+
+    # coarse pass: one window every coarse_step pixels
+    coarse = np.arange(0, n_windows, ratio)
+    flagged, speedup_labels, scores = classify(coarse)
+
+    # fine pass: the windows between the coarse ones that are flagged, or that the
+    # binary classifier is unsure about
+    unsure = (scores >= threshold) | np.isin(
+        np.arange(len(coarse)), flagged)
+    around = (coarse[unsure][:, np.newaxis] +
+              np.arange(1 - ratio, ratio)).ravel()
+    around = np.unique(around[(around >= 0) & (around < n_windows)])
+    classify(around[flags[around] == -1])
+
+    detections = [(j, speedups[j], probabilities[j])
+                  for j in np.flatnonzero(flags == 1)]
+
+    # the label changes between two adjacent windows: find the first column at which it changes by
+    # bisection, classifying all the transitions together at every round. With a fused model each
+    # round costs a full pass of both heads, with two classifiers only the binary one runs
+    edges = np.flatnonzero((flags[:-1] >= 0) & (flags[1:] >= 0)
+                           & (flags[:-1] != flags[1:]))
+    low = offset + edges*step
+    high = low + step
+    while np.any(high - low > 1):
+        active = np.flatnonzero(high - low > 1)
+        middle = (low[active] + high[active]) // 2
+        flagged_middle = classifier.flag(
+            np.stack([spectrum[:, m:m+window_width] for m in middle]))
+
+        same_as_left = flagged_middle == (flags[edges[active]] == 1)
+        low[active[same_as_left]] = middle[same_as_left]
+        high[active[~same_as_left]] = middle[~same_as_left]
+
+    # each transition takes the speedup of the irregular window next to it
+    transitions = []
+    for k, column in zip(edges, high):
+        starts = flags[k] == 0
+        transitions.append(
+            (column, speedups[k+1] if starts else speedups[k], starts))
+
+    return detections, transitions
+
+
+"""
+    scans the spectrogram with a stride of coarse_step pixels (a multiple of step) first,
+    then with step only around the windows that are flagged or that have a probability of
+    being irregular of at least threshold
+    returns the detections of the flagged windows, with the same indexes as scan_spectrogram, and
+    the (column, speedup label, start) of each transition: the first column at which a window
+    starting there is classified differently than the one before, start is True when the
+    irregularity starts there and False when it ends
+"""
+
+
+def scan_stream(chunks, classifier, width, step, window_width):
+    n_windows = vision.count_windows(
+        width, step, window_width) if width is not None else np.inf
+    buffer = None
+    buffer_start = 0
+    next_window = 0
+
+    for start, chunk in chunks:
+        buffer = chunk if buffer is None else np.concatenate(
+            [buffer, chunk], axis=1)
+        buffer_end = start + chunk.shape[1]
+
+        # windows that are complete with the columns computed so far
+        ready = min(n_windows, vision.count_windows(
+            buffer_end, step, window_width))
+        if ready <= next_window:
+            yield []
+            continue
+
+        windows = vision.sliding_windows(
+            buffer, step=step, window_width=window_width,
+            offset=next_window*step - buffer_start)[:ready - next_window]
+
+        flagged, speedup_labels, scores = classifier.classify(
+            windows, return_scores=True)
+        yield list(zip(flagged + next_window, speedup_labels, scores[flagged]))
+
+        # keep only the columns still needed by the windows that are not complete yet
+        next_window += len(windows)
+        buffer = buffer[:, next_window*step - buffer_start:]
+        buffer_start = next_window*step
+
+
+"""
+    scans a spectrogram that arrives in chunks, as yielded by wav2spec.stream_spectrogram
+    classifies the windows as soon as they are complete and yields, for each chunk, the list of
+    (window index, speedup label, probability of being irregular) of the windows flagged as
+    irregular
+    width: width of the whole spectrogram, None if it is not known (e.g. for a live recording)
+"""
+
+
+def channel_spectrogram(sample, channel, scale, width, cache=None, digest=None, engine='sox'):
+    def compute():
+        fs, data = utils.load_audio(sample)
+        return compute_spectrogram(data[:, channel], fs, scale, width, engine)
+
+    return cached_spectrogram(cache, sample, scale, width, channel, compute, digest, engine)
+
+
+"""
+    computes the spectrogram of one channel of the sample (or reads it from the
+    cache), run in the worker processes
+    digest: sha256 of the sample, hashed once by the main process so
+    that the workers don't hash it again
+    engine: 'sox' or 'numpy', what computes the 'lin' and 'log' spectrograms
+"""
+
+
+def load_classifier(binary_model_path, four_classes_model_path, batch_size, backend='keras',
+                    fused_model_path=None):
+    # a single model computing both outputs, see fuse.py
+    if fused_model_path is not None:
+        return FusedClassifier(load_model(fused_model_path, backend), batch_size=batch_size)
+
+    # load the classifiers with the chosen backend
+    binary_model = load_model(binary_model_path, backend)
+    four_classes_model = load_model(four_classes_model_path, backend)
+
+    return WindowClassifier(binary_model, four_classes_model, batch_size=batch_size)
+
+
+def output_names(samples):
+    if len(samples) == 1:
+        return [os.path.splitext(os.path.basename(samples[0]))[0]]
+
+    # keep the folder structure of the input, so that samples with the same name don't collide
+    root = os.path.commonpath([os.path.abspath(sample) for sample in samples])
+
+    return [os.path.splitext(os.path.relpath(os.path.abspath(sample), root))[0]
+            for sample in samples]
+
+
+"""
+    returns the name of the output folder of each sample
+"""
+
+
+def open_samples(samples, out_path, width_res, window_width, cache=None):
+    for sample, name in zip(samples, output_names(samples)):
+        # only the header is read here, the workers memory-map the samples themselves
+        try:
+            fs, data = utils.load_audio(sample)
+        except (ValueError, OSError) as e:
+            print(f"Couldn't read {sample}: {e}. Skipping to next one..")
+            continue
+
+        duration = round(data.shape[0] / fs, 2)
+        width = int(duration*width_res)
+
+        if width < window_width:
+            print(f"The audio file {sample} is too short to be analyzed")
+            continue
+
+        # every sample gets its own output folder, with a log file for each channel
+        sample_path = out_path + name + "/"
+        utils.create_folder(sample_path)
+
+        log_filenames = []
+        for i in range(0, data.shape[1]):
+            log_filename = sample_path + "output-ch" + str(i) + ".txt"
+            with open(log_filename, 'w') as log_file:
+                log_file.write(f"Filename: {sample}\n")
+                log_file.write(f"Duration: {duration}s\n")
+                print(f"Created file {log_filename}")
+            log_filenames.append(log_filename)
+
+        # the key of the sample in the cache, hashed here once for all its channels
+        digest = sample_digest(sample) if cache is not None else None
+
+        yield {"sample": sample, "path": sample_path, "fs": fs, "data": data, "digest": digest,
+               "duration": duration, "width": width, "log_filenames": log_filenames}
+
+
+"""
+    creates the output folder and the log files of each sample that can be analyzed
+    yields a dictionary with the output paths and the parameters of the sample
+    cache: if set, the sample is hashed here for the key of its spectrograms in the cache
+"""
+
+
+def analyze_speed(samples, out_path, scale, binary_model_path, four_classes_model_path, width_res,
+                  step, batch_size=256, stream=False, chunk_seconds=60, processes=None,
+                  backend='keras', fused_model_path=None, cache=None, coarse_step=None,
+                  refine_threshold=0.1, result_format='jsonl', artifacts='all', engine='sox'):
+    if isinstance(samples, str):
+        samples = [samples]
+    if not out_path.endswith("/"):
+        out_path = out_path + "/"
+
+    # results of previous runs are kept, only the folders of the samples analyzed now are replaced
+    os.makedirs(out_path, exist_ok=True)
+
+    # settings for the scanning of the spectrogram
+    offset = 0
+    window_width = 256
+
+    files = open_samples(samples, out_path, width_res, window_width, None if stream else cache)
+
+    if stream:
+        classifier = load_classifier(
+            binary_model_path, four_classes_model_path, batch_size, backend, fused_model_path)
+
+        # compute and scan the spectrogram chunk by chunk, memory is bounded by the chunk size
+        for f in files:
+            for i in range(0, f["data"].shape[1]):
+                print(f"{f['sample']}, channel {i}:")
+                results = ChannelResults(
+                    f["log_filenames"][i], i, f["duration"], f["width"], step, window_width)
+                chunks = stream_spectrogram(
+                    f["data"][:, i], f["fs"], scale, f["width"], chunk_seconds*width_res, engine)
+                for detections in scan_stream(chunks, classifier, f["width"], step, window_width):
+                    results.add(detections)
+                results.write(result_format)
+        return
+
+    # one job for each channel of each sample
+    jobs = ((f, i) for f in files for i in range(0, f["data"].shape[1]))
+
+    if processes is None:
+        processes = os.cpu_count()
+
+    # pipeline: the workers decode the samples and compute the spectrograms while the models
+    # classify the ones that are ready. At most two spectrograms per worker are in flight,
+    # bounding the memory. The workers are spawned rather than forked, as forking a process that
+    # has already initialized tensorflow is unsafe
+    pool = None
+    if processes > 1:
+        pool = ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+        spectrograms = pipeline(pool, jobs, scale, 2*processes, cache, engine)
+    else:
+        # single process: compute the spectrograms one at a time
+        spectrograms = ((f, i, channel_spectrogram(
+            f["sample"], i, scale, f["width"], cache, f["digest"], engine)) for f, i in jobs)
+
+    classifier = load_classifier(
+        binary_model_path, four_classes_model_path, batch_size, backend, fused_model_path)
+
+    # the images for manual revision are encoded in the background,
+    # straight from the spectrograms in memory
+    writer = ArtifactWriter() if artifacts != 'none' else None
+
+    # classify each channel as soon as its spectrogram is ready, all of them share the same models
+    for f, i, spectrum in profiling.timed(spectrograms, "spectrogram wait"):
+        print(f"{f['sample']}, channel {i}:")
+
+        # create folders where to save the spectrogram and the segmented spectrogram
+        channel_path = f["path"] + "ch" + str(i) + "/"
+        segments_path = f["path"] + "segments_ch" + str(i) + "/"
+        if artifacts == 'all':
+            utils.create_folder(channel_path)
+            writer.write_image(channel_path + "ch" +
+                               str(i) + ".png", spectrum)
+        if artifacts != 'none':
+            utils.create_folder(segments_path)
+
+        results = ChannelResults(f["log_filenames"][i], i, f["duration"], f["width"],
+                                 step, window_width, offset)
+        if coarse_step is not None:
+            detections, transitions = scan_adaptive(
+                spectrum, classifier, step, window_width, coarse_step, refine_threshold, offset)
+            results.add_transitions(transitions)
+        else:
+            detections = scan_spectrogram(
+                spectrum, classifier, step, window_width, offset)
+        results.add(detections)
+        results.write(result_format)
+
+        # save the windows for manual analysis, all of them or only the flagged ones
+        if artifacts != 'none':
+            windows = vision.sliding_windows(
+                spectrum, step=step, window_width=window_width, offset=offset)
+            indexes = None if artifacts == 'all' else [
+                j for j, speedup_label, score in detections]
+            writer.write_segments(windows, segments_path,
+                                  "ch" + str(i), indexes)
+
+    if writer is not None:
+        writer.close()
+    if pool is not None:
+        pool.shutdown()
+
+
+"""
+    samples: path of a .wav file, or list of paths
+    the results of each sample are saved in their own folder inside out_path
+    cache: SpectrogramCache shared by the workers, None to always compute the
+    spectrograms (not used in stream mode)
+    coarse_step: if set, scan adaptively (see scan_adaptive) with
+    this stride first, refining with step
+    result_format: 'jsonl' or 'csv', format of the merged events saved next to the log of each
+    channel
+    artifacts: which images to save for manual revision: 'none', 'flagged' (only the flagged
+    windows) or 'all' (the spectrogram and all the windows)
+    engine: 'sox' or 'numpy', what computes the 'lin' and 'log' spectrograms
+"""
+
+
+def pipeline(pool, jobs, scale, max_pending, cache=None, engine='sox'):
+    pending = {}
+
+    def submit():
+        # keep at most max_pending spectrograms in flight
+        for f, i in jobs:
+            if profiling.enabled:
+                future = pool.submit(profiling.run_profiled, channel_spectrogram, f["sample"], i,
+                                     scale, f["width"], cache, f["digest"], engine,
+                                     memory=profiling.trace_memory)
+            else:
+                future = pool.submit(channel_spectrogram, f["sample"], i, scale, f["width"],
+                                     cache, f["digest"], engine)
+            pending[future] = (f, i)
+            if len(pending) >= max_pending:
+                break
+
+    submit()
+    while len(pending) > 0:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            f, i = pending.pop(future)
+            spectrum = future.result()
+            if profiling.enabled:
+                # add the measurements of the worker to those of the main process
+                spectrum, worker_profile = spectrum
+                profiling.merge(worker_profile)
+            yield f, i, spectrum
+
+        submit()
+
+
+"""
+    runs channel_spectrogram on the pool for every (sample, channel) job
+    yields the jobs with their spectrogram as they complete
+"""
 
 
 if __name__ == "__main__":
@@ -112,9 +409,15 @@ if __name__ == "__main__":
         description="""Analyze a digitised magnetic audio tape and detect discrepancies 
         between the recording speed and the playback speed.""")
 
-    # required arguments: audio sample
+    # required arguments: audio sample(s)
     parser.add_argument('-i', '--input', type=str,
-                        help='Path to the WAV audio sample to analyze.')
+                        help="""Path to the WAV audio sample to analyze. It can also be a folder, or
+                        a .txt manifest listing one sample per line.""")
+
+    # optional arguments: output folder
+    parser.add_argument('-o', '--output', type=str, default="output",
+                        help="""Folder in which to save the results, each sample gets its own
+                        subfolder. Default is 'output'.""")
 
     # required arguments: scale for y-axis
     parser.add_argument('-s', '--scale', type=str,
@@ -129,32 +432,172 @@ if __name__ == "__main__":
     parser.add_argument('-j', '--jump', nargs='?', type=int, default=64,
                         help="What step to use for the scanning of the spectrum. Default is 64 pixels.")
 
+    # optional arguments: batch size for the classifiers
+    parser.add_argument('-b', '--batch', nargs='?', type=int, default=256,
+                        help="""How many windows to classify in a single
+                        call to the models. Default is 256.""")
+
+    # optional arguments: streaming analysis
+    parser.add_argument('--stream', action='store_true',
+                        help="""Compute and scan the spectrogram in chunks, so that memory
+                        doesn't grow with the length of the tape. The spectrograms and
+                        segments are not saved in this mode.""")
+
+    # optional arguments: length of the chunks in streaming mode
+    parser.add_argument('--chunk', nargs='?', type=int, default=60,
+                        help="Length of each chunk in streaming mode, in seconds. Default is 60.")
+
+    # optional arguments: number of processes
+    parser.add_argument('-p', '--processes', nargs='?', type=int, default=None,
+                        help="""How many processes to use to decode the samples
+                        and compute the spectrograms of their channels in
+                        parallel. Default is the number of CPUs.""")
+
+    # optional arguments: inference backend
+    parser.add_argument('--backend', type=str, default='keras',
+                        help="""Which runtime to use for the classifiers: 'keras', 'tflite',
+                        'onnx' or 'tflite-int8'. The models must be exported with export.py first
+                        for 'tflite' and 'onnx', and quantized with quantize.py for
+                        'tflite-int8'. Default is 'keras'.""")
+
+    # optional arguments: fused model
+    parser.add_argument('--fused', action='store_true',
+                        help="""Use the model that fuses the binary and the 4-class
+                        classifier of the scale, computing both in a single pass. It
+                        must be created with fuse.py first.""")
+
+    # optional arguments: spectrogram engine
+    parser.add_argument('--engine', type=str, default='sox',
+                        help="""What computes the 'lin' and 'log' spectrograms: 'sox' (the
+                        sox-extended binary the models were trained on, it must be on the PATH)
+                        or 'numpy' (in-process, faster, but check it with parity.py before
+                        relying on it). Default is 'sox'.""")
+
+    # optional arguments: spectrogram cache
+    parser.add_argument('--cache', type=str, default=CACHE_PATH,
+                        help=f"""Folder of the spectrogram cache, so that analyzing the same
+                        sample again (e.g. with another -j) doesn't recompute its
+                        spectrograms. Default is {CACHE_PATH}.""")
+
+    # optional arguments: size of the cache
+    parser.add_argument('--cache-size', nargs='?', type=int, default=CACHE_SIZE,
+                        help=f"""Size limit of the spectrogram cache, in MB. 0 disables the cache.
+                        Default is {CACHE_SIZE}.""")
+
+    # optional arguments: adaptive scanning
+    parser.add_argument('--coarse', nargs='?', type=int, default=None,
+                        help="""Scan with this stride first (a multiple of -j, at most 128 pixels),
+                        then with the stride given by -j only around the windows that look
+                        irregular, and locate the transitions to the column. Not available in
+                        streaming mode.""")
+
+    # optional arguments: threshold of the adaptive scanning
+    parser.add_argument('--refine-threshold', nargs='?', type=float, default=0.1,
+                        help="""Probability of being irregular, according to the
+                        binary classifier, above which the windows around a coarse
+                        window are scanned too. Default is 0.1.""")
+
+    # optional arguments: format of the results
+    parser.add_argument('--results', type=str, default='jsonl',
+                        help="""Format of the file with the irregularities of each
+                        channel, merged into events with their start and end time:
+                        'jsonl' or 'csv'. Default is 'jsonl'.""")
+
+    # optional arguments: images to save for manual revision
+    parser.add_argument('--artifacts', type=str, default='all',
+                        help="""Which images to save for manual revision: 'none', 'flagged'
+                        (only the windows flagged as irregular) or 'all' (the spectrogram and
+                        all the windows). Default is 'all'.""")
+
+    # optional arguments: profiling
+    parser.add_argument('--profile', nargs='?', type=str, default=None, const="profile.json",
+                        help="""Measure the time, the number of calls and the peak memory of each
+                        stage of the analysis, and the latency of each batch, and save the report in
+                        the given .json file. Default is profile.json.""")
+
     # read the input parameters and check for correctness
     args = parser.parse_args()
-    sample = args.input
+    in_path = args.input
+    out_path = args.output
     scale = args.scale
     width_res = args.width
     step = args.jump
+    batch_size = args.batch
+    stream = args.stream
+    chunk_seconds = args.chunk
+    processes = args.processes
+    backend = args.backend
+    fused = args.fused
+
+    if in_path is None:
+        print("No input given. See main.py -h for information.")
+        sys.exit(1)
+
+    if in_path.endswith(".wav"):
+        samples = [in_path]
+    elif os.path.isdir(in_path):
+        samples = sorted(utils.collect_audio_files(in_path))
+    elif in_path.endswith(".txt"):
+        samples = utils.read_manifest(in_path)
+    else:
+        print(f"{in_path} is neither a .wav file, a folder, nor a .txt manifest.")
+        sys.exit(1)
 
-    if not (sample.endswith(".wav")):
-        print("The input file is not a .wav file.")
+    if len(samples) == 0:
+        print(f"{in_path} doesn't contain any .wav samples. Exiting program.")
         sys.exit(1)
 
     if not (scale in ['lin', 'log', 'mel']):
         print("The scale chosen is not valid. See main.py -h for information.")
+        sys.exit(1)
+
+    if args.coarse is not None and (args.coarse < step or args.coarse % step != 0 or stream):
+        print("The coarse stride must be a multiple of the step, and can't be used in streaming "
+              "mode. See main.py -h for information.")
+        sys.exit(1)
+
+    # every column must be covered by two coarse windows (256 pixels wide), or a short
+    # irregularity between two of them could be skipped
+    if args.coarse is not None and args.coarse > 256 // 2:
+        print("The coarse stride can be at most half of the window width (128 pixels). See "
+              "main.py -h for information.")
+        sys.exit(1)
+
+    if args.results not in result_formats:
+        print(f"{args.results} is not a valid results format. See main.py -h for information.")
+        sys.exit(1)
+
+    if args.artifacts not in artifact_modes:
+        print(f"{args.artifacts} is not a valid artifacts option. See main.py -h for information.")
+        sys.exit(1)
+
+    if backend not in backends:
+        print(f"{backend} is not a valid backend. See main.py -h for information.")
+        sys.exit(1)
+
+    if args.engine not in engines:
+        print(f"{args.engine} is not a valid engine. See main.py -h for information.")
+        sys.exit(1)
+
+    if args.engine == 'sox' and scale != 'mel' and shutil.which('sox') is None:
+        print("sox is not on the PATH, use --engine numpy or install sox-extended. "
+              "Exiting program.")
+        sys.exit(1)
 
     # define paths to models
-    binary_models = {
-        'lin': models_path + "model-binary-lin/",
-        'log': models_path + "model-binary-log/",
-        'mel': models_path + "model-binary-mel/"
-    }
-
-    four_classes_models = {
-        'lin': models_path + "model-4c-lin/",
-        'log': models_path + "model-4c-log/",
-        'mel': models_path + "model-4c-mel/"
-    }
+    binary_model_path, four_classes_model_path = model_paths(
+        models_path, scale)
+    fused_path = fused_model_path(models_path, scale) if fused else None
+    cache = SpectrogramCache(
+        args.cache, args.cache_size) if args.cache_size > 0 else None
+
+    if args.profile is not None:
+        profiling.enable()
 
     analyze_speed(
-        sample, scale, binary_models[scale], four_classes_models[scale], width_res, step)
+        samples, out_path, scale, binary_model_path, four_classes_model_path, width_res, step,
+        batch_size, stream, chunk_seconds, processes, backend, fused_path, cache, args.coarse,
+        args.refine_threshold, args.results, args.artifacts, args.engine)
+
+    if args.profile is not None:
+        profiling.save(args.profile)
@@ -0,0 +1,200 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import subprocess
+import numpy as np
+
+import utils
+import vision
+from inference import backends, model_paths
+from spectrogram import sox_command
+from wav2spec import compute_spectrogram
+
+
+def sox_reference(sample, scale, width, out_name):
+    return subprocess.call(sox_command(sample, width, out_name, log=(scale == "log"))) == 0
+
+
+"""
+    writes the spectrogram of sample made by sox in out_name, returns whether sox succeeded
+"""
+
+
+def compare_spectrograms(img, reference):
+    # sox may stop a column earlier or later, compare the columns both have
+    width = min(img.shape[1], reference.shape[1])
+    difference = np.abs(img[:, :width].astype(np.int16) - reference[:, :width])
+
+    return {
+        "columns": img.shape[1],
+        "reference_columns": reference.shape[1],
+        "max_difference": int(difference.max()),
+        "mean_difference": round(float(difference.mean()), 4),
+        "different_pixels": round(float(np.mean(difference > 0)), 4)
+    }
+
+
+"""
+    returns the widths of the two spectrograms and the maximum and mean difference of their pixels (0-255), and
+    the fraction of pixels that differ, over the columns they have in common
+"""
+
+
+def window_labels(classifier, img, step):
+    windows = vision.sliding_windows(img, step=step, window_width=256)
+    flagged, speedup_labels = classifier.classify(windows)
+
+    # -1 for the windows that are not flagged, their speedup label otherwise
+    labels = np.full(len(windows), -1, dtype=np.int64)
+    labels[flagged] = speedup_labels
+
+    return labels
+
+
+"""
+    returns the label given by the classifiers to every window of the spectrogram
+"""
+
+
+def check_sample(sample, reference_name, scale, width_res, classifier, step):
+    import cv2 as cv
+
+    fs, data = utils.load_audio(sample)
+    duration = round(data.shape[0] / fs, 2)
+    img = compute_spectrogram(data[:, 0], fs, scale, int(duration*width_res), engine='numpy')
+    reference = cv.imread(reference_name, cv.IMREAD_GRAYSCALE)
+
+    result = dict({"sample": sample, "reference": reference_name}, **compare_spectrograms(img, reference))
+
+    # the labels of the windows both spectrograms have
+    width = min(img.shape[1], reference.shape[1])
+    labels = window_labels(classifier, img[:, :width], step)
+    reference_labels = window_labels(classifier, reference[:, :width], step)
+    result["windows"] = len(labels)
+    result["label_agreement"] = round(float(np.mean(labels == reference_labels)), 4) if len(labels) > 0 else None
+
+    return result
+
+
+"""
+    compares the in-process spectrogram of the first channel of sample (engine 'numpy') with the one made by sox
+    in reference_name, and the labels the classifiers give to their windows
+"""
+
+
+if __name__ == "__main__":
+    script_path = utils.get_script_path()
+    models_path = os.path.dirname(script_path) + "/models/"
+
+    parser = argparse.ArgumentParser(
+        description="""Check that the lin and log spectrograms computed in-process match the ones made by sox,
+        which the models were trained on: difference of the pixels, and agreement of the labels of the
+        classifiers.""")
+
+    # required argument: audio samples
+    parser.add_argument('-i', '--input', type=str,
+                        help="Mono .wav sample, or folder of samples (e.g. the output of splitchannels.py).")
+
+    # required argument: reference spectrograms
+    parser.add_argument('-c', '--check', type=str,
+                        help="""Folder with the spectrograms made by sox, with the same name as the samples (.png
+                        instead of .wav), e.g. the output of wav2spec.py before it stopped calling sox.""")
+
+    # required argument: scale
+    parser.add_argument('-s', '--scale', type=str,
+                        help="Scale of the spectrograms: 'lin' or 'log'.")
+
+    # optional arguments: resolution of x-axis (pixels per second)
+    parser.add_argument('-w', '--width', nargs='?', type=int, default=256,
+                        help="Resolution of the x-axis of the reference spectrograms, in pixels/s. "
+                             "Default is 256.")
+
+    # optional arguments: step
+    parser.add_argument('-j', '--jump', nargs='?', type=int, default=64,
+                        help="Step between the windows whose labels are compared. Default is 64 pixels.")
+
+    # optional arguments: make the missing references with sox
+    parser.add_argument('--sox', action='store_true',
+                        help="""Make the missing reference spectrograms with sox first. It must be the
+                        sox-extended fork, which has the -R and -L options.""")
+
+    # optional arguments: inference backend
+    parser.add_argument('--backend', type=str, default='keras',
+                        help="Which runtime to use for the classifiers, as in main.py. Default is 'keras'.")
+
+    # optional argument: minimum agreement for the check to pass
+    parser.add_argument('--min-agreement', nargs='?', type=float, default=1.0,
+                        help="Minimum fraction of window labels that must match for the check to pass. "
+                             "Default is 1.0.")
+
+    # optional arguments: json report
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help="Path of a .json file in which to save the results.")
+
+    args = parser.parse_args()
+
+    if args.input is None or not os.path.exists(args.input):
+        print(f"{args.input} is not a .wav file or a folder. See parity.py -h for information.")
+        sys.exit(1)
+
+    if args.check is None or (not os.path.isdir(args.check) and not args.sox):
+        print(f"{args.check} is not a folder. See parity.py -h for information.")
+        sys.exit(1)
+
+    if args.scale not in ['lin', 'log']:
+        print(f"{args.scale} is not a valid scale option, see parity.py -h for help. Exiting program")
+        sys.exit(1)
+
+    if args.backend not in backends:
+        print(f"{args.backend} is not a valid backend. See parity.py -h for information.")
+        sys.exit(1)
+
+    if args.sox and shutil.which('sox') is None:
+        print("sox is not on the PATH, the references can't be made. Exiting program.")
+        sys.exit(1)
+
+    samples = [args.input] if os.path.isfile(args.input) else sorted(utils.collect_audio_files(args.input))
+    os.makedirs(args.check, exist_ok=True)
+
+    from main import load_classifier
+    binary_model_path, four_classes_model_path = model_paths(models_path, args.scale)
+    classifier = load_classifier(binary_model_path, four_classes_model_path, 256, args.backend)
+
+    results = []
+    for sample in samples:
+        reference_name = os.path.join(args.check, os.path.splitext(os.path.basename(sample))[0] + ".png")
+
+        if not os.path.isfile(reference_name) and args.sox:
+            fs, data = utils.load_audio(sample)
+            width = int(round(data.shape[0] / fs, 2) * args.width)
+            if not sox_reference(sample, args.scale, width, reference_name):
+                print(f"sox failed on {sample}. Skipping to next one..")
+                continue
+        if not os.path.isfile(reference_name):
+            print(f"No reference spectrogram for {sample} in {args.check}. Skipping to next one..")
+            continue
+
+        result = check_sample(sample, reference_name, args.scale, args.width, classifier, args.jump)
+        if result["windows"] == 0:
+            print(f"{sample} is shorter than a window. Skipping to next one..")
+            continue
+        print(f"{sample}: pixels differ by {result['mean_difference']} on average, "
+              f"{result['max_difference']} at most ({result['different_pixels']*100:.2f}% differ), "
+              f"{result['columns']} columns against {result['reference_columns']}; "
+              f"{result['label_agreement']*100:.2f}% of {result['windows']} window labels match")
+        results.append(result)
+
+    if args.output is not None:
+        with open(args.output, 'w') as out_file:
+            json.dump(results, out_file, indent=4)
+        print(f"Saved results in {args.output}")
+
+    if len(results) == 0:
+        print("No sample could be compared. Exiting program.")
+        sys.exit(1)
+
+    if any(result["label_agreement"] < args.min_agreement for result in results):
+        print("Parity check failed.")
+        sys.exit(1)
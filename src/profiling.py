@@ -0,0 +1,263 @@
+import sys
+import json
+import time
+import threading
+import functools
+import contextlib
+import tracemalloc
+import numpy as np
+from itertools import repeat
+
+# profiling is off unless enable() is called, the hooks cost nothing then
+enabled = False
+# peak memory is measured with tracemalloc, which slows down the allocations
+trace_memory = True
+
+lock = threading.Lock()
+local = threading.local()
+start_time = None
+# stages running in any thread, to know when the peak of tracemalloc can be reset
+open_stages = []
+
+stages = {}
+samples = {}
+
+
+def enable(memory=True):
+    global enabled, trace_memory, start_time
+
+    enabled = True
+    trace_memory = memory
+    start_time = time.perf_counter()
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+"""
+    memory: also measure the peak memory of the stages, set it to False to measure only the time with less
+    overhead
+"""
+
+
+def reset():
+    stages.clear()
+    samples.clear()
+
+
+@contextlib.contextmanager
+def stage(name):
+    if not enabled:
+        yield
+        return
+
+    # stages can be nested, the peak memory of the inner ones also counts for the outer ones
+    stack = getattr(local, "stack", None)
+    if stack is None:
+        stack = local.stack = []
+
+    with lock:
+        current, peak = tracemalloc.get_traced_memory()
+        for outer in stack:
+            outer["peak"] = max(outer["peak"], peak)
+
+        # the peak of tracemalloc is the one of the whole process: it is reset only if no stage of another thread
+        # is running. Otherwise the stages that overlap measure the peak of the process, and are marked as such
+        entry = {"start_memory": current, "peak": current, "shared": False}
+        if len(open_stages) > len(stack):
+            for other in open_stages:
+                other["shared"] = True
+            entry["shared"] = True
+        else:
+            tracemalloc.reset_peak()
+        open_stages.append(entry)
+
+    stack.append(entry)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+
+        with lock:
+            open_stages.remove(entry)
+
+            peak = max(entry["peak"], tracemalloc.get_traced_memory()[1])
+            for outer in stack:
+                outer["peak"] = max(outer["peak"], peak)
+
+            stats = stages.setdefault(name, new_stats())
+            stats["calls"] += 1
+            stats["seconds"] += elapsed
+            peak_memory = (peak - entry["start_memory"]) / 2**20
+            if entry["shared"]:
+                stats["shared_calls"] += 1
+                stats["process_peak_memory_mb"] = max(stats["process_peak_memory_mb"], peak_memory)
+            else:
+                stats["peak_memory_mb"] = max(stats["peak_memory_mb"], peak_memory)
+
+
+"""
+    context manager that adds the wall time of the block to the stage with the given name, counts the calls
+    and keeps the peak memory allocated during the block (above the memory allocated when it started)
+    usable from any thread, e.g. with profiling.stage("spectrogram"): ...
+    the memory is traced for the whole process: the peak of a call is only its own if no stage of another
+    thread runs at the same time. The calls that overlap one are counted in shared_calls, and their peak,
+    which also holds the memory allocated by the other threads since the start of the call (or before), in
+    process_peak_memory_mb
+"""
+
+
+def new_stats():
+    return {"calls": 0, "seconds": 0.0, "peak_memory_mb": 0.0, "shared_calls": 0, "process_peak_memory_mb": 0.0}
+
+
+def timed(iterable, name):
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+"""
+    yields the items of iterable, adding the time spent waiting for each one to the stage with the given name
+"""
+
+
+def sample(name, value):
+    if not enabled:
+        return
+
+    with lock:
+        samples.setdefault(name, []).append(value)
+
+
+"""
+    records one measurement (e.g. the latency of a batch, in seconds) of the series with the given name
+"""
+
+
+def snapshot():
+    with lock:
+        return {"stages": {name: dict(stats) for name, stats in stages.items()},
+                "samples": {name: list(values) for name, values in samples.items()}}
+
+
+def merge(snapshot):
+    with lock:
+        for name, other in snapshot["stages"].items():
+            stats = stages.setdefault(name, new_stats())
+            stats["calls"] += other["calls"]
+            stats["seconds"] += other["seconds"]
+            stats["peak_memory_mb"] = max(
+                stats["peak_memory_mb"], other["peak_memory_mb"])
+            stats["shared_calls"] += other["shared_calls"]
+            stats["process_peak_memory_mb"] = max(
+                stats["process_peak_memory_mb"], other["process_peak_memory_mb"])
+        for name, values in snapshot["samples"].items():
+            samples.setdefault(name, []).extend(values)
+
+
+def run_profiled(function, *args, memory=True):
+    # run in a worker process: profile only this call and send the measurements back with the result
+    enable(memory)
+    reset()
+    result = function(*args)
+
+    return result, snapshot()
+
+
+"""
+    snapshot() returns the measurements taken so far, merge() adds those of another process
+    run_profiled() calls function(*args) with profiling enabled, in a worker process, and returns its result
+    with the snapshot of the call, to merge in the main process; pass memory=trace_memory to measure the same
+    as the main process
+"""
+
+
+def profiled_map(map_function, function, *iterables):
+    if not enabled:
+        yield from map_function(function, *iterables)
+        return
+
+    # the workers return their measurements with each result
+    worker = functools.partial(run_profiled, memory=trace_memory)
+    for result, worker_profile in map_function(worker, repeat(function), *iterables):
+        merge(worker_profile)
+        yield result
+
+
+"""
+    same as map_function(function, *iterables), with map_function the map of a process pool (e.g.
+    ProcessPoolExecutor.map)
+    when profiling is enabled, the measurements taken in the worker processes are added to those of the main
+    process
+"""
+
+
+def report():
+    import resource
+
+    series = {}
+    for name, values in samples.items():
+        values = np.array(values) * 1000
+        series[name] = {
+            "count": len(values),
+            "mean_ms": round(float(np.mean(values)), 3),
+            "p50_ms": round(float(np.percentile(values, 50)), 3),
+            "p90_ms": round(float(np.percentile(values, 90)), 3),
+            "p99_ms": round(float(np.percentile(values, 99)), 3),
+            "max_ms": round(float(np.max(values)), 3)
+        }
+
+    return {
+        "command": sys.argv,
+        "wall_seconds": round(time.perf_counter() - start_time, 3),
+        # kilobytes on linux
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "stages": {name: {"calls": stats["calls"], "seconds": round(stats["seconds"], 3),
+                          "peak_memory_mb": round(stats["peak_memory_mb"], 1),
+                          "shared_calls": stats["shared_calls"],
+                          "process_peak_memory_mb": round(stats["process_peak_memory_mb"], 1)}
+                   for name, stats in sorted(stages.items(), key=lambda item: -item[1]["seconds"])},
+        "latencies": series
+    }
+
+
+"""
+    returns the report of the run: total wall time, maximum resident memory of the main process, and for each
+    stage the number of calls, the total wall time (summed over threads and worker processes) and the peak
+    memory allocated by a call that ran alone, with the number of calls that overlapped a stage of another
+    thread and the peak of the process during those; for each series of samples the count, mean, percentiles
+    and maximum, in milliseconds
+"""
+
+
+def save(path):
+    result = report()
+
+    print(f"Profile ({result['wall_seconds']}s, max rss {result['max_rss_mb']}MB):")
+    for name, stats in result["stages"].items():
+        shared = ""
+        if stats["shared_calls"] > 0:
+            shared = (f" ({stats['shared_calls']} calls overlapping other threads, "
+                      f"process-wide peak {stats['process_peak_memory_mb']}MB)")
+        print(f"    {name}: {stats['seconds']}s in {stats['calls']} calls, "
+              f"peak {stats['peak_memory_mb']}MB{shared}")
+    for name, stats in result["latencies"].items():
+        print(f"    {name}: p50 {stats['p50_ms']}ms, p99 {stats['p99_ms']}ms over {stats['count']}")
+
+    with open(path, 'w') as out_file:
+        json.dump(result, out_file, indent=4)
+    print(f"Saved profile in {path}")
+
+    return result
+
+
+"""
+    prints a summary of the report and saves it as json in path
+"""
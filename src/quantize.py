@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+import utils
+from evaluate import load_test_set, output_sizes, select_output
+from inference import (TFLiteModel, backend_path, fused_model_path, load_model, model_paths,
+                       ordered_outputs, predict_batched, scales, warm_up)
+
+
+def quantize_model(model_path, calibration_windows, out_name):
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_saved_model(model_path)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    # the ranges of the activations are measured on real segments, one at a time
+    def representative_dataset():
+        for window in calibration_windows:
+            yield [np.expand_dims(window.astype(np.float32), axis=(0, -1))]
+
+    converter.representative_dataset = representative_dataset
+
+    # weights and activations in int8, the model still takes and
+    # returns float32 like the other backends
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    with open(out_name, 'wb') as out_file:
+        out_file.write(converter.convert())
+
+    return out_name
+
+
+"""
+    converts the keras SavedModel in model_path to a tflite model with int8 weights and activations,
+    calibrated on calibration_windows (uint8 array of shape (n, 128, 256)), and saves it in out_name
+"""
+
+
+def timed_outputs(model, windows, batch_size):
+    warm_up(model, min(batch_size, len(windows)))
+
+    start = time.perf_counter()
+    outputs = predict_batched(model, windows, batch_size)
+    elapsed = time.perf_counter() - start
+
+    return ordered_outputs(outputs), round(len(windows) / elapsed, 1)
+
+
+"""
+    returns the outputs of the model over the windows, sorted by number
+    of classes, and the images per second
+"""
+
+
+def compare_models(float_model, int8_model, dataset, indexes, batch_size=256):
+    windows = dataset[indexes]
+    float_outputs, float_speed = timed_outputs(float_model, windows, batch_size)
+    int8_outputs, int8_speed = timed_outputs(int8_model, windows, batch_size)
+
+    # a segment agrees only if every output of the model gives the same label
+    agree = np.ones(len(windows), dtype=bool)
+    for reference, output in zip(float_outputs, int8_outputs):
+        agree &= np.argmax(reference, axis=-1) == np.argmax(output, axis=-1)
+
+    result = {
+        "segments": len(windows),
+        "agreement": round(float(np.mean(agree)), 4),
+        "float_images_per_second": float_speed,
+        "int8_images_per_second": int8_speed
+    }
+
+    # accuracy of both models on the output that fits the labels of the reference set
+    selected = select_output(float_model, dataset, indexes)
+    if selected is not None:
+        output, test_indexes, classes, class_names = selected
+        positions = np.searchsorted(indexes, test_indexes)
+        n_classes = output_sizes(float_model)[output]
+
+        accuracies = []
+        for outputs in [float_outputs, int8_outputs]:
+            predictions = [np.argmax(prediction, axis=-1) for prediction in outputs
+                           if prediction.shape[-1] == n_classes][0]
+            accuracies.append(float(np.mean(predictions[positions] == classes)))
+
+        result.update({
+            "accuracy_segments": len(test_indexes),
+            "float_accuracy": round(accuracies[0], 4),
+            "int8_accuracy": round(accuracies[1], 4),
+            "accuracy_delta": round(accuracies[1] - accuracies[0], 4)
+        })
+
+    return result
+
+
+"""
+    runs the float and the int8 model over the segments of the
+    dataset with the given (sorted) indexes
+    returns the fraction of segments that get the same labels from both, their images per
+    second, and the accuracy of both models and its difference, when the labels of the dataset
+    fit the model (see evaluate.select_output)
+"""
+
+
+if __name__ == "__main__":
+    script_path = utils.get_script_path()
+    models_path = os.path.dirname(script_path) + "/models/"
+
+    parser = argparse.ArgumentParser(
+        description="""Quantize the classifiers of a scale in models/ to int8 tflite
+        models, calibrated on real segments, and save only those that agree enough with the
+        float models on a reference set.""")
+
+    # required argument: segments for calibration and reference
+    parser.add_argument('-i', '--input', type=str,
+                        help="""Labelled segments of the scale (128x256): a folder with a subfolder
+                        of .png segments for each label, a split manifest (.txt) written by
+                        split.py, or a folder of shards written by dataset.py or extract.py
+                        --shards. A random sample calibrates the int8 models, another one is the
+                        reference set on which they are compared with the float models.""")
+
+    # required argument: scale of the classifiers
+    parser.add_argument('-s', '--scale', type=str,
+                        help="""Scale of the classifiers to quantize, the same as the one of the
+                        segments: 'log', 'mel' or 'lin'.""")
+
+    # optional argument: folder containing the models
+    parser.add_argument('-m', '--models', type=str, default=models_path,
+                        help="""Folder containing the SavedModel folders. Default is
+                        the models/ folder of the project.""")
+
+    # optional argument: indexes of the segments to use
+    parser.add_argument('--indexes', type=str, default=None,
+                        help="""For a folder of shards, .npy file with the indexes
+                        of the segments to sample from.""")
+
+    # optional argument: size of the samples
+    parser.add_argument('-n', '--calibration-size', nargs='?', type=int, default=500,
+                        help="How many segments to calibrate the int8 models on. Default is 500.")
+    parser.add_argument('-r', '--reference-size', nargs='?', type=int, default=2000,
+                        help="""How many other segments to compare the int8 and the
+                        float models on. Default is 2000.""")
+
+    # optional argument: minimum agreement with the float models
+    parser.add_argument('--min-agreement', nargs='?', type=float, default=0.99,
+                        help="""Minimum fraction of the reference segments on which the
+                        int8 model must give the same labels as the float model, otherwise
+                        it is not saved. Default is 0.99.""")
+
+    # optional argument: quantize the fused models too
+    parser.add_argument('--fused', action='store_true',
+                        help="""Also quantize the models that fuse the two classifiers of
+                        each scale, created with fuse.py.""")
+
+    # optional argument: seed
+    parser.add_argument('--seed', nargs='?', type=int, default=2023,
+                        help="Seed used to sample the segments. Default is 2023.")
+
+    # optional arguments: batch size
+    parser.add_argument('-b', '--batch', nargs='?', type=int, default=256,
+                        help="""How many segments to classify in a single
+                        call to the models. Default is 256.""")
+
+    args = parser.parse_args()
+
+    models_path = args.models
+    if not models_path.endswith("/"):
+        models_path = models_path + "/"
+
+    if args.input is None or not os.path.exists(args.input):
+        print(f"{args.input} is not a folder or a manifest. See quantize.py -h for information.")
+        sys.exit(1)
+
+    if args.scale not in scales:
+        print(f"{args.scale} is not a valid scale option, see quantize.py -h for help. "
+              f"Exiting program")
+        sys.exit(1)
+
+    model_list = list(model_paths(models_path, args.scale))
+    if args.fused:
+        model_list.append(fused_model_path(models_path, args.scale))
+    for model_path in model_list:
+        if not os.path.isdir(model_path):
+            print(f"{model_path} doesn't exist. Exiting program.")
+            sys.exit(1)
+
+    # two disjoint random samples of the segments: one to calibrate, one to compare the models on
+    dataset, indexes = load_test_set(args.input, args.indexes)
+    if len(indexes) <= args.calibration_size:
+        print(f"{args.input} has {len(indexes)} segments, more than the calibration size are "
+              f"needed. Exiting program.")
+        sys.exit(1)
+    indexes = np.random.default_rng(args.seed).permutation(indexes)
+    calibration_windows = dataset[np.sort(indexes[:args.calibration_size])]
+    reference_indexes = np.sort(
+        indexes[args.calibration_size:args.calibration_size + args.reference_size])
+    print(f"Calibrating on {len(calibration_windows)} segments, "
+          f"comparing on {len(reference_indexes)}")
+
+    # results of the previous runs are kept, those of the models quantized now are replaced
+    report_name = models_path + "quantization.json"
+    report = {}
+    if os.path.isfile(report_name):
+        with open(report_name) as report_file:
+            report = json.load(report_file)
+
+    passed = True
+    for model_path in model_list:
+        out_name = backend_path(model_path, 'tflite-int8')
+
+        # the model is written under a temporary name, and kept only if
+        # it agrees enough with the float one
+        tmp_name = out_name + ".tmp"
+        quantize_model(model_path, calibration_windows, tmp_name)
+        result = compare_models(load_model(model_path, 'keras'), TFLiteModel(tmp_name),
+                                dataset, reference_indexes, args.batch)
+
+        result["calibration_segments"] = len(calibration_windows)
+        result["saved"] = bool(result["agreement"] >= args.min_agreement)
+        if result["saved"]:
+            os.replace(tmp_name, out_name)
+        else:
+            os.remove(tmp_name)
+            passed = False
+        report[os.path.basename(out_name)] = result
+
+        status = (f"saved in {out_name}" if result["saved"]
+                  else f"not saved, below {args.min_agreement*100:.2f}%")
+        if not result["saved"] and os.path.isfile(out_name):
+            status += f" ({out_name} of a previous run is still there)"
+        print(f"{model_path}: int8 agrees with float on {result['agreement']*100:.2f}% of "
+              f"{result['segments']} segments, {status}")
+        if "accuracy_delta" in result:
+            print(f"    accuracy {result['float_accuracy']*100:.2f}% -> "
+                  f"{result['int8_accuracy']*100:.2f}% ({result['accuracy_delta']*100:+.2f}%) "
+                  f"on {result['accuracy_segments']} segments")
+        print(f"    {result['float_images_per_second']} -> "
+              f"{result['int8_images_per_second']} images/s")
+
+    with open(report_name, 'w') as report_file:
+        json.dump(report, report_file, indent=4)
+    print(f"Saved report in {report_name}")
+
+    if not passed:
+        print("Some int8 models don't agree enough with the float ones and were not saved.")
+        sys.exit(1)
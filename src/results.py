@@ -0,0 +1,161 @@
+import csv
+import json
+import numpy as np
+
+import profiling
+from inference import speedup_dict
+
+# formats in which the results of each channel can be saved, next to the text log
+result_formats = ['jsonl', 'csv']
+
+# columns of the csv file
+csv_fields = ["type", "channel", "start", "end", "speedup",
+              "windows", "confidence", "agreement", "first_segment", "last_segment"]
+
+
+def detection_line(j, speedup_label, duration, width, step):
+    timestamp = round(duration * (j * step) / width, 2)
+
+    return f"Segment {j}, time: {str(timestamp)}s, speedup: {speedup_dict[speedup_label]}"
+
+
+def transition_line(column, speedup_label, starts, duration, width):
+    timestamp = round(duration * column / width, 2)
+    kind = "Irregularity starts" if starts else "Irregularity ends"
+
+    return f"{kind}, time: {str(timestamp)}s, speedup: {speedup_dict[speedup_label]}"
+
+
+"""
+    lines of the text log, for a flagged window and for a transition located by the adaptive scan
+"""
+
+
+def merge_events(detections, duration, width, step, window_width, offset=0):
+    events = []
+    group = []
+
+    def close(group):
+        windows = np.array([j for j, label, score in group])
+        labels = np.array([label for j, label, score in group])
+        scores = np.array([score for j, label, score in group])
+
+        # majority speedup of the windows of the event, and how many of them agree with it
+        counts = np.bincount(labels, minlength=len(speedup_dict))
+        majority = int(np.argmax(counts))
+
+        start = offset + windows[0]*step
+        end = min(width, offset + windows[-1]*step + window_width)
+        events.append({
+            "type": "event",
+            "start": round(duration * start / width, 2),
+            "end": round(duration * end / width, 2),
+            "speedup": speedup_dict[majority],
+            "windows": len(windows),
+            "confidence": round(float(np.mean(scores)), 3),
+            "agreement": round(counts[majority] / len(windows), 3),
+            "first_segment": int(windows[0]),
+            "last_segment": int(windows[-1])
+        })
+
+    # flagged windows that overlap belong to the same event
+    for detection in sorted(detections, key=lambda detection: detection[0]):
+        if len(group) > 0 and (detection[0] - group[-1][0])*step >= window_width:
+            close(group)
+            group = []
+        group.append(detection)
+
+    if len(group) > 0:
+        close(group)
+
+    return events
+
+
+"""
+    detections: list of (window index, speedup label, probability of being irregular) of the flagged windows
+    returns a list of events, one for each group of overlapping flagged windows, with their start and end time in
+    seconds, the majority speedup, the mean probability of being irregular of their windows (confidence) and the
+    fraction of windows that agree with the majority speedup (agreement)
+"""
+
+
+class ChannelResults:
+    def __init__(self, log_filename, channel, duration, width, step, window_width, offset=0):
+        self.log_filename = log_filename
+        self.channel = channel
+        self.duration = duration
+        self.width = width
+        self.step = step
+        self.window_width = window_width
+        self.offset = offset
+
+        self.detections = []
+        self.transitions = []
+
+    def add(self, detections, echo=True):
+        if echo:
+            for j, speedup_label, score in detections:
+                print(detection_line(j, speedup_label,
+                      self.duration, self.width, self.step))
+        self.detections += detections
+
+    def add_transitions(self, transitions):
+        for column, speedup_label, starts in transitions:
+            print(transition_line(column, speedup_label,
+                  starts, self.duration, self.width))
+        self.transitions += transitions
+
+    def records(self):
+        records = merge_events(self.detections, self.duration, self.width, self.step,
+                               self.window_width, self.offset)
+
+        for column, speedup_label, starts in self.transitions:
+            timestamp = round(self.duration * column / self.width, 2)
+            records.append({
+                "type": "start" if starts else "end",
+                "start": timestamp,
+                "end": timestamp,
+                "speedup": speedup_dict[speedup_label]
+            })
+
+        for record in records:
+            record["channel"] = self.channel
+
+        return sorted(records, key=lambda record: record["start"])
+
+    def write(self, result_format='jsonl'):
+        with profiling.stage("log I/O"):
+            return self.write_files(result_format)
+
+    def write_files(self, result_format):
+        # text log, in a single write
+        lines = [detection_line(j, speedup_label, self.duration, self.width, self.step) + "\n"
+                 for j, speedup_label, score in sorted(self.detections, key=lambda detection: detection[0])]
+        lines += [transition_line(column, speedup_label, starts, self.duration, self.width) + "\n"
+                  for column, speedup_label, starts in self.transitions]
+
+        with open(self.log_filename, 'a') as log_file:
+            log_file.writelines(lines)
+
+        # structured results: the merged events (and the transitions of the adaptive scan)
+        records = self.records()
+        out_name = self.log_filename[:-4] + "." + result_format
+
+        with open(out_name, 'w', newline='') as out_file:
+            if result_format == 'csv':
+                writer = csv.DictWriter(
+                    out_file, fieldnames=csv_fields, extrasaction='ignore')
+                writer.writeheader()
+                writer.writerows(records)
+            else:
+                for record in records:
+                    out_file.write(json.dumps(record) + "\n")
+
+        return records
+
+
+"""
+    gathers the results of a channel in memory and writes them once, when the channel is done
+    add() prints the detections as they arrive (unless echo is False), write() appends them to the text log and saves
+    the merged events in a .jsonl (one json object per line) or .csv file with the same name as the log
+"""
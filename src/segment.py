@@ -2,9 +2,6 @@ import os
 import sys
 import numpy as np
 import argparse
-import subprocess
-import librosa
-import cv2 as cv
 
 import utils
 import vision
@@ -0,0 +1,220 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import utils
+from inference import (FusedClassifier, MicroBatcher, WindowClassifier, backends, fused_model_path, load_model,
+                       model_paths, scales, speedup_dict)
+from main import scan_spectrogram, scan_stream
+from results import merge_events
+from spectrogram import engines
+from wav2spec import compute_spectrogram, stream_spectrogram
+
+
+def load_batchers(models_path, batch_size, max_wait, backend='keras', fused=False):
+    # keep the classifiers of every scale loaded, each one behind its own batcher
+    batchers = {}
+    for scale in scales:
+        if fused:
+            batchers[scale] = (MicroBatcher(load_model(fused_model_path(
+                models_path, scale), backend), batch_size, max_wait),)
+            print(f"Loaded fused model for scale '{scale}'")
+            continue
+
+        binary_model_path, four_classes_model_path = model_paths(
+            models_path, scale)
+        batchers[scale] = (MicroBatcher(load_model(binary_model_path, backend), batch_size, max_wait),
+                           MicroBatcher(load_model(four_classes_model_path, backend), batch_size, max_wait))
+        print(f"Loaded models for scale '{scale}'")
+
+    return batchers
+
+
+"""
+    returns a dictionary with, for each scale, the micro-batchers of the binary and of the 4-class classifier
+    (or only the one of the fused model, if fused is set)
+"""
+
+
+def analyze_job(job, batchers, batch_size, engine='sox'):
+    sample = job["input"]
+    scale = job.get("scale", "lin")
+    width_res = int(job.get("width", 256))
+    step = int(job.get("jump", 64))
+    window_width = 256
+
+    if not sample.endswith(".wav") or not os.path.isfile(sample):
+        raise ValueError(f"{sample} is not a .wav file")
+    if scale not in scales:
+        raise ValueError(f"{scale} is not a valid scale")
+
+    if len(batchers[scale]) == 1:
+        classifier = FusedClassifier(batchers[scale][0], batch_size=batch_size)
+    else:
+        classifier = WindowClassifier(*batchers[scale], batch_size=batch_size)
+
+    fs, data = utils.load_audio(sample)
+    duration = round(data.shape[0] / fs, 2)
+    width = int(duration*width_res)
+    result = {"filename": sample, "duration": duration, "channels": []}
+
+    for i in range(0, data.shape[1]):
+        detections = []
+        if width >= window_width:
+            if job.get("stream", False):
+                chunks = stream_spectrogram(
+                    data[:, i], fs, scale, width, int(job.get("chunk", 60))*width_res, engine)
+                for chunk_detections in scan_stream(chunks, classifier, width, step, window_width):
+                    detections += chunk_detections
+            else:
+                spectrum = compute_spectrogram(data[:, i], fs, scale, width, engine)
+                detections = scan_spectrogram(
+                    spectrum, classifier, step, window_width)
+
+        result["channels"].append({
+            "channel": i,
+            "detections": [{"segment": int(j),
+                            "time": round(duration * (j * step) / width, 2),
+                            "speedup": speedup_dict[speedup_label]} for j, speedup_label, score in detections],
+            "events": merge_events(detections, duration, width, step, window_width)
+        })
+
+    return result
+
+
+"""
+    job: dictionary with the same parameters as main.py: 'input', 'scale', 'width', 'jump' and optionally 'stream',
+    'chunk'
+    returns the irregularities found in each channel, the windows of concurrent jobs are classified in shared batches
+"""
+
+
+class AnalyzerHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_json(404, {"error": f"{self.path} not found"})
+            return
+
+        self.send_json(200, {"status": "ok", "scales": scales})
+
+    def do_POST(self):
+        if self.path != "/analyze":
+            self.send_json(404, {"error": f"{self.path} not found"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = json.loads(self.rfile.read(length))
+            result = analyze_job(
+                job, self.server.batchers, self.server.batch_size, self.server.engine)
+        except (ValueError, KeyError, TypeError, AttributeError, OSError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            # any other error comes from the models, raised again by the future of the batcher
+            self.log_error("analysis failed: %r", e)
+            self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+
+        self.send_json(200, result)
+
+    def send_json(self, code, body):
+        body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # clients of a unix socket have no address
+        if not self.client_address:
+            return "unix"
+
+        return self.client_address[0]
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    script_path = utils.get_script_path()
+    models_path = os.path.dirname(script_path) + "/models/"
+
+    parser = argparse.ArgumentParser(
+        description="""Keep the classifiers of every scale loaded and analyze the audio samples
+        posted as JSON jobs to /analyze, classifying the windows of concurrent jobs together.""")
+
+    # optional arguments: unix socket to listen on
+    parser.add_argument('--socket', type=str, default=None,
+                        help="Path of the unix socket to listen on. If not set, listen on localhost instead.")
+
+    # optional arguments: port to listen on
+    parser.add_argument('-p', '--port', nargs='?', type=int, default=8765,
+                        help="Port to listen on, on localhost. Default is 8765.")
+
+    # optional arguments: batch size for the classifiers
+    parser.add_argument('-b', '--batch', nargs='?', type=int, default=256,
+                        help="How many windows to classify in a single call to the models. Default is 256.")
+
+    # optional arguments: how long to wait for other jobs before running a batch
+    parser.add_argument('--wait', nargs='?', type=float, default=5,
+                        help="""How many milliseconds to wait for windows of other jobs before running an incomplete
+                        batch. Default is 5.""")
+
+    # optional arguments: inference backend
+    parser.add_argument('--backend', type=str, default='keras',
+                        help="""Which runtime to use for the classifiers: 'keras', 'tflite', 'onnx' or 'tflite-int8'.
+                        Default is 'keras'.""")
+
+    # optional arguments: spectrogram engine
+    parser.add_argument('--engine', type=str, default='sox',
+                        help="""What computes the 'lin' and 'log' spectrograms: 'sox' or 'numpy', as in
+                        main.py. Default is 'sox'.""")
+
+    # optional arguments: fused models
+    parser.add_argument('--fused', action='store_true',
+                        help="Use the models that fuse the two classifiers of each scale, created with fuse.py.")
+
+    args = parser.parse_args()
+
+    if args.backend not in backends:
+        print(f"{args.backend} is not a valid backend. See server.py -h for information.")
+        sys.exit(1)
+
+    if args.engine not in engines:
+        print(f"{args.engine} is not a valid engine. See server.py -h for information.")
+        sys.exit(1)
+
+    if args.engine == 'sox' and shutil.which('sox') is None:
+        print("sox is not on the PATH, use --engine numpy or install sox-extended. Exiting program.")
+        sys.exit(1)
+
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = UnixHTTPServer(args.socket, AnalyzerHandler)
+        address = args.socket
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", args.port), AnalyzerHandler)
+        address = f"127.0.0.1:{args.port}"
+
+    server.batch_size = args.batch
+    server.engine = args.engine
+    server.batchers = load_batchers(
+        models_path, args.batch, args.wait / 1000, args.backend, args.fused)
+
+    print(f"Listening on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.unlink(args.socket)
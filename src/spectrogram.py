@@ -0,0 +1,343 @@
+import os
+import functools
+import subprocess
+import numpy as np
+
+
+# settings of the sox invocation the models were trained on: -y 128 -R 0:20k, default -z 120 and -q 249
+SPEC_HEIGHT = 128
+FMAX = 20000
+DYN_RANGE = 120
+SPECTRUM_POINTS = 249
+
+# engines of the lin and log spectrograms: the sox binary the models were trained on, or the in-process model of
+# it below, which is to be preferred only once parity.py passes on reference spectrograms
+engines = ['sox', 'numpy']
+
+# highest resolution sox accepts for the x-axis, in pixels/s
+MAX_PIXELS_PER_SEC = 5000
+
+# how many samples to frame at once, bounds the temporary memory of a call
+FRAME_BLOCK = 2**22
+
+# length of the dft of the mel spectrogram, as librosa computed it with hop_length=512 for the models
+MEL_FFT = 2048
+
+# how many columns of the mel spectrogram to compute at once, few enough for the frames to stay in cache
+MEL_BLOCK = 256
+
+
+def pcm_to_float(data):
+    if data.dtype == np.uint8:
+        return (data.astype(np.float32) - 128) / 128
+    if np.issubdtype(data.dtype, np.integer):
+        return data.astype(np.float32) / float(np.iinfo(data.dtype).max + 1)
+
+    return data.astype(np.float32, copy=False)
+
+
+"""
+    converts pcm samples as returned by scipy.io.wavfile.read to float32 in [-1, 1)
+"""
+
+
+def dft_size(sr, fmax=FMAX, height=SPEC_HEIGHT):
+    # sox: -y gives the number of bins, the dft has 2*(y - 1) points and its bins go from 0 to nyquist.
+    # With -R 0:fmax of sox-extended, the dft is assumed to be scaled so that the y bins go from 0 to fmax
+    # instead
+    return int(round(2 * (height - 1) * max(1, sr / 2 / fmax)))
+
+
+"""
+    returns the length of the dft used for the lin and log spectrograms
+"""
+
+
+def row_bins(sr, n_fft, height=SPEC_HEIGHT, fmax=FMAX, log=False):
+    if not log:
+        return np.arange(0, height)
+
+    # -L of sox-extended, assumed: rows spaced geometrically from the first bin above dc to fmax, each showing
+    # the nearest bin of the same dft
+    freqs = np.geomspace(sr / n_fft, min(fmax, sr / 2), height)
+
+    return np.minimum(np.round(freqs * n_fft / sr).astype(np.int64), n_fft//2)
+
+
+"""
+    returns the dft bin shown by each row of the spectrogram, from the bottom to the top
+    sox itself shows one bin per row; the mapping of -R and -L is not taken from the sox-extended source, check
+    it against spectrograms made by sox with parity.py
+"""
+
+
+@functools.lru_cache(maxsize=64)
+def sox_window(n_fft, end=0):
+    # make_window() in spectrogram.c: a hann window over the 1 + n_fft - |end| points that hold samples,
+    # shifted by end points if end > 0 (start of the input) and truncated if end < 0 (end of the input)
+    n = 1 + n_fft - abs(end)
+    window = np.zeros(n_fft + 1)
+    window[max(end, 0):max(end, 0) + n] = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(0, n) / (n - 1))
+    window = window[:n_fft]
+
+    # a full scale sine is at 0dBFS, with the empirical adjustment of sox for the shorter windows
+    return (window * 2 / np.sum(window) * (n / n_fft)**2).astype(np.float32)
+
+
+"""
+    returns the window applied to the frames of the spectrogram, n_fft points long
+"""
+
+
+def pixels_per_second(sr, width, n_samples):
+    # sox -x: the resolution that fits the whole input in width columns
+    return min(MAX_PIXELS_PER_SEC, width / (n_samples / sr))
+
+
+def sox_geometry(sr, n_fft, pixels_per_sec):
+    # start() in spectrogram.c: the hop is about the number of points of the window (whose sum is n_fft/2), and
+    # each column averages the power of block_steps dfts
+    step = int(n_fft / 2 + .5)
+    block_steps = int(sr / pixels_per_sec)
+    step = int(block_steps / np.ceil(block_steps / step))
+    block_steps = block_steps // step
+
+    # the first frame starts (n_fft - step)/2 samples before the input, in zeros (c integer division)
+    first = -(n_fft - step + int((step - n_fft) / 2))
+
+    return step, block_steps, first
+
+
+"""
+    returns the hop between two frames, the number of frames of each column and the first sample of the first
+    frame
+    the columns are step*block_steps samples apart, which is a bit less than sr/pixels_per_sec: sox drops the
+    columns beyond the width of the image
+"""
+
+
+def frame_count(n_samples, n_fft, step, first):
+    # drain() in spectrogram.c: at the end of the input, zeros are fed up to about half a frame past it
+    # samples read since the last frame, frame 0 ends at first + n_fft
+    read = n_samples - first - n_fft
+    read = read % step if read >= 0 else read + step
+    padding = (n_fft - step) // 2
+    left_over = (padding + read) % step
+    if left_over >= step >> 1:
+        padding += step - left_over
+
+    return max(0, (n_samples + padding - n_fft - first) // step + 1)
+
+
+"""
+    returns how many frames sox computes over an input of n_samples samples
+"""
+
+
+def gray_levels(db, dyn_range=DYN_RANGE, points=SPECTRUM_POINTS):
+    # colour() in spectrogram.c: level 0 below -dyn_range dBFS, the last one at 0dBFS and above
+    with np.errstate(invalid='ignore'):
+        levels = (1 + (1 + db / dyn_range) * (points - 2)).astype(np.int64)
+    levels[db < -dyn_range] = 0
+    levels[db >= 0] = points - 1
+
+    # make_palette() with -m, gray levels from black to white
+    palette = (0.5 + 255 * np.arange(0, points) / (points - 1)).astype(np.uint8)
+
+    return palette[levels]
+
+
+"""
+    maps the power of the bins, in dBFS, to the gray levels of a monochrome sox spectrogram
+"""
+
+
+def frame_signal(y, centers, n_fft):
+    n_samples = len(y)
+    starts = np.round(centers).astype(np.int64) - n_fft//2
+    low, high = starts[0], starts[-1] + n_fft
+
+    # convert only the samples covered by the frames, padding with zeros outside of the signal
+    block = np.zeros(high - low, dtype=np.float32)
+    block[max(0, -low):min(high, n_samples) - low] = pcm_to_float(
+        y[max(0, low):min(high, n_samples)])
+
+    return np.lib.stride_tricks.sliding_window_view(block, n_fft)[starts - low]
+
+
+"""
+    y: 1-D array of samples, it can be a strided view (e.g. a channel of a memory-mapped file)
+    returns an array of shape (len(centers), n_fft) with the frames centered on the given samples
+"""
+
+
+def column_centers(n_samples, width, start, stop):
+    return (np.arange(start, stop) + 0.5) * n_samples / width
+
+
+"""
+    returns the sample on which columns [start, stop) of a spectrogram width pixels wide are centered
+"""
+
+
+def spectrogram_columns(y, sr, width, start, stop, log=False, height=SPEC_HEIGHT, fmax=FMAX, dyn_range=DYN_RANGE,
+                        n_samples=None, first_sample=0, pixels_per_sec=None):
+    import scipy.fft
+
+    if n_samples is None:
+        n_samples = first_sample + len(y)
+    if pixels_per_sec is None:
+        pixels_per_sec = pixels_per_second(sr, width, n_samples)
+
+    n_fft = dft_size(sr, fmax, height)
+    step, block_steps, first = sox_geometry(sr, n_fft, pixels_per_sec)
+    n_frames = frame_count(n_samples, n_fft, step, first)
+    rows = row_bins(sr, n_fft, height, fmax, log)
+    window = sox_window(n_fft)
+
+    # columns without frames (past the end of a short input) are left black
+    img = np.zeros((height, stop - start), dtype=np.uint8)
+    block = max(1, FRAME_BLOCK // (n_fft * block_steps))
+
+    for c in range(start, min(stop, -(-n_frames // block_steps)), block):
+        frame_indexes = np.arange(c * block_steps, min((c + block) * block_steps, stop * block_steps, n_frames))
+        starts = first + frame_indexes * step
+        frames = frame_signal(y, starts + n_fft//2 - first_sample, n_fft)
+
+        # the frames that cross the start or the end of the input get a shorter window, over their samples only
+        edges = np.flatnonzero((starts < 0) | (starts + n_fft > n_samples))
+        edge_frames = frames[edges]
+        frames *= window
+        for k, edge_start, edge_frame in zip(edges, starts[edges], edge_frames):
+            end = n_samples - edge_start - n_fft if edge_start + n_fft > n_samples else -edge_start
+            frames[k] = edge_frame * sox_window(n_fft, int(end))
+
+        spectrum = scipy.fft.rfft(frames, axis=1)[:, rows]
+        power = spectrum.real**2 + spectrum.imag**2
+
+        # mean power of the frames of each column, the last one can have fewer of them
+        column_starts = np.arange(0, len(frame_indexes), block_steps)
+        power = np.add.reduceat(power, column_starts, axis=0)
+        power /= np.diff(np.append(column_starts, len(frame_indexes)))[:, np.newaxis]
+
+        with np.errstate(divide='ignore'):
+            db = 10 * np.log10(power)
+        # low frequencies at the bottom
+        img[:, c - start:c - start + len(column_starts)] = gray_levels(db, dyn_range).T[::-1]
+
+    return img
+
+
+"""
+    lin and log spectrogram, modelled on the spectrogram effect of sox 14.4.2 (src/spectrogram.c) as invoked by
+    'sox -n spectrogram -y height -x width -r -m -R 0:fmax' (-L if log is set) of sox-extended: hann window of
+    dft_size() points, frames every step samples, step*block_steps samples per column averaging the power of its
+    frames, gray levels of the monochrome palette. See row_bins() for the parts that are assumptions
+    computes only the columns in [start, stop) of the spectrogram, width is the width of the full image
+    y can also be only a part of the signal, starting at its sample first_sample: n_samples is then the length of
+    the whole signal (or of the part received so far, for a signal that is still growing, with the resolution
+    given by pixels_per_sec since width is not known yet)
+    returns a grayscale uint8 image of shape (height, stop - start)
+"""
+
+
+def sox_spectrogram(y, sr, width, log=False, height=SPEC_HEIGHT, fmax=FMAX, dyn_range=DYN_RANGE):
+    return spectrogram_columns(y, sr, width, 0, width, log=log, height=height, fmax=fmax, dyn_range=dyn_range)
+
+
+"""
+    returns the whole spectrogram of the 1-D signal y as a grayscale uint8 image of shape (height, width)
+"""
+
+
+def sox_command(sample, width, out_name, log=False, height=SPEC_HEIGHT, fmax=FMAX):
+    command = ['sox', sample, '-n', 'spectrogram', '-y', str(height), '-x', str(width), '-r', '-m']
+    if log:
+        command.append('-L')
+
+    return command + ['-R', f'0:{fmax // 1000}k', '-o', out_name]
+
+
+"""
+    returns the command the spectrograms of the training set were made with, -R and -L need sox-extended
+"""
+
+
+def run_sox(y, sr, width, log=False, height=SPEC_HEIGHT, fmax=FMAX):
+    import tempfile
+    import cv2 as cv
+    import scipy.io.wavfile
+
+    # sox only reads files: write the channel to a temporary .wav, in its own sample format
+    with tempfile.TemporaryDirectory() as tmp_path:
+        wav_name = os.path.join(tmp_path, "channel.wav")
+        png_name = os.path.join(tmp_path, "channel.png")
+        scipy.io.wavfile.write(wav_name, sr, np.ascontiguousarray(y))
+
+        if subprocess.call(sox_command(wav_name, width, png_name, log, height, fmax)) != 0:
+            raise RuntimeError("sox failed, check that sox-extended is on the PATH")
+
+        return cv.imread(png_name, cv.IMREAD_GRAYSCALE)
+
+
+"""
+    lin and log spectrogram made by sox itself, as the spectrograms of the training set
+    returns the whole spectrogram of the 1-D signal y as a grayscale uint8 image of shape (height, width)
+"""
+
+
+@functools.lru_cache(maxsize=8)
+def mel_filterbank(sr, n_fft, n_mels, fmax):
+    import librosa
+    import scipy.sparse
+
+    filterbank = librosa.filters.mel(
+        sr=sr, n_fft=n_fft, n_mels=n_mels, fmax=fmax).astype(np.float32)
+
+    # the filters are narrow and end at fmax, keep only the bins up to the last one they use
+    n_bins = np.flatnonzero(filterbank.any(axis=0))[-1] + 1
+
+    return scipy.sparse.csr_matrix(filterbank[:, :n_bins])
+
+
+"""
+    returns the mel filters used by librosa.feature.melspectrogram, as a sparse (n_mels, n_bins) matrix over the first
+    n_bins bins of the dft
+"""
+
+
+def log_mel_columns(y, sr, width, start, stop, n_mels=SPEC_HEIGHT, n_fft=MEL_FFT, fmax=FMAX):
+    import scipy.fft
+    import scipy.signal
+
+    window = scipy.signal.get_window('hann', n_fft).astype(np.float32)
+    filterbank = mel_filterbank(sr, n_fft, n_mels, fmax)
+    n_bins = filterbank.shape[1]
+
+    mels = np.empty((n_mels, stop - start), dtype=np.float32)
+
+    # one frame per column, centered on it: the hop is the number of samples per pixel, so no resize is needed
+    for c in range(start, stop, MEL_BLOCK):
+        c_end = min(c + MEL_BLOCK, stop)
+        frames = frame_signal(y, column_centers(
+            len(y), width, c, c_end), n_fft)
+        frames *= window
+
+        spectrum = scipy.fft.rfft(frames, axis=1, overwrite_x=True)[:, :n_bins]
+        power = spectrum.real**2
+        power += spectrum.imag**2
+
+        mels[:, c - start:c_end - start] = filterbank @ power.T
+
+    mels += 1e-9  # add small number to avoid log(0)
+    np.log(mels, out=mels)
+
+    return mels
+
+
+"""
+    computes columns [start, stop) of the log-melspectrogram of y, width columns wide in total, in float32
+    the frames are the same as librosa.feature.melspectrogram(n_fft=n_fft, center=True), taken at the center of each
+    column instead of every hop_length samples
+    returns an array of shape (n_mels, stop - start), with the low frequencies in the first row
+"""
@@ -0,0 +1,95 @@
+import os
+import sys
+import argparse
+import numpy as np
+
+import utils
+
+split_names = ['train', 'valid', 'test']
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Divide a dataset in training, validation and test set without copying it: write a manifest of
+        each set (or the indexes of its segments, for a packed dataset), optionally with hardlinked folders.""")
+
+    # required argument: dataset
+    parser.add_argument('-i', '--input', type=str,
+                        help="""Folder containing a subfolder of .png segments for each label, or a folder of
+                        shards created by dataset.py or extract.py --shards""")
+
+    # required argument: output folder
+    parser.add_argument('-o', '--output', type=str,
+                        help="""Folder in which to save train.txt, valid.txt and test.txt (train.npy, valid.npy
+                        and test.npy for a packed dataset). If it doesn't exist, it will be created""")
+
+    # optional arguments: ratios of the split
+    parser.add_argument('-r', '--ratios', nargs=3, type=float, default=[0.7, 0.2, 0.1],
+                        help="""What fraction of the dataset goes into training, validation and testing. Default is
+                        0.7 0.2 0.1.""")
+
+    # optional arguments: seed
+    parser.add_argument('--seed', nargs='?', type=int, default=2023,
+                        help="Seed used to shuffle the dataset. Default is 2023.")
+
+    # optional arguments: create the folders too
+    parser.add_argument('--link', action='store_true',
+                        help="""Also create the train/, valid/ and test/ folders read by flow_from_directory, with
+                        hardlinks to the segments instead of copies""")
+
+    args = parser.parse_args()
+
+    in_path = args.input
+    out_path = args.output
+
+    if in_path is None or not os.path.isdir(in_path):
+        print(f"{in_path} is not a folder. Exiting program.")
+        sys.exit(1)
+
+    if out_path is None:
+        print("No output folder given, see split.py -h for help. Exiting program.")
+        sys.exit(1)
+
+    if np.sum(args.ratios) > 1.0:
+        print("Sum of ratios must be less than 1. Exiting program.")
+        sys.exit(1)
+
+    if not in_path.endswith("/"):
+        in_path = in_path + "/"
+    if not out_path.endswith("/"):
+        out_path = out_path + "/"
+    if not os.path.isdir(out_path):
+        utils.create_folder(out_path)
+
+    # packed dataset: save the indexes of the segments of each set
+    if os.path.isfile(in_path + "index.json"):
+        from dataset import SegmentDataset, split_indexes
+
+        if args.link:
+            print("--link only works with folders of .png segments. Exiting program.")
+            sys.exit(1)
+
+        splits = split_indexes(SegmentDataset(
+            in_path), args.ratios, args.seed)
+        for name, split in zip(split_names, splits):
+            np.save(out_path + name + ".npy", split)
+            print(f"{name}: {len(split)} segments")
+        sys.exit(0)
+
+    # one subfolder per label
+    labels = sorted(label for label in os.listdir(in_path)
+                    if os.path.isdir(in_path + label))
+    in_paths = [in_path + label + "/" for label in labels]
+
+    if len(labels) == 0:
+        print(f"{in_path} doesn't contain any label subfolder. Exiting program.")
+        sys.exit(1)
+
+    if args.link:
+        utils.create_dataset(in_paths, labels, [out_path + name + "/" for name in split_names],
+                             args.ratios, args.seed)
+    else:
+        splits = utils.write_split_manifests(in_paths, labels, [out_path + name + ".txt" for name in split_names],
+                                             args.ratios, args.seed)
+        for name, split in zip(split_names, splits):
+            print(f"{name}: {len(split)} segments")
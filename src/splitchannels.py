@@ -2,26 +2,20 @@ import os
 import sys
 import numpy as np
 import argparse
-import subprocess
-import librosa
-from scipy.io import wavfile
 
 import utils
-import vision
 
 
 def split_channels(sample, out_path):
+    from scipy.io import wavfile
+
     if not out_path.endswith("/"):
         out_path = out_path + "/"
     if not os.path.isdir(out_path):
         utils.create_folder(out_path)
 
-    # read audio sample
-    fs, data = wavfile.read(sample)
-
-    # sample is mono
-    if len(data.shape) == 1:
-        data.shape = (data.shape[0], 1)
+    # read audio sample, memory-mapped
+    fs, data = utils.load_audio(sample)
 
     for i in range(0, data.shape[1]):
         # save audio of channel
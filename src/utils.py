@@ -5,6 +5,8 @@ import shutil
 import math
 import random
 
+import profiling
+
 
 def get_script_path():
     return os.path.dirname(os.path.realpath(sys.argv[0]))
@@ -34,6 +36,30 @@ def create_folder(path, overwrite=True):
             print(f"Substituted folder {path}")
 
 
+def load_audio(sample):
+    from scipy.io import wavfile
+
+    # memory-map the samples so that each channel is read from disk only when used
+    with profiling.stage("decode"):
+        try:
+            fs, data = wavfile.read(sample, mmap=True)
+        except ValueError:
+            # mmap is not supported for every format (e.g. 24-bit), decode it normally
+            fs, data = wavfile.read(sample)
+
+    # sample is mono
+    if len(data.shape) == 1:
+        data = data.reshape(data.shape[0], 1)
+
+    return fs, data
+
+
+"""
+    reads a .wav file once, returns the sample rate and an array of shape (n_frames, n_channels)
+    data[:, i] is a zero-copy view of channel i
+"""
+
+
 def collect_audio_files(path):
     ret_list = []
 
@@ -45,6 +71,26 @@ def collect_audio_files(path):
     return ret_list
 
 
+def read_manifest(path):
+    ret_list = []
+    root = os.path.dirname(os.path.abspath(path))
+
+    with open(path) as manifest:
+        for line in manifest:
+            line = line.strip()
+            # skip empty lines and comments
+            if line == "" or line.startswith("#"):
+                continue
+            ret_list.append(os.path.join(root, line))
+
+    return ret_list
+
+
+"""
+    reads a manifest with one path per line, relative paths are relative to the folder of the manifest
+"""
+
+
 def collect_png_files(path):
     ret_list = []
 
@@ -56,6 +102,100 @@ def collect_png_files(path):
     return ret_list
 
 
+def split_files(files, ratios, seed):
+    # number of elements in each split
+    n_train = math.floor(ratios[0] * len(files))
+    n_valid = math.floor(ratios[1] * len(files))
+
+    # create list of random indexes and shuffle it
+    indexes = list(range(0, len(files)))
+    random.Random(seed).shuffle(indexes)
+
+    train_files = [files[index] for index in indexes[:n_train]]
+    valid_files = [files[index] for index in indexes[n_train:n_train+n_valid]]
+    test_files = [files[index] for index in indexes[n_train+n_valid:]]
+
+    return train_files, valid_files, test_files
+
+
+"""
+    shuffles the files with the given seed and divides them in training, validation and test set
+    ratios: what fraction of the files goes into training and validation, the rest goes into testing
+"""
+
+
+def write_split_manifests(in_paths, labels, out_paths, ratios, seed):
+    if len(ratios) != 3 or len(out_paths) != 3:
+        print("Output configuration is wrong")
+        return
+
+    if np.sum(ratios) > 1.0:
+        print("Sum of ratios must be less than 1")
+        return
+
+    splits = [[], [], []]
+    for label_index, in_path in enumerate(in_paths):
+        label = labels[label_index]
+
+        # only the .png segments, sorted so that the same seed gives the same split on any filesystem
+        files = sorted(f for f in os.listdir(in_path)
+                       if f.endswith('.png') and os.path.isfile(os.path.join(in_path, f)))
+
+        for i, split_files_list in enumerate(split_files(files, ratios, seed)):
+            splits[i] += [(label, os.path.abspath(os.path.join(in_path, f)))
+                          for f in split_files_list]
+
+    for out_path, split in zip(out_paths, splits):
+        root = os.path.dirname(os.path.abspath(out_path))
+        with open(out_path, 'w') as manifest:
+            manifest.write(f"# seed: {seed}, ratios: {' '.join(str(r) for r in ratios)}\n")
+            for label, path in split:
+                manifest.write(label + "\t" + os.path.relpath(path, root) + "\n")
+
+    return splits
+
+
+"""
+    inputs: in_paths  ---> list of paths, where every path corresponds to a different label
+            out_paths ---> paths of the training, validation and test manifests (.txt), in this order
+              ratios  ---> what fraction of the dataset goes into training, validation and testing
+              seed    ---> seed used for randomization
+
+    every line of a manifest is a label and the path of a .png segment, relative to the manifest, separated by a
+    tab; the other files of the folders are left out
+    returns, for each split, the list of (label, path) pairs
+"""
+
+
+def read_split_manifest(path):
+    ret_list = []
+    root = os.path.dirname(os.path.abspath(path))
+
+    with open(path) as manifest:
+        for line in manifest:
+            line = line.strip()
+            # skip empty lines and comments
+            if line == "" or line.startswith("#"):
+                continue
+            label, file_path = line.split("\t", 1)
+            ret_list.append((label, os.path.join(root, file_path)))
+
+    return ret_list
+
+
+"""
+    returns the list of (label, path) pairs of a manifest written by write_split_manifests
+"""
+
+
+def link_file(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # hardlinks only work within the same filesystem
+        shutil.copyfile(src, dst)
+
+
 def create_dataset(in_paths, labels, out_paths, ratios, seed):
     if len(ratios) != 3 or len(out_paths) != 3:
         print("Output configuration is wrong")
@@ -65,49 +205,19 @@ def create_dataset(in_paths, labels, out_paths, ratios, seed):
         print("Sum of ratios must be less than 1")
         return
 
+    # the manifests of the split are saved next to the folders
+    manifests = [out_path.rstrip("/") + ".txt" for out_path in out_paths]
+    splits = write_split_manifests(in_paths, labels, manifests, ratios, seed)
+
     for out_path in out_paths:
         create_folder(out_path)
+        for label in labels:
+            create_folder(out_path + label + "/")
 
-    for label_index, in_path in enumerate(in_paths):
-        label = labels[label_index]
-
-        for (root, dirs, files) in os.walk(in_path, topdown=True):
-            # number of elements in each split
-            n_train = math.floor(ratios[0] * len(files))
-            n_valid = math.floor(ratios[1] * len(files))
-            n_test = len(files) - (n_train + n_valid)
-
-            train_files = []
-            valid_files = []
-            test_files = []
-
-            # create list of random indexes and shuffle it
-            indexes = list(range(0, len(files)))
-            random.Random(seed).shuffle(indexes)
-
-            for j in range(0, len(files)):
-                if j < n_train:
-                    train_files.append(files[indexes[j]])
-                elif n_train <= j < n_train + n_valid:
-                    valid_files.append(files[indexes[j]])
-                else:
-                    test_files.append(files[indexes[j]])
-
-            for i, out_path in enumerate(out_paths):
-                create_folder(out_path + label + "/")
-
-                if i == 0:
-                    for filename in train_files:
-                        shutil.copyfile(in_path + filename,
-                                        out_path + label + "/" + filename)
-                elif i == 1:
-                    for filename in valid_files:
-                        shutil.copyfile(in_path + filename,
-                                        out_path + label + "/" + filename)
-                else:
-                    for filename in test_files:
-                        shutil.copyfile(in_path + filename,
-                                        out_path + label + "/" + filename)
+    # link the files instead of copying them, the folders take no extra space
+    for out_path, split in zip(out_paths, splits):
+        for label, path in split:
+            link_file(path, out_path + label + "/" + os.path.basename(path))
 
 
 """
@@ -116,5 +226,8 @@ def create_dataset(in_paths, labels, out_paths, ratios, seed):
               ratios  ---> what fraction of the dataset goes into training, validation and testing
               seed    ---> seed used for randomization 
 
+    writes the manifests of the split (out_path.txt for each folder), then creates the folders for
+    flow_from_directory with hardlinks to the original files (copies if the files are on another filesystem)
+
               NOTE: this function is only used in the Colab Notebook for now
 """
@@ -1,42 +1,78 @@
-import cv2 as cv
 import numpy as np
 import os
-import utils
-import librosa
-import skimage.io
+import spectrogram
+import profiling
 
+# cv2, librosa and skimage are slow to import, they are imported only by the functions that use them
 
-def mel_spectrogram_image(y, sr, out, hop_length, n_mels, dimensions, save):
-    # use log-melspectrogram
-    mels = librosa.feature.melspectrogram(
-        y=y, sr=sr, n_mels=n_mels, n_fft=hop_length*4, hop_length=hop_length, fmax=20000)
-    mels = np.log(mels + 1e-9)  # add small number to avoid log(0)
 
-    # min-max scale to fit inside 8-bit range
-    img = scale_minmax(mels, 0, 255).astype(np.uint8)
-    img = np.flip(img, axis=0)  # put low frequencies at the bottom in image
-    img = cv.resize(img, dimensions, cv.INTER_LINEAR)
+def mel_spectrogram_image(y, sr, out, n_mels, width, save, n_fft=spectrogram.MEL_FFT):
+    # use log-melspectrogram, one frame for each column of the image
+    mels = spectrogram.log_mel_columns(
+        y, sr, width, 0, width, n_mels=n_mels, n_fft=n_fft)
+
+    # min-max scale to fit inside 8-bit range, with the low frequencies at the bottom in image
+    img = scale_minmax(mels[::-1], mels.min(), mels.max())
 
     # save as PNG and return numpy array
     if save == True:
+        import skimage.io
         skimage.io.imsave(out, img)
 
     return img
 
 
 """
-    extract the spectrogram of an audio sample loaded with librosa.load
+    extract the spectrogram of an audio sample, as float samples, with dimensions (width, n_mels)
+"""
+
+
+def scale_minmax(X, low, high):
+    # in place, X is float32 and can be as large as the whole spectrogram
+    X -= low
+    X *= 255 / (high - low) if high > low else 0
+
+    return X.astype(np.uint8)
+
+
+"""
+    scales X from [low, high] to [0, 255], overwriting it, and returns it as a uint8 image
+"""
+
+
+def mel_bounds(y, sr, width, n_mels, block=8192):
+    low, high = np.inf, -np.inf
+
+    for start in range(0, width, block):
+        mels = spectrogram.log_mel_columns(
+            y, sr, width, start, min(start + block, width), n_mels=n_mels)
+        low, high = min(low, mels.min()), max(high, mels.max())
+
+    return low, high
+
+
+"""
+    returns the minimum and maximum of the log-melspectrogram, computed block by block
 """
 
 
-def scale_minmax(X, min=0.0, max=1.0):
-    X_std = (X - X.min()) / (X.max() - X.min())
-    X_scaled = X_std * (max - min) + min
+def mel_spectrogram_columns(y, sr, width, start, stop, n_mels, bounds):
+    mels = spectrogram.log_mel_columns(
+        y, sr, width, start, stop, n_mels=n_mels)
+
+    # min-max scale with the bounds of the whole spectrogram
+    return scale_minmax(mels[::-1], *bounds)
 
-    return X_scaled
+
+"""
+    computes only columns [start, stop) of the image returned by mel_spectrogram_image
+    bounds: minimum and maximum of the whole log-melspectrogram, as returned by mel_bounds
+"""
 
 
 def highlight_split(img, low_thresh=3, high_thresh=255, h_size=3, v_size=20):
+    import cv2 as cv
+
     # threshold the original image and extract vertical lines using vertical morphological operator
     ret, thresh1 = cv.threshold(img, low_thresh, high_thresh, cv.THRESH_BINARY)
     verticalStructure = cv.getStructuringElement(
@@ -58,24 +94,25 @@ def find_splits(img):
     i = 0
 
     for j in range(0, height-1):
-        # start from the last seen black column if already encountered
-        if len(list_splits) > 1:
-            i = list_splits[-1][-1]
-
-        while (i < width):
-            # found a black pixel: append x coordinate at the end of the ROI
-            if not (img[j][i].any()):
-                start_roi = i
-
-                while (not (img[j][i]).any() and i < width):
-                    i += 1
-
-                end_roi = i
-
-                list_splits.append([start_roi, end_roi])
-                break
-
-            i += 1
+        # black pixels of the rest of the row, starting from the end of the last black band found
+        black = img[j, i:] == 0
+        if black.ndim == 2:
+            black = black.all(axis=1)
+
+        # no black pixel left in the row: stop, unless at least two bands were already found
+        start_roi = np.argmax(black) if len(black) > 0 else 0
+        if len(black) == 0 or not black[start_roi]:
+            if len(list_splits) > 1:
+                continue
+            break
+
+        # the band ends at the first non-black pixel after its start, or at the right edge
+        end_roi = np.argmin(black[start_roi:])
+        if black[start_roi + end_roi]:
+            end_roi = len(black) - start_roi
+
+        list_splits.append([i + int(start_roi), i + int(start_roi + end_roi)])
+        i = list_splits[-1][-1]
 
     return list_splits
 
@@ -86,17 +123,21 @@ def find_splits(img):
 """
 
 
-def divide_half(img, filename, middle, left_path, right_path):
+def divide_half(img, filename, middle, left_path, right_path, save=True):
     height, width = img.shape[:2]
 
     left_roi = img[0:height, 0:middle[0]]
     right_roi = img[0:height, middle[1]:width-1]
 
-    left_filename = left_path + "c_" + filename
-    right_filename = right_path + "w_" + filename
+    if save == True:
+        import cv2 as cv
 
-    cv.imwrite(left_filename, left_roi)
-    cv.imwrite(right_filename, right_roi)
+        left_filename = left_path + "c_" + filename
+        right_filename = right_path + "w_" + filename
+
+        with profiling.stage("png encode"):
+            cv.imwrite(left_filename, left_roi)
+            cv.imwrite(right_filename, right_roi)
 
     return [left_roi, right_roi]
 
@@ -104,36 +145,87 @@ def divide_half(img, filename, middle, left_path, right_path):
 """
     takes in input an image and the middle region and saves the two halfs in separate files
     middle = list of two x coordinates, which mark the start and the end of the middle region
+    returns the two halfs, if save is False they are only returned
 """
 
 
-def segment(img, step, window_width, multiple, offset):
+def count_windows(width, step, window_width, offset=0):
+    if width - offset - window_width <= 0:
+        return 0
+
+    # same windows as scanning i in range(0, width//step) with offset + i*step + window_width < width
+    return min(width//step, (width - offset - window_width - 1)//step + 1)
+
+
+"""
+    returns how many windows of width window_width fit in an image of the given width
+"""
+
+
+def sliding_windows(img, step, window_width, offset=0):
+    height, width = img.shape[:2]
+    n_windows = count_windows(width, step, window_width, offset)
+    shape = (n_windows, height, window_width) + img.shape[2:]
+
+    if n_windows == 0:
+        return np.empty(shape, dtype=img.dtype)
+
+    # strided read-only view over the image, no pixel is copied
+    strides = (step * img.strides[1],) + img.strides
+    return np.lib.stride_tricks.as_strided(img[:, offset:], shape=shape, strides=strides, writeable=False)
+
+
+"""
+    takes in input an image (numpy array) and returns a read-only view of shape (n_windows, height, window_width)
+    window i starts at column offset + i*step
+"""
+
+
+def iter_windows(img, step, window_width, offset=0):
     height, width = img.shape[:2]
-    ret_list = []
 
+    for i in range(0, count_windows(width, step, window_width, offset)):
+        yield i, img[0:height, offset + i*step:offset+(i*step)+window_width]
+
+
+"""
+    lazy variant of sliding_windows, yields the index and the view of each window
+"""
+
+
+def segment(img, step, window_width, multiple, offset):
     if multiple == False:
-        window = img[0:height, offset:offset+window_width]
-        ret_list.append(window)
-    else:
-        for i in range(0, width//step):
-            if offset + i*step + window_width < width:
-                window = img[0:height, offset + i *
-                             step:offset+(i*step)+window_width]
-                ret_list.append(window)
+        return img[np.newaxis, :, offset:offset+window_width]
 
-    return ret_list
+    return sliding_windows(img, step, window_width, offset)
 
 
 """
     takes in input an image (numpy array) and divides it into segments
-    returns a list that contains all the segments
+    returns a read-only view of shape (n_segments, height, window_width) over the image
 
     multiple: boolean value. if set to false, only save the first segment of the image
     offset: how many pixels from the left to use as starting point
 """
 
 
+def write_segments(seg_list, out_path, name):
+    import cv2 as cv
+
+    with profiling.stage("png encode"):
+        for j, seg in enumerate(seg_list):
+            out_name = out_path + name + "_" + str(j) + ".png"
+            cv.imwrite(out_name, seg)
+
+
+"""
+    saves every segment in out_path as name_j.png, with j the index of the segment
+"""
+
+
 def compute_segments(in_paths, out_paths, step, window_width, multiple, offset):
+    import cv2 as cv
+
     if len(in_paths) == 0:
         return
 
@@ -146,15 +238,14 @@ def compute_segments(in_paths, out_paths, step, window_width, multiple, offset):
         for (root, dirs, files) in os.walk(in_path, topdown=True):
             for filename in files:
                 if filename.endswith('.png'):
-                    img = cv.imread(os.path.join(in_path + filename))
+                    # the spectrograms are monochrome, decode them straight to grayscale
+                    with profiling.stage("png decode"):
+                        img = cv.imread(os.path.join(
+                            in_path + filename), cv.IMREAD_GRAYSCALE)
 
                     seg_list = segment(
                         img, step, window_width, multiple, offset)
-                    for j, seg in enumerate(seg_list):
-                        out_name = out_paths[i] + \
-                            filename[0:-4] + "_" + str(j) + ".png"
-                        seg = cv.cvtColor(seg, cv.COLOR_RGB2GRAY)
-                        cv.imwrite(out_name, seg)
+                    write_segments(seg_list, out_paths[i], filename[0:-4])
 
 
 """
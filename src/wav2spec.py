@@ -1,70 +1,110 @@
 import os
 import sys
-import numpy as np
+import shutil
 import argparse
-import subprocess
-import librosa
 
 import utils
 import vision
+import spectrogram
+import profiling
+from cache import CACHE_PATH, CACHE_SIZE, SpectrogramCache, cached_spectrogram
 
 
-def wav2spec(sample, scale, out_path, width_res=256):
+def compute_spectrogram(y, sr, scale, width, engine='sox'):
+    with profiling.stage("spectrogram"):
+        # mel-spec
+        if scale == "mel":
+            return vision.mel_spectrogram_image(y, sr, None, n_mels=128, width=width, save=False)
+
+        # lin-spec and log-spec, made by sox unless the in-process engine is chosen
+        if engine == 'sox':
+            return spectrogram.run_sox(y, sr, width, log=(scale == "log"))
+        return spectrogram.sox_spectrogram(y, sr, width, log=(scale == "log"))
+
+
+"""
+    y: 1-D array of pcm samples of a single channel
+    engine: 'sox' or 'numpy', what computes the 'lin' and 'log' spectrograms (see spectrogram.engines)
+    returns the spectrogram as a grayscale uint8 image of shape (128, width)
+"""
+
+
+def stream_spectrogram(y, sr, scale, width, chunk_width, engine='sox'):
+    # sox can't compute a part of the spectrogram, make it whole and hand it out in chunks
+    if scale != "mel" and engine == 'sox':
+        img = compute_spectrogram(y, sr, scale, width, engine)
+        for start in range(0, width, chunk_width):
+            yield start, img[:, start:start + chunk_width]
+        return
+
+    # the mel spectrogram is min-max scaled, find the bounds of the whole file first
+    if scale == "mel":
+        with profiling.stage("spectrogram"):
+            bounds = vision.mel_bounds(y, sr, width, n_mels=128)
+
+    for start in range(0, width, chunk_width):
+        stop = min(start + chunk_width, width)
+
+        with profiling.stage("spectrogram"):
+            if scale == "mel":
+                chunk = vision.mel_spectrogram_columns(
+                    y, sr, width, start, stop, n_mels=128, bounds=bounds)
+            else:
+                chunk = spectrogram.spectrogram_columns(
+                    y, sr, width, start, stop, log=(scale == "log"))
+        yield start, chunk
+
+
+"""
+    generator variant of compute_spectrogram, computes the spectrogram chunk_width columns at a time
+    (except for the 'lin' and 'log' spectrograms made by sox, which are computed whole)
+    yields the index of the first column of each chunk and the chunk itself
+"""
+
+
+def wav2spec(sample, scale, out_path, width_res=256, save=True, cache=None, engine='sox'):
     if not out_path.endswith("/"):
         out_path = out_path + "/"
-    if not os.path.isdir(out_path):
+    if save and not os.path.isdir(out_path):
         utils.create_folder(out_path)
 
     # create spectrogram's filename
     out_name = sample.split("/")
     out_name = out_path + out_name[-1].split(".")[0] + '.png'
 
-    duration = round(librosa.get_duration(filename=sample), 2)
+    sr, y = utils.load_audio(sample)
+    duration = round(y.shape[0] / sr, 2)
     if duration < 1:
         print(f"file {sample} is too short. Skipping to next one..")
         return
 
-    # mel-spec
-    if scale == "mel":
-        y, sr = librosa.load(sample, sr=None)
+    def compute():
+        # mix multichannel samples down to mono
+        if y.shape[1] == 1:
+            mono = y[:, 0]
+        else:
+            mono = spectrogram.pcm_to_float(y).mean(axis=1)
 
-        vision.mel_spectrogram_image(
-            y, sr, out_name, hop_length=512, n_mels=128, dimensions=(int(duration*width_res), 128), save=True)
+        return compute_spectrogram(mono, sr, scale, int(duration*width_res), engine)
 
-    else:
-        width = str(duration*width_res)
-        height = str(128)
-
-        # lin-spec
-        if scale == "lin":
-            subprocess.call([
-                'sox',
-                sample,
-                '-n', 'spectrogram',
-                '-y', height,
-                '-x', width,
-                '-r',
-                '-m',
-                '-R', '0:20k',
-                '-o', out_name,
-            ])
-
-        # log-spec
-        elif scale == "log":
-            subprocess.call([
-                'sox',
-                sample,
-                '-n', 'spectrogram',
-                '-y', height,
-                '-x', width,
-                '-r',
-                '-m',
-                '-L',
-                '-R', '0:20k',
-                '-o', out_name,
-            ])
-
-    return out_name
+    img = cached_spectrogram(cache, sample, scale, int(
+        duration*width_res), "mix", compute, engine=engine)
+
+    if save == True:
+        import cv2 as cv
+        with profiling.stage("png encode"):
+            cv.imwrite(out_name, img)
+
+    return img
+
+
+"""
+    computes the spectrogram of a .wav file with the given scale ('lin', 'log' or 'mel')
+    if save is set, the spectrogram is also written as a PNG in out_path, with the same name as the sample
+    cache: SpectrogramCache in which to look for the spectrogram before computing it, None to always compute it
+    engine: 'sox' or 'numpy', what computes the 'lin' and 'log' spectrograms
+    returns the spectrogram as a grayscale uint8 image
+"""
 
 
 if __name__ == "__main__":
@@ -90,6 +130,26 @@ if __name__ == "__main__":
     parser.add_argument('-w', '--width', nargs='?', type=int, default=256,
                         help="What resolution to use on the x-axis, in pixels/s. Default is 256.")
 
+    # optional arguments: spectrogram engine
+    parser.add_argument('--engine', type=str, default='sox',
+                        help="""What computes the 'lin' and 'log' spectrograms: 'sox' (sox-extended, which
+                        the models were trained on, must be on the PATH) or 'numpy' (in-process, check it
+                        with parity.py first). Default is 'sox'.""")
+
+    # optional arguments: spectrogram cache
+    parser.add_argument('--cache', type=str, default=CACHE_PATH,
+                        help=f"Folder of the spectrogram cache, shared with main.py. Default is {CACHE_PATH}.")
+
+    # optional arguments: size of the cache
+    parser.add_argument('--cache-size', nargs='?', type=int, default=CACHE_SIZE,
+                        help=f"""Size limit of the spectrogram cache, in MB. 0 disables the cache. Default is
+                        {CACHE_SIZE}.""")
+
+    # optional arguments: profiling
+    parser.add_argument('--profile', nargs='?', type=str, default=None, const="profile.json",
+                        help="""Measure the time, the number of calls and the peak memory of each stage, and save the
+                        report in the given .json file. Default is profile.json""")
+
     args = parser.parse_args()
 
     in_path = args.input
@@ -103,9 +163,23 @@ if __name__ == "__main__":
             f"{scale} is not a valid scale option, see wav2spec.py -h for help. Exiting program")
         sys.exit(1)
 
+    if args.engine not in spectrogram.engines:
+        print(f"{args.engine} is not a valid engine. See wav2spec.py -h for information.")
+        sys.exit(1)
+
+    if args.engine == 'sox' and scale != "mel" and shutil.which('sox') is None:
+        print("sox is not on the PATH, use --engine numpy or install sox-extended. Exiting program.")
+        sys.exit(1)
+
+    cache = SpectrogramCache(
+        args.cache, args.cache_size) if args.cache_size > 0 else None
+
+    if args.profile is not None:
+        profiling.enable()
+
     if in_path.endswith(".wav"):
         wav2spec(sample=in_path, scale=scale,
-                 out_path=out_path, width_res=width_res)
+                 out_path=out_path, width_res=width_res, cache=cache, engine=args.engine)
 
     elif os.path.isdir(in_path):
         sample_list = utils.collect_audio_files(in_path)
@@ -116,8 +190,11 @@ if __name__ == "__main__":
 
         for sample in sample_list:
             wav2spec(sample=sample, scale=scale,
-                     out_path=out_path, width_res=width_res)
+                     out_path=out_path, width_res=width_res, cache=cache, engine=args.engine)
 
     else:
         print(f"{in_path} is neither a .wav file, nor a folder.")
         sys.exit(1)
+
+    if args.profile is not None:
+        profiling.save(args.profile)